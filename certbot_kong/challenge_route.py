@@ -0,0 +1,49 @@
+""" Module to serve the http-01 challenges of several domains with one Kong
+route
+"""
+from certbot_kong import lua
+
+_plugin_name = "pre-function"
+_path_prefix = "/.well-known/acme-challenge/"
+
+_challenge_function = """
+return function()
+  local validation = validations[kong.request.get_path()]
+  if not validation then
+    return kong.response.exit(404, "")
+  end
+  return kong.response.exit(200, validation, {
+    ["Content-Type"] = "text/plain"
+  })
+end
+"""
+
+
+def route_data(service_id, hosts):
+    """ Get the route matching the challenge paths of the hosts """
+    return {
+        "service": {"id": service_id},
+        "paths": [_path_prefix],
+        "hosts": sorted(set(hosts)),
+        "protocols": ["http"]
+    }
+
+
+def plugin_data(service_id, validations):
+    """ Get the plugin responding to the challenges of a service.
+    The plugin looks up the validation by request path, so a single plugin
+    serves the challenges of every domain.
+
+    :param dict validations: validations by validation path
+    """
+    lines = ["local validations = {"]
+    for path, validation in sorted(validations.items()):
+        lines.append('  [%s] = %s,' % (lua.quote(path), lua.quote(validation)))
+    lines.append("}")
+    return {
+        "service": {"id": service_id},
+        "name": _plugin_name,
+        "config": {
+            "access": ["\n".join(lines) + _challenge_function]
+        }
+    }
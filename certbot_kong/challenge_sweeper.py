@@ -0,0 +1,106 @@
+""" Module to remove http-01 challenge services left behind by failed runs """
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from certbot_kong import constants
+
+logger = logging.getLogger(__name__)
+
+_sweep_processes = 8
+
+
+class SweepReport(object):
+    """ Entities removed (and errors encountered) by a sweep """
+
+    def __init__(self):
+        self.services = [] #type: List[str]
+        self.routes = [] #type: List[str]
+        self.plugins = [] #type: List[str]
+        self.errors = [] #type: List[Tuple[str, str]]
+
+    def merge(self, other):
+        """ Add the entities of another report (if any) to this report """
+        if other is not None:
+            self.services.extend(other.services)
+            self.routes.extend(other.routes)
+            self.plugins.extend(other.plugins)
+            self.errors.extend(other.errors)
+        return self
+
+    def __str__(self):
+        return ("Removed {} orphaned challenge services, {} routes "
+            "and {} plugins ({} errors)".format(
+                len(self.services), len(self.routes), len(self.plugins),
+                len(self.errors)))
+
+
+class ChallengeSweeper(object):
+    """ Remove http-01 challenge services which were not cleaned up,
+    i.e. because certbot crashed while performing challenges.
+
+    Challenge services are found by name with a single paginated listing
+    of services (scoped to the api tags). Only services older than
+    `min_age` seconds are removed so challenges in progress by concurrent
+    runs are left alone. The routes and plugins of each service are removed
+    before the service itself, with services swept concurrently.
+    """
+
+    def __init__(self, api, min_age=3600, processes=_sweep_processes):
+        self._api = api
+        self._min_age = min_age
+        self._processes = processes
+
+    def find_orphans(self):
+        """ Find the challenge services older than min_age """
+        cutoff = time.time() - self._min_age
+        return [s for s in self._api.list_services()
+            if s.get('name') == constants.CHALLENGE_SERVICE_NAME and
+            (s.get('created_at') or 0) <= cutoff]
+
+    def sweep(self):
+        """ Remove the orphaned challenge services
+        :returns: report of the removed entities
+        :rtype: SweepReport
+        """
+        report = SweepReport()
+        orphans = self.find_orphans()
+        if not orphans:
+            return report
+
+        pool = ThreadPool(min(len(orphans), self._processes))
+        try:
+            results = pool.map(self._sweep_service,
+                [s['id'] for s in orphans])
+        finally:
+            pool.close()
+
+        for service_id, routes, plugins, error in results:
+            report.routes.extend(routes)
+            report.plugins.extend(plugins)
+            if error is None:
+                report.services.append(service_id)
+            else:
+                report.errors.append((service_id, error))
+
+        logger.info(str(report))
+        return report
+
+    def _sweep_service(self, service_id):
+        routes = []
+        plugins = []
+        try:
+            for route in self._api.list_service_routes(service_id):
+                self._api.delete_route(route['id'])
+                routes.append(route['id'])
+            for plugin in self._api.list_service_plugins(service_id):
+                self._api.delete_plugin(plugin['id'])
+                plugins.append(plugin['id'])
+            self._api.delete_service(service_id)
+        except Exception as e: # pylint: disable=broad-except
+            logger.warning("Unable to remove challenge service %s: %s",
+                service_id, e)
+            return service_id, routes, plugins, str(e)
+
+        logger.info("Removed orphaned challenge service %s", service_id)
+        return service_id, routes, plugins, None
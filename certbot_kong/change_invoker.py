@@ -2,11 +2,50 @@
 import logging
 import uuid
 import collections
+import copy
+import json
+from multiprocessing.pool import ThreadPool
+
+from certbot_kong import challenge_route
+from certbot_kong import constants
+from certbot_kong import redirect
+from certbot_kong.name_index import NameIndex
+from certbot_kong.route_table import RouteTable
+from certbot_kong import pem_cache
+from certbot_kong import profiler
+# the changes are imported from this module by earlier versions, i.e. the
+# invokers pickled in the work directory reference them here
+from certbot_kong.changes import ID_NAMESPACE
+from certbot_kong.changes import AddCertificate
+from certbot_kong.changes import CertificateData # pylint: disable=unused-import
+from certbot_kong.changes import CertificateStore
+from certbot_kong.changes import Change
+from certbot_kong.changes import CreatePlugin
+from certbot_kong.changes import CreateRoute
+from certbot_kong.changes import CreateService
+from certbot_kong.changes import CreateSni
+from certbot_kong.changes import DeleteCertificate
+from certbot_kong.changes import ParallelChanges
+from certbot_kong.changes import UpdateCertificate # pylint: disable=unused-import
+from certbot_kong.changes import UpdateRedirectPlugin
+from certbot_kong.changes import UpdateRouteProtocols
+from certbot_kong.changes import UpdateSniCertificate
 
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Fields which are compared to detect that an entity changed in Kong
+# (in addition to updated_at when Kong provides it)
+_version_fields = {
+    "certificates": ("cert", "key", "snis"),
+    "routes": ("hosts", "protocols"),
+    "snis": ("certificate",),
+    "plugins": ("config",),
+}
+_revalidate_processes = 8
+_undo_processes = 8
+_reap_batch_size = 50
+
 class KongChangeInvokerError(Exception):
     """Exception when there is a kong config error"""
 
@@ -14,11 +53,23 @@ class KongChangeInvoker(object):
     """ Invoke changes to the Kong configuration """
 
     def __init__(self,
-            api #type: api
+            api, #type: api
+            lease_manager=None, #type: LeaseManager
+            revalidate=True, #type: bool
+            store=None, #type: CertificateStore
+            progress=None #type: ChangeProgress
             ):
         self._api = api
+        self._lease_manager = lease_manager
+        self._revalidate = revalidate
+        # when set, resumable applies record their progress and are not
+        # undone when they fail
+        self._progress = progress
         self._queued_changes = [] #type: List[Change]
         self._executed_changes = collections.deque() #type: Deque[Change]
+        # the store may be shared with the invokers of other workspaces
+        self._store = store if store is not None else CertificateStore()
+        self._clear_plan()
         self.load_config()
 
     @property
@@ -31,10 +82,29 @@ class KongChangeInvoker(object):
         """ Get the certs """
         return self._certs
 
+    @property
+    def names(self):
+        """ Get the names of the certificate SNIs and route hosts
+        :rtype: :class:`~certbot_kong.name_index.NameIndex`
+        """
+        if self._names is None:
+            self._names = NameIndex(self._certs, self._routes)
+        return self._names
+
     def clear_changes(self):
         """ Clear the queued changes """
         self._queued_changes = []
         self._executed_changes = collections.deque()
+        self._store.clear()
+        self._clear_plan()
+
+    def _clear_plan(self):
+        # The calls which queued the changes, so the changes can be
+        # re-planned, and the version and original copy of every entity
+        # the changes depend on.
+        self._intents = [] #type: List[Tuple[str, Tuple]]
+        self._snapshots = collections.OrderedDict() #type: Dict[Tuple[str, str], Tuple]
+        self._new_cert_ids = set() #type: Set[str]
 
 
     def load_config(self):
@@ -43,11 +113,24 @@ class KongChangeInvoker(object):
         if self._queued_changes:
             raise KongChangeInvokerError(
                 'Unable to load config while changes are queued')
-        self._certs = self._api.list_certificates()
-        self._routes = self._api.list_routes()
+        with profiler.active().operation("load_config"):
+            # the certificates are listed while the routes are, so the
+            # pages of both are requested from different admin API nodes
+            pool = ThreadPool(1)
+            try:
+                certs = pool.apply_async(self._api.list_certificates)
+                self._routes = RouteTable(self._api.iter_routes())
+                self._certs = certs.get()
+            finally:
+                pool.close()
+        self._cert_index = None
+        self._names = None
+        # the redirect plugin is only loaded when hosts are redirected
+        self._redirect_plugin = None
+        self._redirect_plugin_loaded = False
 
     def set_sni_cert(self, sni, fullchain_str, key_str,
-            delete_unused_certs=True):
+            delete_unused_certs=True, fingerprint=None):
         """Sets a SNI with a certificate.
 
         If the SNI does not exist then it will be created.
@@ -58,14 +141,31 @@ class KongChangeInvoker(object):
         All changes are queued, operations on Kong Admin API to commit the
         changes will perfromed by apply_changes()
 
+        The fingerprint of the fullchain and key (see
+        :func:`~certbot_kong.pem_cache.fingerprint`) can be provided when
+        it is already known.
         """
-        cert = self._get_cert(fullchain_str, key_str)
+        if fingerprint is None:
+            fingerprint = pem_cache.fingerprint(fullchain_str, key_str)
+        self._intents.append(("set_sni_cert",
+            (sni, fullchain_str, key_str, delete_unused_certs, fingerprint)))
+        cert = self._get_cert(fingerprint)
         old_cert, old_cert_index = self._get_sni_cert(sni)
         cert_id = None
 
+        if old_cert is None:
+            self._snapshot("snis", sni, None)
+        else:
+            self._snapshot("certificates", old_cert['id'], old_cert)
+        if cert is not None and cert['id'] not in self._new_cert_ids:
+            self._snapshot("certificates", cert['id'], cert)
+
         if cert is None:
             # Create certificate
-            cert_id = str(uuid.uuid4())
+            # the id is derived from the certificate so another run
+            # planning the same deployment plans the same changes
+            cert_id = str(uuid.uuid5(ID_NAMESPACE, "%s/certificates/%s" % (
+                getattr(self._api, 'workspace', None) or "", fingerprint)))
             cert = {
                 "id": cert_id,
                 "cert": fullchain_str,
@@ -73,11 +173,14 @@ class KongChangeInvoker(object):
                 "snis": []
             }
             self._certs.append(cert)
+            self._get_cert_index()[fingerprint] = cert
+            self._new_cert_ids.add(cert_id)
             logger.info("Adding certificate %s",
                 cert_id)
             self._queue_change(
                 AddCertificate(cert_id,
-                    CertificateData(fullchain_str, key_str)))
+                    self._store.add(fullchain_str, key_str, fingerprint),
+                    self._store))
 
         else:
             cert_id = cert['id']
@@ -106,30 +209,45 @@ class KongChangeInvoker(object):
                 # update cert snis reference
                 old_snis = old_cert.get('snis', [])
                 old_snis.remove(sni)
+                if self._names is not None:
+                    self._names.discard(sni)
                 if not old_snis and delete_unused_certs:
                     # Certificate no longer references any snis and
                     # can be deleted
                     del self._certs[old_cert_index]
+                    old_ref = self._store.add(
+                        old_cert.get('cert'), old_cert.get('key'))
+                    self._get_cert_index().pop(old_ref, None)
                     logger.info("Deleting certificate %s "
                         "as no SNIs are using it",
                         old_cert_id)
                     self._queue_change(DeleteCertificate(old_cert_id,
-                        CertificateData(
-                            old_cert.get('cert'), old_cert.get('key'))))
+                        old_ref, self._store, tags=old_cert.get('tags')))
 
         # Update cert with reference to sni
         snis = cert.get('snis', [])
+        if sni not in snis and self._names is not None:
+            self._names.add(sni)
         snis.append(sni)
         cert['snis'] = list(set(snis))
 
-    def _get_cert(self, fullchain_str, key_str):
+    def _get_cert(self, fingerprint):
         """helper function to find the certificate matching the
-        fullchain and key
+        fingerprint of the fullchain and key
         """
-        for c in self._certs:
-            if(fullchain_str == c.get('cert') and key_str == c.get('key')):
-                return c
-        return None
+        return self._get_cert_index().get(fingerprint)
+
+    def _get_cert_index(self):
+        """helper function to get the certificates by the fingerprint of
+        their fullchain and key. Each certificate is hashed once when the
+        index is first used after the config is loaded.
+        """
+        if self._cert_index is None:
+            self._cert_index = {}
+            for c in self._certs:
+                self._cert_index.setdefault(
+                    pem_cache.fingerprint(c.get('cert'), c.get('key')), c)
+        return self._cert_index
 
     def _get_sni_cert(self, sni):
         """helper function to find the certificate used by the SNI.
@@ -141,6 +259,42 @@ class KongChangeInvoker(object):
             i += 1
         return None, -1
 
+    def reap_unused_certs(self, batch_size=_reap_batch_size):
+        """Deletes every certificate which is not referenced by any SNI.
+
+        Unused certificates are found in one pass over the certificates and
+        their deletion is queued in batches which are deleted concurrently.
+        Each deletion can be undone like any other DeleteCertificate.
+
+        :returns: ids of the certificates to be deleted
+        """
+        self._intents.append(("reap_unused_certs", (batch_size,)))
+
+        sni_refs = collections.Counter()
+        for c in self._certs:
+            sni_refs[c['id']] += len(c.get('snis') or [])
+
+        unused = [c for c in self._certs if not sni_refs[c['id']]]
+        if not unused:
+            return []
+
+        self._certs = [c for c in self._certs if sni_refs[c['id']]]
+        self._cert_index = None
+        changes = []
+        for c in unused:
+            self._snapshot("certificates", c['id'], c)
+            logger.info("Deleting certificate %s "
+                "as no SNIs are using it",
+                c['id'])
+            changes.append(DeleteCertificate(c['id'],
+                self._store.add(c.get('cert'), c.get('key')), self._store,
+                tags=c.get('tags')))
+
+        for i in range(0, len(changes), batch_size):
+            self._queue_change(ParallelChanges(changes[i:i + batch_size]))
+
+        return [c['id'] for c in unused]
+
     def redirect_route(self, route_id):
         """ Configure http to https redirection for a route """
         route = self._get_route(route_id)
@@ -149,17 +303,78 @@ class KongChangeInvoker(object):
             raise KongChangeInvokerError("Unable to redirect route for %s "
             "as there is no matching route" % route_id)
 
+        self._intents.append(("redirect_route", (route_id,)))
+        self._snapshot("routes", route_id, route)
+
         old_protocols = route.get('protocols', [])
         redirect_protocols = ['https']
         logger.info("Updating Route %s protocols from %s to %s",
            route_id, str(old_protocols), str(redirect_protocols))
         self._queue_change(UpdateRouteProtocols(route_id,
             redirect_protocols, old_protocols))
-        route['protocols'] = redirect_protocols
+        self._routes.set_protocols(route_id, redirect_protocols)
+
+    def redirect_hosts(self, hosts):
+        """ Configure http to https redirection for hosts.
+        Every host is redirected by a single global plugin, so redirecting
+        any number of hosts is one change.
+        """
+        plugin = self._get_redirect_plugin()
+        current_hosts = redirect.get_hosts(plugin)
+        new_hosts = current_hosts.union(hosts)
+        if new_hosts == current_hosts:
+            return
+
+        self._intents.append(("redirect_hosts", (sorted(hosts),)))
+        plugin_id = self._get_redirect_plugin_id()
+        self._snapshot("plugins", plugin_id, plugin)
+        logger.info("Redirecting hosts %s with plugin %s",
+            ", ".join(sorted(new_hosts - current_hosts)), plugin_id)
+
+        # queued redirects of the same plan are merged into one change
+        old_hosts = current_hosts if plugin is not None else None
+        queued = [c for c in self._queued_changes
+            if isinstance(c, UpdateRedirectPlugin)]
+        if queued:
+            self._queued_changes.remove(queued[0])
+            old_hosts = queued[0].old_hosts
+        self._queue_change(
+            UpdateRedirectPlugin(plugin_id, new_hosts, old_hosts))
+        self._redirect_plugin = dict(plugin or {}, id=plugin_id,
+            **redirect.plugin_data(new_hosts))
+
+    def _get_redirect_plugin_id(self):
+        return redirect.plugin_id(getattr(self._api, 'workspace', None))
+
+    def _get_redirect_plugin(self):
+        if not self._redirect_plugin_loaded:
+            plugin_id = self._get_redirect_plugin_id()
+            plugin = self._api.get_plugin(plugin_id)
+            if plugin is None:
+                self._check_no_global_plugin(plugin_id)
+            self._redirect_plugin = plugin
+            self._redirect_plugin_loaded = True
+        return self._redirect_plugin
+
+    def _check_no_global_plugin(self, plugin_id):
+        """ helper function to check the redirect plugin can be created.
+        Kong allows a single global instance of a plugin, so the redirect
+        plugin cannot be created next to another global pre-function plugin.
+        """
+        others = [p['id'] for p in
+            self._api.list_global_plugins(redirect.PLUGIN_NAME)
+            if p['id'] != plugin_id]
+        if others:
+            raise KongChangeInvokerError("Unable to redirect hosts with a "
+                "plugin as there is already a global %s plugin (%s), use "
+                "--kong-redirect-strategy protocols instead" % (
+                    redirect.PLUGIN_NAME, ", ".join(others)))
 
     def create_http01_challenge_service(self,
             domain, validation, validation_path):
         """ Create a service to complete a 'let's encrypt' HTTP01 challenge """
+        self._intents.append(("create_http01_challenge_service",
+            (domain, validation, validation_path)))
         service_id = str(uuid.uuid4())
         plugin_id = str(uuid.uuid4())
         route_id = str(uuid.uuid4())
@@ -169,7 +384,7 @@ class KongChangeInvoker(object):
         self._queue_change(
                 CreateService(service_id,
                     {
-                        "name": "certbot-kong_TEMPORARY_ACME_challenge",
+                        "name": constants.CHALLENGE_SERVICE_NAME,
                         "url": "http://invalid.example.com"
                     }
                 ))
@@ -196,14 +411,155 @@ class KongChangeInvoker(object):
                     }
                 ))
 
+    def create_http01_challenge_route(self, challenges):
+        """ Create a service, with a single route and plugin, to complete the
+        'let's encrypt' HTTP01 challenges of several domains
+
+        :param list challenges: (domain, validation, validation_path) tuples
+        """
+        challenges = [tuple(c) for c in challenges]
+        if not challenges:
+            return
+        self._intents.append(("create_http01_challenge_route", (challenges,)))
+        service_id = str(uuid.uuid4())
+        plugin_id = str(uuid.uuid4())
+        route_id = str(uuid.uuid4())
+        logger.info("Adding http01 challenge service %s for %d domains "
+            "(with pre-function plugin %s and route %s)",
+            service_id, len(challenges), plugin_id, route_id)
+        self._queue_change(
+                CreateService(service_id,
+                    {
+                        "name": constants.CHALLENGE_SERVICE_NAME,
+                        "url": "http://invalid.example.com"
+                    }
+                ))
+        self._queue_change(CreatePlugin(plugin_id,
+            challenge_route.plugin_data(service_id,
+                dict((path, v) for _, v, path in challenges))))
+        self._queue_change(CreateRoute(route_id,
+            challenge_route.route_data(service_id,
+                [domain for domain, _, _ in challenges])))
+
 
     def _get_route(self, route_id):
-        for r in self._routes:
-            if r['id'] == route_id:
-                return r
-        return None
+        return self._routes.get(route_id)
 
 
+    def _snapshot(self, kind, entity_id, entity):
+        """ helper function to record the version and a copy of an entity
+        before it is first changed by the plan
+        """
+        key = (kind, entity_id)
+        if key not in self._snapshots:
+            self._snapshots[key] = (
+                self._get_version(kind, entity), copy.deepcopy(entity))
+
+    @staticmethod
+    def _get_version(kind, entity):
+        if entity is None:
+            return None
+        fields = [entity.get('updated_at')]
+        for f in _version_fields[kind]:
+            value = entity.get(f)
+            fields.append(sorted(value) if isinstance(value, list) else value)
+        return json.dumps(fields, sort_keys=True)
+
+    def _fetch_entity(self, key):
+        kind, entity_id = key
+        if kind == "certificates":
+            return self._api.get_certificate(entity_id)
+        if kind == "routes":
+            return self._api.get_route(entity_id)
+        if kind == "plugins":
+            return self._api.get_plugin(entity_id)
+        return self._api.get_sni(entity_id)
+
+    def revalidate(self):
+        """ Check that the entities the queued changes depend on have not
+        changed in Kong since the config was loaded.
+
+        Only the entities recorded by the plan are fetched (concurrently).
+        If any have changed, the model is updated with the current state of
+        the changed entities and the queued changes are re-planned.
+
+        :returns: True if the changes were re-planned
+        """
+        if not self._snapshots:
+            return False
+
+        keys = list(self._snapshots.keys())
+        pool = ThreadPool(min(len(keys), _revalidate_processes))
+        try:
+            current = pool.map(self._fetch_entity, keys)
+        finally:
+            pool.close()
+
+        stale = {}
+        for key, entity in zip(keys, current):
+            if self._get_version(key[0], entity) != self._snapshots[key][0]:
+                stale[key] = entity
+
+        if not stale:
+            return False
+
+        logger.info("Kong configuration changed since it was loaded, "
+            "re-planning changes for %s",
+            ", ".join("%s %s" % key for key in stale))
+
+        for (kind, _), entity in list(stale.items()):
+            if kind == "snis" and entity is not None:
+                # the SNI now exists, fetch the certificate it uses
+                cert_id = entity['certificate']['id']
+                stale[("certificates", cert_id)] = (
+                    self._api.get_certificate(cert_id))
+
+        self._replan(stale)
+        return True
+
+    def _replan(self, stale):
+        """ helper function to restore the model to the state before
+        planning (with the current state of stale entities) and queue the
+        changes again.
+        """
+        self._certs = [c for c in self._certs
+            if c['id'] not in self._new_cert_ids]
+        self._cert_index = None
+        self._names = None
+
+        originals = dict((key, original)
+            for key, (_, original) in self._snapshots.items())
+        originals.update(stale)
+        for (kind, entity_id), entity in originals.items():
+            if kind == "certificates":
+                self._replace_entity(self._certs, entity_id, entity)
+            elif kind == "routes":
+                self._routes.replace(entity_id, entity)
+            elif kind == "plugins":
+                self._redirect_plugin = entity
+                self._redirect_plugin_loaded = True
+
+        intents = self._intents
+        self._queued_changes = []
+        self._clear_plan()
+        for name, args in intents:
+            try:
+                getattr(self, name)(*args)
+            except KongChangeInvokerError:
+                logger.warning("Unable to re-plan %s%s", name, args)
+
+    @staticmethod
+    def _replace_entity(entities, entity_id, entity):
+        for i, e in enumerate(entities):
+            if e['id'] == entity_id:
+                if entity is None:
+                    del entities[i]
+                else:
+                    entities[i] = entity
+                return
+        if entity is not None:
+            entities.append(entity)
+
     def get_changes_details(self):
         """ Get a list of changes queued to be invoked """
         details = []
@@ -217,279 +573,152 @@ class KongChangeInvoker(object):
             ):
         self._queued_changes.append(change)
 
-    def apply_changes(self):
+    def get_lock_keys(self):
+        """ Get the lock keys of the entities touched by the queued changes
+        """
+        keys = set()
+        for change in self._queued_changes:
+            keys.update(change.lock_keys())
+        workspace = getattr(self._api, 'workspace', None)
+        if workspace:
+            # entities of different workspaces are leased independently
+            keys = set(workspace + ":" + k for k in keys)
+        return keys
+
+    def apply_changes(self, resumable=False):
         """ Apply changes.
-        Iterate through the changes and execute() each of them
+        Iterate through the changes and execute() each of them.
+        When there is a lease manager, leases on the entities touched by
+        the changes are held while the changes are applied.
+
+        When resumable (and the invoker has a progress) the id of each
+        applied change is recorded. Changes recorded by a previous run which
+        are verified in Kong are skipped, and if a change fails the applied
+        changes are kept so the next run can resume from the failed change.
         """
+        if self._lease_manager is None:
+            self._revalidate_and_apply_changes(resumable)
+            return
+
+        keys = self.get_lock_keys()
+        while True:
+            with self._lease_manager.hold(keys):
+                if self._revalidate:
+                    self.revalidate()
+                replanned_keys = self.get_lock_keys()
+                if replanned_keys.issubset(keys):
+                    self._apply_changes(resumable)
+                    return
+            # re-planning touched other entities, lease them as well
+            keys = keys.union(replanned_keys)
+
+    def _revalidate_and_apply_changes(self, resumable=False):
+        if self._revalidate:
+            self.revalidate()
+        self._apply_changes(resumable)
+
+    def _apply_changes(self, resumable=False):
+        progress = self._progress if resumable else None
         for change in self._queued_changes:
+            if progress is not None and self._is_applied(change, progress):
+                logger.info("Skipping change applied by a previous run: %s",
+                    change.get_details())
+                continue
             try:
                 change.execute(self._api)
                 self._executed_changes.append(change)
             except:
-                # revert changes
+                if progress is not None:
+                    logger.warning("Unable to apply changes, %d applied "
+                        "changes are kept to resume from", len(progress))
+                    raise
+                # the remaining changes are not attempted. The circuit
+                # breaker may have opened on the failure, close it so the
+                # executed changes can be undone
+                self._api.reset_circuit()
                 self.undo_changes()
                 raise
+            if progress is not None:
+                progress.add(self._get_progress_id(change))
+        if progress is not None:
+            # the changes applied by a previous run are not planned again
+            # once they are in Kong, so every id of this invoker is
+            # discarded rather than only the ids of the queued changes
+            progress.discard([i for i in progress
+                if self._is_own_progress_id(i)])
         self._queued_changes = []
+        self._clear_plan()
+
+    def _is_applied(self, change, progress):
+        """ helper function to check if a change was applied by a previous
+        run, and is still applied
+        """
+        return (self._get_progress_id(change) in progress and
+            change.verify(self._api))
+
+    def _get_progress_id(self, change):
+        """ helper function to get the id of a change in the progress, the
+        progress may be shared by the invokers of several workspaces
+        """
+        workspace = getattr(self._api, 'workspace', None)
+        if workspace:
+            return workspace + ":" + change.change_id
+        return change.change_id
+
+    def _is_own_progress_id(self, progress_id):
+        """ helper function to check if an id in the progress was recorded
+        by an invoker of the same workspace
+        """
+        workspace = getattr(self._api, 'workspace', None)
+        if workspace:
+            return progress_id.startswith(workspace + ":")
+        return ":" not in progress_id
 
     def undo_changes(self):
         """ undo changes
+        Independent changes (see Change.dependency_keys()) are undone
+        concurrently. A change is only undone once every change executed
+        after it which has keys in common has been undone.
         """
         while self._executed_changes:
-            change = self._executed_changes.pop()
-
+            wave = self._get_undo_wave()
+            pool = ThreadPool(min(len(wave), _undo_processes))
             try:
-                change.undo(self._api)
-            except Exception:
+                errors = pool.map(self._undo_change, wave)
+            finally:
+                pool.close()
+
+            for change, error in zip(wave, errors):
+                if error is None:
+                    self._executed_changes.remove(change)
+            failed = [c for c, e in zip(wave, errors) if e is not None]
+            if failed:
                 raise UndoChangesError(
-                    change,
+                    failed[0],
                     self._executed_changes,
                     "Unable to undo changes."
                     " Configuration may be in an inconsitant state")
 
-class Change(object):
-    """Change interface"""
-
-    def execute(self, api #type: api
-            ):
-        """ apply the change """
-        raise NotImplementedError
-
-    def undo(self, api #type: api
-            ):
-        """ undo the change """
-        raise NotImplementedError
-
-    def get_details(self):
-        """ get details of the change """
-        raise NotImplementedError
-
-class AddCertificate(Change):
-    """Change to add a new certificate to kong."""
-
-    def __init__(self,
-        certificate_id,
-        certificate_data #type: CertificateData
-            ):
-        self._certificate_id = certificate_id
-        self._certificate_data = certificate_data
-
-    @property
-    def certificate_id(self):
-        """ get the certificate_id """
-        return self._certificate_id
-
-    def execute(self, api #type: api
-            ):
-        api.update_or_create_certificate(
-            self._certificate_id,
-            self._certificate_data.cert,
-            self._certificate_data.key,
-            self._certificate_data.snis
-        )
-
-    def undo(self, api #type: api
-            ):
-        api.delete_certificate(self._certificate_id)
-
-    def get_details(self):
-        return "Add certificate %s" % self._certificate_id
-
-class DeleteCertificate(Change):
-    """Change to delete a certificate in kong."""
-
-    def __init__(self, certificate_id, certificate_data #type: CertificateData
-            ):
-        self._certificate_id = certificate_id
-        self._certificate_data = certificate_data
-
-    def execute(self, api #type: api
-            ):
-        api.delete_certificate(self._certificate_id)
-
-    def undo(self, api #type: api
-            ):
-
-        api.update_or_create_certificate(
-            self._certificate_id,
-            self._certificate_data.cert,
-            self._certificate_data.key,
-            self._certificate_data.snis
-        )
-
-    def get_details(self):
-        return "Delete certificate %s" % self._certificate_id
-
-class UpdateCertificate(Change):
-    """Change to update an existing certificate to kong."""
-    def __init__(self, certificate_id, #type str
-            certificate_data,  #type: CertificateData
-            old_certificate_data #type: CertificateData
-            ):
-        self._certificate_id = certificate_id
-        self._certificate_data = certificate_data
-        self._old_certificate_data = old_certificate_data
-
-    def execute(self, api):
-        api.update_certificate(
-            self._certificate_id,
-            self._certificate_data.cert,
-            self._certificate_data.key,
-            self._certificate_data.snis
-        )
-
-    def undo(self, api):
-        api.update_certificate(
-            self._certificate_id,
-            self._old_certificate_data.cert,
-            self._old_certificate_data.key,
-            self._old_certificate_data.snis
-        )
-
-    def get_details(self):
-        return "Update certificate %s" % self._certificate_id
-
-class UpdateRouteProtocols(Change):
-    """Change to update an existing route protocols to kong."""
-    def __init__(self, route_id, #type str
-            protocols, #type: list[str]
-            old_protocols #type: list[str]
-            ):
-        self.route_id = route_id
-        self.protocols = protocols
-        self.old_protocols = old_protocols
-
-    def execute(self, api):
-        api.update_route_protocols(
-            self.route_id,
-            self.protocols
-        )
-
-    def undo(self, api):
-        api.update_route_protocols(
-            self.route_id,
-            self.old_protocols
-        )
-
-    def get_details(self):
-        return "Update route protocol %s" % self.route_id
-
-class UpdateSniCertificate(Change):
-    """Change to update an existing sni with a certificate."""
-    def __init__(self,
-            sni, # type str
-            cert_id, #type str
-            old_cert_id #type str
-            ):
-        self._sni = sni
-        self._cert_id = cert_id
-        self._old_cert_id = old_cert_id
-
-    def execute(self, api):
-        api.update_sni(
-            self._sni,
-            self._cert_id
-        )
-
-    def undo(self, api):
-        api.update_sni(
-            self._sni,
-            self._old_cert_id
-        )
-
-    def get_details(self):
-        return "Update SNI %s" % self._sni
-
-class CreateSni(Change):
-    """Change to update an existing sni with a certificate."""
-    def __init__(self,
-            sni, # type str
-            cert_id #type str
-            ):
-        self._sni = sni
-        self._cert_id = cert_id
-
-    def execute(self, api):
-        api.create_sni(
-            self._sni,
-            self._cert_id
-        )
-
-    def undo(self, api):
-        api.delete_sni(
-            self._sni
-        )
-
-    def get_details(self):
-        return "Add SNI %s" % self._sni
-
-class CreateService(Change):
-    """Change to create a service."""
-    def __init__(self,
-            service_id, # type str
-            data #type Dict
-            ):
-        self._service_id = service_id
-        self._data = data
-
-    def execute(self, api):
-        api.update_or_create_service(self._service_id, self._data)
-
-    def undo(self, api):
-        api.delete_service(
-            self._service_id
-        )
-
-    def get_details(self):
-        return "Add Service %s" % self._service_id
-
-class CreatePlugin(Change):
-    """Change to create a plugin."""
-    def __init__(self,
-            plugin_id, # type str
-            data #type Dict
-            ):
-        self._plugin_id = plugin_id
-        self._data = data
-
-    def execute(self, api):
-        api.update_or_create_plugin(self._plugin_id, self._data)
-
-    def undo(self, api):
-        api.delete_plugin(
-            self._plugin_id
-        )
-
-    def get_details(self):
-        return "Add Plugin %s" % self._plugin_id
-
-
-class CreateRoute(Change):
-    """Change to create a route."""
-    def __init__(self,
-            route_id, # type str
-            data #type Dict
-            ):
-        self._route_id = route_id
-        self._data = data
-
-    def execute(self, api):
-        api.update_or_create_route(self._route_id, self._data)
-
-    def undo(self, api):
-        api.delete_route(
-            self._route_id
-        )
-
-    def get_details(self):
-        return "Add Route %s" % self._route_id
-
-class CertificateData(object):
-    """ certificat data """
-    def __init__(self, cert, key, snis=None):
-        self.cert = cert
-        self.key = key
-        self.snis = snis
-
+    def _get_undo_wave(self):
+        """ helper function to get the executed changes which can be undone
+        now, i.e. which have no keys in common with a later change
+        """
+        wave = []
+        later_keys = set()
+        for change in reversed(self._executed_changes):
+            keys = set(change.dependency_keys())
+            if not keys & later_keys:
+                wave.append(change)
+            later_keys.update(keys)
+        return wave
+
+    def _undo_change(self, change):
+        try:
+            change.undo(self._api)
+            return None
+        except Exception as e: # pylint: disable=broad-except
+            logger.warning("Unable to undo %s: %s", change.get_details(), e)
+            return e
 
 class UndoChangesError(Exception):
     """ Rasied when an error is encountered while undoing changes"""
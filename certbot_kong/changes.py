@@ -0,0 +1,679 @@
+""" Module of the changes to the Kong configuration applied (and undone) by
+the change invoker
+"""
+import json
+import logging
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from certbot_kong import pem_cache
+from certbot_kong import redirect
+
+logger = logging.getLogger(__name__)
+
+# namespace of the deterministic change and certificate ids
+ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "certbot-kong")
+
+
+class Change(object):
+    """Change interface
+
+    Changes are compact slotted records. `_fields` names the constructor
+    arguments which are stored in the `_<field>` slots and make up the
+    serialized record of the change (see to_record() and from_record()).
+    Certificate material is referenced by fingerprint in a shared
+    CertificateStore rather than held by each change.
+    """
+    __slots__ = ()
+    _fields = () #type: Tuple[str, ...]
+    _uses_store = False
+
+    def execute(self, api #type: api
+            ):
+        """ apply the change """
+        raise NotImplementedError
+
+    def undo(self, api #type: api
+            ):
+        """ undo the change """
+        raise NotImplementedError
+
+    def get_details(self):
+        """ get details of the change """
+        raise NotImplementedError
+
+    def lock_keys(self): # pylint: disable=no-self-use
+        """ get the keys to lease while the change is applied """
+        return ()
+
+    def dependency_keys(self):
+        """ get the keys of the entities the change touches or references.
+        Changes without keys in common are independent and can be undone
+        concurrently.
+        """
+        return self.lock_keys()
+
+    @property
+    def change_id(self):
+        """ get the id of the change, derived from its record so the same
+        change planned by another run has the same id
+        """
+        return str(uuid.uuid5(ID_NAMESPACE,
+            json.dumps(self.to_record(), sort_keys=True)))
+
+    def verify(self, api): # pylint: disable=no-self-use,unused-argument
+        """ check that the change is applied in Kong. Changes which cannot
+        be verified are never skipped by a resumed run.
+        """
+        return False
+
+    def to_record(self):
+        """ get the serialized record of the change.
+        The record only contains JSON types.
+        """
+        record = {"type": type(self).__name__}
+        for field in self._fields:
+            value = getattr(self, "_" + field)
+            record[field] = list(value) if isinstance(value, tuple) else value
+        return record
+
+    @staticmethod
+    def from_record(record, store=None):
+        """ create a change from its serialized record
+        :param dict record: record from to_record()
+        :param CertificateStore store: store of the certificates
+            referenced by the record
+        """
+        cls = _change_types[record["type"]]
+        return cls._from_record(record, store)
+
+    @classmethod
+    def _from_record(cls, record, store):
+        kwargs = dict((f, record.get(f)) for f in cls._fields)
+        if cls._uses_store:
+            kwargs["store"] = store
+        return cls(**kwargs)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+            self.to_record() == other.to_record())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+class AddCertificate(Change):
+    """Change to add a new certificate to kong.
+
+    The certificate id is derived from the certificate, so runs planning
+    the same deployment add the same certificate. Undo only deletes the
+    certificate when it did not exist before the change and no SNI
+    references it, so a run which rolls back does not delete the
+    certificate of another run.
+    """
+    __slots__ = ('_certificate_id', '_certificate_ref', '_store', '_created')
+    _fields = ('certificate_id', 'certificate_ref')
+    _uses_store = True
+
+    def __init__(self,
+        certificate_id,
+        certificate_ref, #type: str
+        store #type: CertificateStore
+            ):
+        self._certificate_id = certificate_id
+        self._certificate_ref = certificate_ref
+        self._store = store
+        # whether execute() created the certificate, None when unknown
+        self._created = None
+
+    @property
+    def certificate_id(self):
+        """ get the certificate_id """
+        return self._certificate_id
+
+    def execute(self, api #type: api
+            ):
+        certificate_data = self._store.get(self._certificate_ref)
+        self._created = api.get_certificate(self._certificate_id) is None
+        api.update_or_create_certificate(
+            self._certificate_id,
+            certificate_data.cert,
+            certificate_data.key
+        )
+
+    def undo(self, api #type: api
+            ):
+        if getattr(self, '_created', None) is False:
+            logger.info("Keeping certificate %s, it was added by another "
+                "run", self._certificate_id)
+            return
+        # SNIs of this run are undone first, SNIs still referencing the
+        # certificate were created by another run
+        certificate = api.get_certificate(self._certificate_id)
+        if certificate is not None and certificate.get('snis'):
+            logger.info("Keeping certificate %s, it is referenced by %s",
+                self._certificate_id, ", ".join(certificate['snis']))
+            return
+        api.delete_certificate(self._certificate_id)
+
+    def get_details(self):
+        return "Add certificate %s" % self._certificate_id
+
+    def verify(self, api):
+        return _has_certificate(api, self._certificate_id,
+            self._store.get(self._certificate_ref))
+
+    def lock_keys(self):
+        return ("certificate:" + self._certificate_id,)
+
+class DeleteCertificate(Change):
+    """Change to delete a certificate in kong."""
+    __slots__ = ('_certificate_id', '_certificate_ref', '_tags', '_store')
+    _fields = ('certificate_id', 'certificate_ref', 'tags')
+    _uses_store = True
+
+    def __init__(self, certificate_id,
+            certificate_ref, #type: str
+            store, #type: CertificateStore
+            tags=None #type: List[str]
+            ):
+        self._certificate_id = certificate_id
+        self._certificate_ref = certificate_ref
+        self._tags = tuple(tags) if tags is not None else None
+        self._store = store
+
+    def execute(self, api #type: api
+            ):
+        api.delete_certificate(self._certificate_id)
+
+    def undo(self, api #type: api
+            ):
+        certificate_data = self._store.get(self._certificate_ref)
+        api.update_or_create_certificate(
+            self._certificate_id,
+            certificate_data.cert,
+            certificate_data.key,
+            tags=list(self._tags) if self._tags is not None else None
+        )
+
+    def get_details(self):
+        return "Delete certificate %s" % self._certificate_id
+
+    def verify(self, api):
+        return api.get_certificate(self._certificate_id) is None
+
+    def lock_keys(self):
+        return ("certificate:" + self._certificate_id,)
+
+class UpdateCertificate(Change):
+    """Change to update an existing certificate to kong."""
+    __slots__ = ('_certificate_id', '_certificate_ref', '_old_certificate_ref',
+        '_store')
+    _fields = ('certificate_id', 'certificate_ref', 'old_certificate_ref')
+    _uses_store = True
+
+    def __init__(self, certificate_id, #type str
+            certificate_ref,  #type: str
+            old_certificate_ref, #type: str
+            store #type: CertificateStore
+            ):
+        self._certificate_id = certificate_id
+        self._certificate_ref = certificate_ref
+        self._old_certificate_ref = old_certificate_ref
+        self._store = store
+
+    def execute(self, api):
+        certificate_data = self._store.get(self._certificate_ref)
+        api.update_certificate(
+            self._certificate_id,
+            certificate_data.cert,
+            certificate_data.key
+        )
+
+    def undo(self, api):
+        certificate_data = self._store.get(self._old_certificate_ref)
+        api.update_certificate(
+            self._certificate_id,
+            certificate_data.cert,
+            certificate_data.key
+        )
+
+    def get_details(self):
+        return "Update certificate %s" % self._certificate_id
+
+    def verify(self, api):
+        return _has_certificate(api, self._certificate_id,
+            self._store.get(self._certificate_ref))
+
+    def lock_keys(self):
+        return ("certificate:" + self._certificate_id,)
+
+class UpdateRouteProtocols(Change):
+    """Change to update an existing route protocols to kong."""
+    __slots__ = ('_route_id', '_protocols', '_old_protocols')
+    _fields = ('route_id', 'protocols', 'old_protocols')
+
+    def __init__(self, route_id, #type str
+            protocols, #type: list[str]
+            old_protocols #type: list[str]
+            ):
+        self._route_id = route_id
+        self._protocols = tuple(protocols)
+        self._old_protocols = tuple(old_protocols)
+
+    @property
+    def route_id(self):
+        """ get the route_id """
+        return self._route_id
+
+    @property
+    def protocols(self):
+        """ get the protocols """
+        return list(self._protocols)
+
+    @property
+    def old_protocols(self):
+        """ get the protocols before the change """
+        return list(self._old_protocols)
+
+    def execute(self, api):
+        api.update_route_protocols(
+            self._route_id,
+            self.protocols
+        )
+
+    def undo(self, api):
+        api.update_route_protocols(
+            self._route_id,
+            self.old_protocols
+        )
+
+    def get_details(self):
+        return "Update route protocol %s" % self._route_id
+
+    def verify(self, api):
+        route = api.get_route(self._route_id)
+        return (route is not None and
+            sorted(route.get('protocols') or []) == sorted(self._protocols))
+
+    def lock_keys(self):
+        return ("route:" + self._route_id,)
+
+class UpdateSniCertificate(Change):
+    """Change to update an existing sni with a certificate."""
+    __slots__ = ('_sni', '_cert_id', '_old_cert_id')
+    _fields = ('sni', 'cert_id', 'old_cert_id')
+
+    def __init__(self,
+            sni, # type str
+            cert_id, #type str
+            old_cert_id #type str
+            ):
+        self._sni = sni
+        self._cert_id = cert_id
+        self._old_cert_id = old_cert_id
+
+    def execute(self, api):
+        api.update_sni(
+            self._sni,
+            self._cert_id
+        )
+
+    def undo(self, api):
+        api.update_sni(
+            self._sni,
+            self._old_cert_id
+        )
+
+    def get_details(self):
+        return "Update SNI %s" % self._sni
+
+    def verify(self, api):
+        return _has_sni(api, self._sni, self._cert_id)
+
+    def lock_keys(self):
+        return ("sni:" + self._sni,)
+
+    def dependency_keys(self):
+        return ("sni:" + self._sni, "certificate:" + self._cert_id,
+            "certificate:" + str(self._old_cert_id))
+
+class UpdateRedirectPlugin(Change):
+    """Change to update the hosts redirected by the redirect plugin."""
+    __slots__ = ('_plugin_id', '_hosts', '_old_hosts')
+    _fields = ('plugin_id', 'hosts', 'old_hosts')
+
+    def __init__(self,
+            plugin_id, # type str
+            hosts, #type: Iterable[str]
+            old_hosts #type: Optional[Iterable[str]]
+            ):
+        self._plugin_id = plugin_id
+        self._hosts = tuple(sorted(hosts))
+        self._old_hosts = (tuple(sorted(old_hosts))
+            if old_hosts is not None else None)
+
+    @property
+    def old_hosts(self):
+        """ get the hosts before the change, None if there was no plugin """
+        return self._old_hosts
+
+    def execute(self, api):
+        api.update_or_create_plugin(self._plugin_id,
+            redirect.plugin_data(self._hosts))
+
+    def undo(self, api):
+        if self._old_hosts is None:
+            api.delete_plugin(self._plugin_id)
+        else:
+            api.update_or_create_plugin(self._plugin_id,
+                redirect.plugin_data(self._old_hosts))
+
+    def get_details(self):
+        return "Redirect %d hosts with plugin %s" % (
+            len(self._hosts), self._plugin_id)
+
+    def verify(self, api):
+        return (redirect.get_hosts(api.get_plugin(self._plugin_id)) ==
+            set(self._hosts))
+
+    def lock_keys(self):
+        return ("plugin:" + self._plugin_id,)
+
+class CreateSni(Change):
+    """Change to update an existing sni with a certificate."""
+    __slots__ = ('_sni', '_cert_id')
+    _fields = ('sni', 'cert_id')
+
+    def __init__(self,
+            sni, # type str
+            cert_id #type str
+            ):
+        self._sni = sni
+        self._cert_id = cert_id
+
+    def execute(self, api):
+        api.create_sni(
+            self._sni,
+            self._cert_id
+        )
+
+    def undo(self, api):
+        api.delete_sni(
+            self._sni
+        )
+
+    def get_details(self):
+        return "Add SNI %s" % self._sni
+
+    def verify(self, api):
+        return _has_sni(api, self._sni, self._cert_id)
+
+    def lock_keys(self):
+        return ("sni:" + self._sni,)
+
+    def dependency_keys(self):
+        return ("sni:" + self._sni, "certificate:" + self._cert_id)
+
+class CreateService(Change):
+    """Change to create a service."""
+    __slots__ = ('_service_id', '_data')
+    _fields = ('service_id', 'data')
+
+    def __init__(self,
+            service_id, # type str
+            data #type Dict
+            ):
+        self._service_id = service_id
+        self._data = data
+
+    def execute(self, api):
+        api.update_or_create_service(self._service_id, self._data)
+
+    def undo(self, api):
+        api.delete_service(
+            self._service_id
+        )
+
+    def get_details(self):
+        return "Add Service %s" % self._service_id
+
+    def dependency_keys(self):
+        return ("service:" + self._service_id,)
+
+class CreatePlugin(Change):
+    """Change to create a plugin."""
+    __slots__ = ('_plugin_id', '_data')
+    _fields = ('plugin_id', 'data')
+
+    def __init__(self,
+            plugin_id, # type str
+            data #type Dict
+            ):
+        self._plugin_id = plugin_id
+        self._data = data
+
+    def execute(self, api):
+        api.update_or_create_plugin(self._plugin_id, self._data)
+
+    def undo(self, api):
+        api.delete_plugin(
+            self._plugin_id
+        )
+
+    def get_details(self):
+        return "Add Plugin %s" % self._plugin_id
+
+    def dependency_keys(self):
+        return _service_dependency_keys("plugin:" + self._plugin_id,
+            self._data)
+
+
+class CreateRoute(Change):
+    """Change to create a route."""
+    __slots__ = ('_route_id', '_data')
+    _fields = ('route_id', 'data')
+
+    def __init__(self,
+            route_id, # type str
+            data #type Dict
+            ):
+        self._route_id = route_id
+        self._data = data
+
+    def execute(self, api):
+        api.update_or_create_route(self._route_id, self._data)
+
+    def undo(self, api):
+        api.delete_route(
+            self._route_id
+        )
+
+    def get_details(self):
+        return "Add Route %s" % self._route_id
+
+    def dependency_keys(self):
+        return _service_dependency_keys("route:" + self._route_id,
+            self._data)
+
+
+def _has_certificate(api, certificate_id, certificate_data):
+    """ helper function to check that kong has the certificate """
+    cert = api.get_certificate(certificate_id)
+    return cert is not None and cert.get('cert') == certificate_data.cert
+
+
+def _has_sni(api, sni, cert_id):
+    """ helper function to check that kong has the sni with the certificate
+    """
+    entity = api.get_sni(sni)
+    return (entity is not None and
+        (entity.get('certificate') or {}).get('id') == cert_id)
+
+
+def _service_dependency_keys(key, data):
+    """ helper function to get the keys of an entity and its service """
+    service = data.get('service') or {}
+    if service.get('id'):
+        return (key, "service:" + service['id'])
+    return (key,)
+
+class ParallelChanges(Change):
+    """Changes which are independent of each other and are applied
+    concurrently.
+    If any of the changes fail, the changes which were applied are undone
+    before the error is raised.
+    """
+    __slots__ = ('_changes', '_processes')
+
+    def __init__(self,
+            changes, # type: List[Change]
+            processes=8 # type: int
+            ):
+        self._changes = changes
+        self._processes = processes
+
+    @property
+    def changes(self):
+        """ get the changes """
+        return self._changes
+
+    def to_record(self):
+        return {
+            "type": type(self).__name__,
+            "changes": [c.to_record() for c in self._changes],
+            "processes": self._processes
+        }
+
+    @classmethod
+    def _from_record(cls, record, store):
+        return cls([Change.from_record(r, store) for r in record["changes"]],
+            record.get("processes", 8))
+
+    def _run(self, func, changes):
+        pool = ThreadPool(max(min(len(changes), self._processes), 1))
+        try:
+            return pool.map(func, changes)
+        finally:
+            pool.close()
+
+    def execute(self, api):
+        def execute_change(change):
+            try:
+                change.execute(api)
+                return None
+            except Exception as e: # pylint: disable=broad-except
+                return e
+
+        errors = self._run(execute_change, self._changes)
+        failed = [e for e in errors if e is not None]
+        if failed:
+            # the circuit breaker may have opened on the failures
+            api.reset_circuit()
+            self._undo([c for c, e in zip(self._changes, errors) if e is None],
+                api)
+            raise failed[0]
+
+    def undo(self, api):
+        self._undo(self._changes, api)
+
+    def _undo(self, changes, api):
+        def undo_change(change):
+            try:
+                change.undo(api)
+                return None
+            except Exception as e: # pylint: disable=broad-except
+                return e
+
+        failed = [e for e in self._run(undo_change, changes) if e is not None]
+        if failed:
+            raise failed[0]
+
+    def get_details(self):
+        return "\n".join(c.get_details() for c in self._changes)
+
+    def lock_keys(self):
+        keys = []
+        for c in self._changes:
+            keys.extend(c.lock_keys())
+        return keys
+
+    def dependency_keys(self):
+        keys = []
+        for c in self._changes:
+            keys.extend(c.dependency_keys())
+        return keys
+
+    def verify(self, api):
+        return all(c.verify(api) for c in self._changes)
+
+_change_types = dict((cls.__name__, cls) for cls in (
+    AddCertificate, DeleteCertificate, UpdateCertificate,
+    UpdateRouteProtocols, UpdateSniCertificate, UpdateRedirectPlugin,
+    CreateSni,
+    CreateService, CreatePlugin, CreateRoute, ParallelChanges
+)) #type: Dict[str, type]
+
+class CertificateData(object):
+    """ certificate data """
+    __slots__ = ('cert', 'key')
+
+    def __init__(self, cert, key):
+        self.cert = cert
+        self.key = key
+
+class CertificateStore(object):
+    """ Certificate data referenced by changes, keyed by fingerprint.
+    A certificate is stored once however many changes reference it.
+    """
+
+    def __init__(self):
+        self._data = {} #type: Dict[str, CertificateData]
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """ remove every certificate """
+        self._data.clear()
+
+    def __contains__(self, ref):
+        return ref in self._data
+
+    def add(self, cert, key, ref=None):
+        """ store a certificate
+        :returns: reference to the certificate
+        """
+        if ref is None:
+            ref = pem_cache.fingerprint(cert, key)
+        if ref not in self._data:
+            self._data[ref] = CertificateData(cert, key)
+        return ref
+
+    def get(self, ref):
+        """ get the certificate data
+        :rtype: CertificateData
+        """
+        return self._data[ref]
+
+    def to_record(self):
+        """ get the serialized record of the store """
+        return dict((ref, {"cert": d.cert, "key": d.key})
+            for ref, d in self._data.items())
+
+    @classmethod
+    def from_record(cls, record):
+        """ create a store from its serialized record """
+        store = cls()
+        for ref, d in record.items():
+            store.add(d["cert"], d["key"], ref)
+        return store
+
+    def __getstate__(self):
+        return self.to_record()
+
+    def __setstate__(self, state):
+        self._data = {}
+        for ref, d in state.items():
+            self.add(d["cert"], d["key"], ref)
@@ -0,0 +1,76 @@
+""" Module to stop sending requests to an unhealthy Kong Admin API """
+import threading
+import time
+
+
+def _now():
+    return getattr(time, 'monotonic', time.time)()
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker for the requests to an admin API.
+
+    The circuit opens after `threshold` consecutive failures (timeouts,
+    connection errors and 5xx responses, other than 503 with a Retry-After
+    header which only asks for requests to be slowed down). While it is open requests are
+    refused, so the remaining requests of a batch fail fast. Once
+    `reset_timeout` seconds have passed requests are allowed again, the
+    circuit closes on the first success and opens again on the next
+    failure. A threshold of None (or 0) never opens the circuit.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=_now):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        # a restored api starts with a closed circuit
+        self.reset()
+
+    @property
+    def is_open(self):
+        """ check if requests are currently refused """
+        with self._lock:
+            return (self._opened_at is not None and
+                self._clock() - self._opened_at < self.reset_timeout)
+
+    @property
+    def failures(self):
+        """ get the number of consecutive failures """
+        return self._failures
+
+    def allow(self):
+        """ check if a request may be sent """
+        return not self.is_open
+
+    def record_success(self):
+        """ record a request which succeeded, closing the circuit """
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        """ record a request which failed, opening the circuit once
+        threshold consecutive requests have failed
+        """
+        with self._lock:
+            self._failures += 1
+            if self.threshold and self._failures >= self.threshold:
+                self._opened_at = self._clock()
+
+    def reset(self):
+        """ close the circuit, i.e. before undoing changes """
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
@@ -1,24 +1,54 @@
 """Kong Configurator Certbot plugins.
+
+Certbot imports every installed plugin on every invocation, so only what is
+needed to register the plugin and its options is imported here. The admin
+API client (and requests), the change invoker, pickle and the challenge
+support are imported when they are first used.
 """
+import argparse
+import contextlib
+import functools
 import logging
-import pickle
 
 import zope.interface
 
-from acme import challenges
-
 from certbot import errors
 from certbot import interfaces
 from certbot.compat import os
 from certbot.plugins import common
 
-from certbot_kong.kong_admin_api import KongAdminApi
-from certbot_kong.change_invoker import KongChangeInvoker
+from certbot_kong.domain_resolver import is_wildcard_domain
+from certbot_kong.domain_resolver import matches_wildcard
+from certbot_kong.pem_cache import PemCache
 from certbot_kong import constants
-from certbot_kong import http_01
+from certbot_kong import profiler
 
 logger = logging.getLogger(__name__)
 
+_true_values = ("true", "yes", "on", "1")
+_false_values = ("false", "no", "off", "0")
+
+
+def _bool(value):
+    """ parse the value of a boolean option, i.e. --kong-resume false """
+    if value.lower() in _true_values:
+        return True
+    if value.lower() in _false_values:
+        return False
+    raise argparse.ArgumentTypeError(
+        "expected one of {}, got {!r}".format(
+            ", ".join(_true_values + _false_values), value))
+
+
+def _profiled(func):
+    """ decorator to profile a plugin operation (see --kong-profile) """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profiler.active().operation(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
 @zope.interface.implementer(interfaces.IAuthenticator, interfaces.IInstaller)
 @zope.interface.provider(interfaces.IPluginFactory)
 class KongConfigurator(common.Installer):
@@ -37,15 +67,103 @@ class KongConfigurator(common.Installer):
     @classmethod
     def add_parser_arguments(cls, add):
         add("admin-url", default=constants.CLI_DEFAULTS["admin_url"],
-            help="kong admin URL.")
-        add("delete-unused-certificates", default=True,
+            help="kong admin URL. unix:///path/to/admin.sock URLs send "
+            "requests to an admin API listening on a Unix domain socket. "
+            "Comma separated URLs of several admin API nodes spread reads "
+            "over the nodes, send writes to one node and fail over to the "
+            "next node on errors.")
+        add("tags", default=None,
+            help="Comma separated kong tags. Only routes and certificates "
+            "with all of the tags are managed and every entity created is "
+            "tagged with them")
+        add("workspaces", default=None,
+            help="Comma separated Kong Enterprise workspaces. Certificates "
+            "are deployed (and routes redirected) in every workspace which "
+            "uses the domain, with the workspaces changed concurrently")
+        add("delete-unused-certificates", default=True, type=_bool,
             help="Delete certificates when it no longer references any SNIs")
-        add("redirect-route-no-host", default=True,
+        add("reap-unused-certificates", default=False, type=_bool,
+            help="Delete every certificate which does not reference any SNIs "
+            "when the configuration is saved")
+        add("redirect-route-no-host", default=True, type=_bool,
             help="Include redirect HTTP to HTTPS for routes which do not "
             "specify any hosts")
-        add("redirect-route-any-host", default=True,
+        add("redirect-route-any-host", default=True, type=_bool,
             help="Include redirect HTTP to HTTPS for routes which has at "
             "least one host which matches the domain")
+        add("redirect-strategy", default="protocols",
+            choices=["protocols", "plugin"],
+            help="How HTTP is redirected to HTTPS. 'protocols' removes http "
+            "from the protocols of each route. 'plugin' redirects the hosts "
+            "of every route with a single global pre-function plugin, "
+            "routes without hosts still have their protocols changed")
+        add("defer-save", default=False, type=_bool,
+            help="Queue changes from permanent saves and apply them with a "
+            "single apply, checkpoint and reload when the installer is "
+            "restarted")
+        add("admin-rate-limit", default=None, type=float,
+            help="Maximum number of kong admin API requests per second. "
+            "Unlimited when not set")
+        add("admin-rate-burst", default=10, type=int,
+            help="Number of kong admin API requests which may be sent in a "
+            "burst before admin-rate-limit applies")
+        add("admin-max-retries", default=5, type=int,
+            help="Number of times a kong admin API request rejected with "
+            "429 Too Many Requests (or 503 with a Retry-After header) "
+            "is retried")
+        add("admin-timeout", default=60, type=float,
+            help="Seconds to wait for the kong admin API to accept a "
+            "connection or to send a response")
+        add("admin-circuit-threshold", default=5, type=int,
+            help="Number of consecutive failed kong admin API requests "
+            "(timeouts, connection errors and 5xx responses other than 503 "
+            "with a Retry-After header) after which "
+            "the remaining changes fail fast and the applied changes are "
+            "undone. 0 never stops sending requests")
+        add("admin-circuit-reset", default=30, type=float,
+            help="Seconds after which kong admin API requests are sent "
+            "again once admin-circuit-threshold requests have failed")
+        add("challenge-route", default="per-domain",
+            choices=["per-domain", "consolidated"],
+            help="How http-01 challenges are routed. 'per-domain' creates a "
+            "service, route and plugin for each domain. 'consolidated' "
+            "creates one service, with one route for every challenge host "
+            "and one pre-function plugin which responds by token path")
+        add("sweep-challenge-services", default=False, type=_bool,
+            help="Remove http-01 challenge services, and their routes and "
+            "plugins, left behind by failed runs when the plugin is "
+            "prepared")
+        add("sweep-challenge-services-age", default=3600, type=int,
+            help="Minimum age in seconds of the challenge services removed "
+            "by sweep-challenge-services")
+        add("revalidate", default=True, type=_bool,
+            help="Before applying changes, check that the certificates, SNIs "
+            "and routes the changes depend on have not changed in Kong "
+            "since they were loaded, and re-plan the changes if they have")
+        add("resume", default=False, type=_bool,
+            help="Record the changes applied by each save in the certbot "
+            "work directory. When applying the changes fails the applied "
+            "changes are kept rather than undone, and the next run with "
+            "resume set skips the changes which were applied and are "
+            "still in Kong, continuing from the change which failed")
+        add("profile", default=False, type=_bool,
+            help="Profile the run and write a JSON report, splitting the "
+            "time of each plugin operation between admin API requests, "
+            "JSON decoding, pickling and python, to kong_profile.json in "
+            "the certbot work directory")
+        add("lease", default="none", choices=["none", "kong", "file"],
+            help="Lease the SNIs and routes changed by a run so concurrent "
+            "runs against the same Kong cluster only wait on each other "
+            "when they change the same entities. 'kong' stores leases as "
+            "Kong consumers, 'file' stores leases in lease-dir")
+        add("lease-dir", default=None,
+            help="Directory for 'file' leases. Defaults to a directory in "
+            "the certbot work directory")
+        add("lease-ttl", default=300, type=int,
+            help="Seconds after which a lease left by a crashed run can be "
+            "taken over")
+        add("lease-timeout", default=600, type=int,
+            help="Seconds to wait for a lease held by another run")
 
     def __init__(self, *args, **kwargs):
         # TODO add enable redirect enhancement.
@@ -62,15 +180,104 @@ class KongConfigurator(common.Installer):
 
         self._api = None
         self._invoker = None
+        self._pem_cache = PemCache()
+        self._resolver = None
+        self._resolver_names = None
+
+        # Deferred save state. Permanent saves requested while saving is
+        # deferred are recorded here and applied by finalize_save()
+        self._defer_depth = 0
+        self._save_deferred = False
+        self._deferred_title = None
 
     def prepare(self):
         """Prepare the authenticator/installer.
         """
+        if self.conf('profile'):
+            profiler.start(os.path.join(self.config.work_dir,
+                "kong_profile.json"))
+        with profiler.active().operation("prepare"):
+            self._prepare()
 
-        self._api = KongAdminApi(
-            url=self.conf('admin-url'))
+    def _prepare(self):
+        from certbot_kong.kong_admin_api import KongAdminApi
 
-        self._invoker = KongChangeInvoker(self._api)
+        self._api = KongAdminApi(
+            url=self.conf('admin-url'),
+            rate_limit=self.conf('admin-rate-limit'),
+            burst=self.conf('admin-rate-burst'),
+            max_retries=self.conf('admin-max-retries'),
+            tags=self._get_tags(),
+            timeout=self.conf('admin-timeout'),
+            circuit_threshold=self.conf('admin-circuit-threshold'),
+            circuit_reset=self.conf('admin-circuit-reset'))
+
+        if self.conf('sweep-challenge-services'):
+            self.sweep_challenge_services()
+
+        self._invoker = self._create_invoker()
+
+    def _create_invoker(self):
+        kwargs = {
+            "lease_manager": self._get_lease_manager(),
+            "revalidate": self.conf('revalidate'),
+            "progress": self._get_progress()
+        }
+        workspaces = self._get_workspaces()
+        if workspaces:
+            from certbot_kong.workspace_invoker import WorkspaceChangeInvoker
+            return WorkspaceChangeInvoker(self._api, workspaces, **kwargs)
+
+        from certbot_kong.change_invoker import KongChangeInvoker
+        return KongChangeInvoker(self._api, **kwargs)
+
+    def _get_progress(self):
+        if not self.conf('resume'):
+            return None
+        from certbot_kong.progress import ChangeProgress
+        return ChangeProgress(os.path.join(self.config.work_dir,
+            "kong_progress"))
+
+    def sweep_challenge_services(self):
+        """Remove challenge services left behind by failed runs.
+        :returns: report of the removed entities
+        :rtype: :class:`~certbot_kong.challenge_sweeper.SweepReport`
+        """
+        from certbot_kong.challenge_sweeper import ChallengeSweeper
+
+        apis = ([self._api.for_workspace(w) for w in self._get_workspaces()]
+            or [self._api])
+        report = None
+        for api in apis:
+            sweeper = ChallengeSweeper(api,
+                min_age=self.conf('sweep-challenge-services-age'))
+            report = sweeper.sweep().merge(report)
+        return report
+
+    def _get_tags(self):
+        tags = self.conf('tags') or ""
+        return [t.strip() for t in tags.split(",") if t.strip()]
+
+    def _get_workspaces(self):
+        workspaces = self.conf('workspaces') or ""
+        return [w.strip() for w in workspaces.split(",") if w.strip()]
+
+    def _get_lease_manager(self):
+        from certbot_kong.lease import FileLeaseManager
+        from certbot_kong.lease import KongLeaseManager
+
+        lease = self.conf('lease')
+        kwargs = {
+            "ttl": self.conf('lease-ttl'),
+            "timeout": self.conf('lease-timeout')
+        }
+        if lease == "kong":
+            return KongLeaseManager(self._api, **kwargs)
+        if lease == "file":
+            directory = (self.conf('lease-dir') or
+                os.path.join(self.config.work_dir, "kong_leases"))
+            return FileLeaseManager(directory, **kwargs)
+        return None
 
     def _enable_redirect(self, domain, unused_options):
         """Redirect HTTP traffic to HTTPS for routes matching domain.
@@ -80,6 +287,7 @@ class KongConfigurator(common.Installer):
         :type unused_options: Not Available
         """
 
+        routes = []
         for route in self._invoker.routes:
             hosts = route.get('hosts', [])
             protocols = route.get('protocols', [])
@@ -89,14 +297,14 @@ class KongConfigurator(common.Installer):
                 continue
 
             if hosts:
-                if self._is_wildcard_domain(domain):
-                    matched_hosts = self._determine_matched_domains(
-                        domain, hosts)
+                if is_wildcard_domain(domain):
+                    matched_hosts = [h for h in hosts
+                        if matches_wildcard(h, domain)]
 
                     if matched_hosts:
                         if(len(matched_hosts) == len(hosts) or
                                 self.conf('redirect-route-any-host')):
-                            self._invoker.redirect_route(route['id'])
+                            routes.append(route)
                 else:
                     if(
                         (len(hosts) == 1 and domain == hosts[0]) or
@@ -105,11 +313,26 @@ class KongConfigurator(common.Installer):
                             domain in hosts
                         )
                     ):
-                        self._invoker.redirect_route(route['id'])
+                        routes.append(route)
             else:
                 if self.conf('redirect-route-no-host'):
-                    self._invoker.redirect_route(route['id'])
+                    routes.append(route)
 
+        if self.conf('redirect-strategy') == "plugin":
+            hosts = set()
+            for route in routes:
+                hosts.update(route.get('hosts') or [])
+            if hosts:
+                from certbot_kong.change_invoker import KongChangeInvokerError
+                try:
+                    self._invoker.redirect_hosts(hosts)
+                except KongChangeInvokerError as e:
+                    raise errors.PluginError(str(e))
+            # routes without hosts cannot be matched by the plugin
+            routes = [r for r in routes if not r.get('hosts')]
+
+        for route in routes:
+            self._invoker.redirect_route(route['id'])
 
         self.save()
 
@@ -118,20 +341,16 @@ class KongConfigurator(common.Installer):
         :returns: all the hosts from all the routes and all the snis from certificates
         :rtype: set
         """
-        all_names = set()  # type: Set[str]
-
-        for c in self._invoker.certs:
-            snis = c.get('snis', [])
-            for sni in snis:
-                all_names.add(sni)
-
-        for r in self._invoker.routes:
-            hosts = r.get('hosts', [])
-            for host in hosts:
-                all_names.add(host)
+        return self._invoker.names.names()
 
-        return all_names
+    def get_names_with_prefix(self, prefix):
+        """Returns the names found in the Kong Configuration starting with
+        prefix.
+        :rtype: list
+        """
+        return self._invoker.names.with_prefix(prefix)
 
+    @_profiled
     def deploy_cert(self, domain,
             cert_path, key_path, chain_path, fullchain_path): # pylint: disable=unused-argument
         """Deploy certificate.
@@ -148,83 +367,46 @@ class KongConfigurator(common.Installer):
                 "The kong plugin requires --fullchain-path to "
                 "install a cert.")
 
-        domains = []
-        if self._is_wildcard_domain(domain):
-            domains = self._determine_domains(domain)
-        else:
-            domains = [domain]
+        domains = self.domain_resolver().resolve(domain)
 
         if not domains:
             logger.info("No route hosts matching %s",
                 domain)
             return
 
+        certificate = self._read_certificate(fullchain_path, key_path)
+        for d in domains:
+            self._set_sni_cert(d, certificate)
+
+    def _read_certificate(self, fullchain_path, key_path):
         try:
-            key_str = None
-            with open(key_path, 'r') as file:
-                key_str = file.read()
-
-            fullchain_str = None
-            with open(fullchain_path, 'r') as file:
-                fullchain_str = file.read()
-        except IOError:
+            return self._pem_cache.read_certificate(fullchain_path, key_path)
+        except (IOError, OSError):
             logger.debug('Encountered error:', exc_info=True)
             raise errors.PluginError('Unable to open cert files.')
 
-        for d in domains:
-            self._invoker.set_sni_cert(d, fullchain_str, key_str,
-                self.conf('delete-unused-certificates'))
-            self.save_notes = "\n".join(self._invoker.get_changes_details())
-
-    def _is_wildcard_domain(self, domain):
-        """ helper method to determine whether a domain is wildcard domain.
-        *.example.com is
-        www.example.com is not
-        www.example.* is not
-        *ww.exmape.com is not
-        """
-        return domain.startswith('*.') and len(domain.split('.')) > 2
-
-    def _determine_domains(self, wildcard_domain):
-        """ helper method to find all route hosts matching a wildcard domain.
-        """
-        domains = set()
-        for r in self._invoker.routes:
-            domains.update(r.get('hosts', []))
-
-        for c in self._invoker.certs:
-            domains.update(c.get('snis', []))
-
-        return self._determine_matched_domains(wildcard_domain,
-            list(domains))
-
-    def _determine_matched_domains(self, wildcard_domain, domains):
-        matched_domains = []
-        for d in domains:
-            if self._matched_domain(d, wildcard_domain):
-                matched_domains.append(d)
-
-        return matched_domains
-
-    def _matched_domain(self,
-            domain, # type: str
-            wildcard_domain # type: str
-            ):
-        """ helper function to determine if the host matches
-        the wildcard domain.
+    def _set_sni_cert(self, name, certificate):
+        fullchain_str, key_str, fingerprint = certificate
+        self._invoker.set_sni_cert(name, fullchain_str, key_str,
+            self.conf('delete-unused-certificates'), fingerprint)
+        self.domain_resolver().add(name)
+        self.save_notes = "\n".join(self._invoker.get_changes_details())
+
+    def domain_resolver(self):
+        """Returns the resolver of domains to the names found in the Kong
+        Configuration. The resolver is rebuilt when the configuration is
+        reloaded.
+        :rtype: :class:`~certbot_kong.domain_resolver.DomainResolver`
         """
+        from certbot_kong.domain_resolver import DomainResolver
 
-        # split and remove the subdomain
-        domain_components = domain.split('.')[1:]
-        if not domain_components:
-            return False
-
-        # split and remove the "*" segment
-        wildcard_domain_components = wildcard_domain.split('.')[1:]
-
-        # can now compare for a match
-        return domain_components == wildcard_domain_components
+        names = self._invoker.names
+        if self._resolver is None or self._resolver_names is not names:
+            self._resolver = DomainResolver(names)
+            self._resolver_names = names
+        return self._resolver
 
+    @_profiled
     def enhance(self, domain, enhancement, options=None):
         """Perform a configuration enhancement.
         :param str domain: domain for which to provide enhancement
@@ -254,6 +436,7 @@ class KongConfigurator(common.Installer):
         """
         return self._enhance_func.keys()
 
+    @_profiled
     def save(self, title=None, temporary=False):
         """Saves all changes to the configuration files.
         Both title and temporary are needed because a save may be
@@ -269,9 +452,23 @@ class KongConfigurator(common.Installer):
             be quickly reversed in the future (challenges)
         :raises .PluginError: when save is unsuccessful
         """
+        if not temporary and self._is_save_deferred():
+            # Leave the changes queued, they are applied by finalize_save()
+            self.save_notes = "\n".join(self._invoker.get_changes_details())
+            self._save_deferred = True
+            if title:
+                self._deferred_title = title
+            return
+
+        self._save(title, temporary)
+
+    def _save(self, title=None, temporary=False):
         try:
+            if not temporary and self.conf('reap-unused-certificates'):
+                self._invoker.reap_unused_certs()
             self.save_notes = "\n".join(self._invoker.get_changes_details())
-            self._invoker.apply_changes()
+            # challenges are temporary, they are undone rather than resumed
+            self._invoker.apply_changes(resumable=not temporary)
             conf_dump_filename = self._get_conf_dump_filename()
             self._dump_config(conf_dump_filename)
             self.add_to_checkpoint([conf_dump_filename], self.save_notes, temporary)
@@ -286,6 +483,38 @@ class KongConfigurator(common.Installer):
             raise errors.PluginError("Unable to apply changes")
 
 
+    def _is_save_deferred(self):
+        return self._defer_depth > 0 or self.conf('defer-save')
+
+    @contextlib.contextmanager
+    def deferred_save(self):
+        """Context manager which defers permanent saves.
+        Saves made within the scope only queue the changes. The queued
+        changes are applied with a single apply, checkpoint and reload when
+        the outermost scope exits without an error, or before challenges are
+        performed.
+        """
+        self._defer_depth += 1
+        try:
+            yield self
+        finally:
+            self._defer_depth -= 1
+
+        if self._defer_depth == 0 and not self.conf('defer-save'):
+            self.finalize_save()
+
+    def finalize_save(self):
+        """Apply the changes queued by deferred saves.
+        :raises .PluginError: when save is unsuccessful
+        """
+        if not self._save_deferred:
+            return
+
+        title = self._deferred_title
+        self._save_deferred = False
+        self._deferred_title = None
+        self._save(title)
+
     def _get_conf_dump_filename(self):
         return os.path.join(self.config.work_dir, "kong_conf")
 
@@ -305,6 +534,8 @@ class KongConfigurator(common.Installer):
         self._invoker.undo_changes()
         self._invoker.clear_changes()
         self.save_notes = ""
+        self._save_deferred = False
+        self._deferred_title = None
         self._invoker.load_config()
 
     def recovery_routine(self):  # type: ignore
@@ -321,6 +552,8 @@ class KongConfigurator(common.Installer):
         self._invoker.undo_changes()
         self._invoker.clear_changes()
         self.save_notes = ""
+        self._save_deferred = False
+        self._deferred_title = None
         self._invoker.load_config()
 
     def revert_temporary_config(self):
@@ -332,33 +565,48 @@ class KongConfigurator(common.Installer):
         self._invoker.undo_changes()
         self._invoker.clear_changes()
         self.save_notes = ""
+        self._save_deferred = False
+        self._deferred_title = None
         self._invoker.load_config()
 
     def config_test(self):
         """Not required for Kong. Config is always valid"""
 
     def restart(self):
-        """Not required for Kong. No restart required to apply configurations"""
+        """No restart required to apply configurations in Kong.
+        Changes queued by deferred saves are applied.
+        """
+        self.finalize_save()
 
     def _dump_config(self, filename):
-        with open(filename, 'wb') as f:
+        import pickle
+        with open(filename, 'wb') as f, profiler.active().measure("pickle"):
             pickle.dump(self._invoker, f, pickle.HIGHEST_PROTOCOL)
 
     def _load_config(self, filename):
-        with open(filename, 'rb') as f:
+        import pickle
+        with open(filename, 'rb') as f, profiler.active().measure("pickle"):
             self._invoker = pickle.load(f)
 
     ### Authenticator
     def get_chall_pref(self, unused_domain):  # pylint: disable=no-self-use
         """Return list of challenge preferences."""
+        from acme import challenges
         return [challenges.HTTP01]
 
+    @_profiled
     def perform(self, achalls):
         """Perform the configuration related challenge.
         This function currently assumes all challenges will be fulfilled.
         If this turns out not to be the case in the future. Cleanup and
         outstanding challenges will have to be designed better.
         """
+        from certbot_kong import http_01
+
+        # the changes of deferred saves share the queue with the challenges,
+        # apply them first so they are not saved (and reverted) as temporary
+        self.finalize_save()
+
         self._chall_out += len(achalls)
         responses = [None] * len(achalls)
         http_doer = http_01.KongHttp01(self)
@@ -380,6 +628,7 @@ class KongConfigurator(common.Installer):
         return responses
 
     # called after challenges are performed
+    @_profiled
     def cleanup(self, achalls):
         """Revert all challenges."""
         self._chall_out -= len(achalls)
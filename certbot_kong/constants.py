@@ -8,3 +8,9 @@ CLI_DEFAULTS = dict(
     admin_url="http://localhost:8001",
 )
 """CLI defaults."""
+
+CHALLENGE_SERVICE_NAME = "certbot-kong_TEMPORARY_ACME_challenge"
+"""Name of the temporary services created for http-01 challenges."""
+
+MAX_NAMES_PER_CERTIFICATE = 100
+"""Maximum number of names in one certificate (Let's Encrypt's limit)."""
@@ -0,0 +1,68 @@
+""" Module to resolve the domains of certbot lineages to Kong names """
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def is_wildcard_domain(domain):
+    """ Check if a domain is a wildcard domain.
+    *.example.com is
+    www.example.com is not
+    www.example.* is not
+    *ww.example.com is not
+    """
+    return domain.startswith('*.') and len(domain.split('.')) > 2
+
+
+def is_wildcard_host(host):
+    """ Check if a Kong route host is a wildcard host, i.e. *.example.com
+    or example.*, which cannot be validated with http-01 challenges
+    """
+    return "*" in host
+
+
+def parent_domain(name):
+    """ Get the domain one level above a name, i.e. example.com for
+    www.example.com, or None when the name has no parent
+    """
+    parts = name.split('.', 1)
+    if len(parts) == 2 and parts[1]:
+        return parts[1]
+    return None
+
+
+def matches_wildcard(name, wildcard_domain):
+    """ Check if a name is one level below a wildcard domain, i.e.
+    www.example.com matches *.example.com
+    """
+    return parent_domain(name) == wildcard_domain[2:]
+
+
+class DomainResolver(object):
+    """ Resolve domains to the names (route hosts and SNIs) in Kong.
+
+    Names are indexed by their parent domain once, so a wildcard domain is
+    resolved with a single lookup rather than a scan of every name. Names
+    deployed during the run are added to the index as they are deployed.
+    """
+
+    def __init__(self, names=()):
+        self._parents = collections.defaultdict(set) #type: Dict[str, Set[str]]
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """ Index a name """
+        parent = parent_domain(name)
+        if parent:
+            self._parents[parent].add(name)
+
+    def resolve(self, domain):
+        """ Get the names a domain resolves to, in sorted order.
+        A wildcard domain resolves to the names one level below it, any
+        other domain resolves to itself.
+        """
+        if not is_wildcard_domain(domain):
+            return [domain]
+        return sorted(self._parents.get(domain[2:], ()))
@@ -32,12 +32,16 @@ class KongHttp01(common.ChallengePerformer):
 
         responses = [x.response(x.account_key) for x in self.achalls]
 
-        for achall in self.achalls:
-            self.configurator.invoker.create_http01_challenge_service(
-                achall.domain,
-                achall.validation(achall.account_key),
-                self._get_validation_path(achall)
-            )
+        challenges = [(achall.domain,
+            achall.validation(achall.account_key),
+            self._get_validation_path(achall)) for achall in self.achalls]
+        if self.configurator.conf('challenge-route') == "consolidated":
+            # one service, route and plugin for every domain
+            self.configurator.invoker.create_http01_challenge_route(challenges)
+        else:
+            for challenge in challenges:
+                self.configurator.invoker.create_http01_challenge_service(
+                    *challenge)
 
         # Save reversible changes
         self.configurator.save("HTTP Challenge", True)
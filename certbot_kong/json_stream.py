@@ -0,0 +1,77 @@
+""" Module to stream JSON request bodies holding certificate material """
+import collections
+import json
+import threading
+
+_cache_size = 256
+_inline_limit = 512
+
+
+class EncodedStrings(object):
+    """ Bounded cache of strings encoded as JSON (UTF-8) bytes.
+    The same PEM chain and key uploaded by several changes, or to several
+    Kong clusters, are encoded once.
+    """
+
+    def __init__(self, size=_cache_size):
+        self._size = size
+        self._encoded = collections.OrderedDict() #type: Dict[str, bytes]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._encoded)
+
+    def encode(self, value):
+        """ Get the JSON encoding of a string as bytes """
+        with self._lock:
+            encoded = self._encoded.pop(value, None)
+            if encoded is None:
+                encoded = json.dumps(value).encode('utf-8')
+                if len(self._encoded) >= self._size:
+                    self._encoded.popitem(last=False)
+            self._encoded[value] = encoded
+        return encoded
+
+
+encoded_strings = EncodedStrings()
+
+
+class JsonBody(object):
+    """ JSON object request body sent as a sequence of byte chunks.
+
+    Small members are coalesced into a single chunk while large string
+    values (i.e. PEM chains and keys) are sent as their cached encoding, so
+    the body is never joined in memory. The body has a length so it is sent
+    with a Content-Length rather than chunked, and can be iterated again
+    when a request is retried.
+    """
+
+    def __init__(self, data, strings=None):
+        if strings is None:
+            strings = encoded_strings
+        self._chunks = self._encode(data, strings)
+        self._length = sum(len(c) for c in self._chunks)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    @staticmethod
+    def _encode(data, strings):
+        chunks = []
+        pending = [b'{']
+        for i, (name, value) in enumerate(sorted(data.items())):
+            if i:
+                pending.append(b',')
+            pending.append(json.dumps(name).encode('utf-8') + b':')
+            if isinstance(value, str) and len(value) >= _inline_limit:
+                chunks.append(b''.join(pending))
+                chunks.append(strings.encode(value))
+                pending = []
+            else:
+                pending.append(json.dumps(value).encode('utf-8'))
+        pending.append(b'}')
+        chunks.append(b''.join(pending))
+        return tuple(chunks)
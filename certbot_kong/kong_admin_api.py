@@ -1,43 +1,393 @@
 """ Module wrapping Kong Admin API REST operations """
+import copy
+import email.utils
 import logging
+import threading
+import time
+
 import requests
+from urllib3.exceptions import NewConnectionError
+
+from certbot_kong import profiler
+from certbot_kong.node_pool import NodePool
+from certbot_kong import unix_socket
+from certbot_kong.json_stream import JsonBody
+from certbot_kong.request_scheduler import RequestScheduler
+from certbot_kong.request_scheduler import PRIORITY_BULK
+from certbot_kong.request_scheduler import PRIORITY_CHALLENGE
+from certbot_kong.request_scheduler import PRIORITY_DEFAULT
 
 
 _default_kong_admin_url = "http://localhost:8001"
-logging.basicConfig(level=logging.INFO)
+_retry_status_codes = (429, 503)
+_max_retry_delay = 60
+_default_timeout = 60
+_json_headers = {"Content-Type": "application/json"}
 logger = logging.getLogger(__name__)
 
+try:
+    import brotli # pylint: disable=unused-import
+    _accept_encoding = "br, gzip, deflate"
+except ImportError: # pragma: no cover
+    _accept_encoding = "gzip, deflate"
+
 
 class ApiError(Exception):
     """Exception for api errors"""
 
+class CircuitOpenError(ApiError):
+    """Exception when requests are refused as the admin API is unhealthy"""
+
 class NotFound(Exception):
     """Exception for api errors"""
 
+class Conflict(ApiError):
+    """Exception when an entity already exists"""
+
+
+class TransferStats(object):
+    """ Bytes received from the admin API, as sent on the wire (i.e.
+    compressed) and once decoded.
+    """
+
+    def __init__(self):
+        self.responses = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def saved_bytes(self):
+        """ bytes saved by compression """
+        return self.decoded_bytes - self.wire_bytes
+
+    def add(self, response):
+        """ count the bytes of a response which has been read """
+        decoded = len(response.content or b"")
+        tell = getattr(response.raw, 'tell', None)
+        wire = tell() if tell is not None else decoded
+        with self._lock:
+            self.responses += 1
+            self.wire_bytes += wire
+            self.decoded_bytes += decoded
+
+    def __str__(self):
+        return ("{} responses, {} bytes received, {} bytes decoded".format(
+            self.responses, self.wire_bytes, self.decoded_bytes))
+
+
+def _is_backpressure(r):
+    """ check if a response asks for requests to be slowed down (429, or
+    503 with a Retry-After header) rather than reporting a failure
+    """
+    return r.status_code == 429 or (r.status_code == 503 and
+        'Retry-After' in r.headers)
+
+
+def _can_fail_over(method, error):
+    """ check if a failed request can be sent to another node, i.e. it is a
+    read or it was never sent as the node could not be connected to. A write
+    which failed once it was sent (i.e. the connection was aborted) may have
+    been applied, so it is not sent again.
+    """
+    if method == "GET" or isinstance(error,
+            requests.exceptions.ConnectTimeout):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, 'reason', None), NewConnectionError)
 
-class KongAdminApi():
-    """ Kong Admin API wrapper """
 
-    def __init__(self, url=_default_kong_admin_url):
-        self.url = url
+class KongAdminApi():
+    """ Kong Admin API wrapper
+    The url is either an http(s) url or a unix:///path/to/admin.sock url of
+    an admin API listening on a Unix domain socket.
+    When a (Kong Enterprise) workspace is set the requests are sent to the
+    entities of the workspace.
+    Requests time out after `timeout` seconds without a response, and once
+    `circuit_threshold` consecutive requests have failed further requests
+    are refused with CircuitOpenError for `circuit_reset` seconds.
+    The url can also be a comma separated list (or a list) of the urls of
+    several admin API nodes of a cluster, see
+    :class:`~certbot_kong.node_pool.NodePool`. Requests which could not be
+    sent to a node are sent to the next node, as are reads which timed out.
+    """
+
+    def __init__(self, url=_default_kong_admin_url,
+            rate_limit=None, burst=1, max_retries=5, tags=None,
+            workspace=None, timeout=_default_timeout, circuit_threshold=5,
+            circuit_reset=30):
+        self._pool = NodePool(url, circuit_threshold, circuit_reset)
+        self.url = self._pool.urls[0]
+        self.tags = list(tags or [])
+        self.workspace = workspace
+        self.timeout = timeout
+        self._scheduler = RequestScheduler(rate_limit, burst)
+        self._max_retries = max_retries
+        self.transfer_stats = TransferStats()
+        self._sessions = self._create_sessions()
+
+    @property
+    def urls(self):
+        """ get the urls of the admin API nodes """
+        return self._pool.urls
+
+    def _create_sessions(self):
+        """ helper function to create a (base url, session) per node """
+        return dict((u, self._create_session(u)) for u in self._pool.urls)
+
+    @staticmethod
+    def _create_session(url):
+        session = requests.Session()
+        session.headers['Accept-Encoding'] = _accept_encoding
+        if unix_socket.is_unix_url(url):
+            session.mount(unix_socket.BASE_URL, unix_socket.UnixAdapter(
+                unix_socket.socket_path(url)))
+            return unix_socket.BASE_URL, session
+        return url, session
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_sessions']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sessions = self._create_sessions()
+
+    def for_workspace(self, workspace):
+        """ get an api for the workspace.
+        The api shares the sessions, nodes, scheduler and transfer stats of
+        this api so requests to every workspace are pooled, rate limited and
+        fail fast together.
+        """
+        api = copy.copy(self)
+        api.workspace = workspace
+        return api
+
+    def _path(self, path):
+        """ helper function to prefix the path with the workspace """
+        if not self.workspace:
+            return path
+        prefix = "/" + self.workspace
+        if path == prefix or path.startswith(prefix + "/"):
+            # i.e. next page paths returned by kong
+            return path
+        return prefix + path
+
+    def reset_circuit(self):
+        """ close the circuit breakers, so requests are sent again """
+        self._pool.reset()
+
+    def _unprefixed(self, path):
+        """ helper function to remove the workspace from a path """
+        if self.workspace and path.startswith("/" + self.workspace + "/"):
+            return path[len(self.workspace) + 1:]
+        return path
+
+    def _json(self, r):
+        """ helper function to decode a json response """
+        with profiler.active().measure("json"):
+            return r.json()
+
+    def _request(self, method, path, priority=PRIORITY_DEFAULT, **kwargs):
+        """ Send a request once the scheduler allows it.
+        Requests rejected with 429 (or 503 with a Retry-After header) are
+        retried after the delay requested by Kong, up to max_retries times.
+        """
+        attempt = 0
+        while True:
+            self._scheduler.acquire(priority)
+            r = self._send(method, path, **kwargs)
+            self.transfer_stats.add(r)
+
+            if (r.status_code not in _retry_status_codes or
+                    attempt >= self._max_retries):
+                return r
+
+            delay = self._get_retry_delay(r, attempt)
+            if delay is None:
+                return r
+
+            logger.info("Kong admin API responded %s to %s %s, "
+                "retrying in %.1f seconds",
+                r.status_code, method, path, delay)
+            self._scheduler.defer(delay)
+            attempt += 1
+
+    def _send(self, method, path, **kwargs):
+        """ helper function to send a request to the first node which
+        accepts it. Reads are spread over the nodes and writes are sent to
+        the pinned node (see NodePool).
+        """
+        urls = self._pool.candidates(write=method != "GET")
+        if not urls:
+            raise CircuitOpenError("Kong admin API {} is unavailable, "
+                "{} consecutive requests failed, not sending {} {}"
+                .format(",".join(self.urls), self._pool.failures(), method,
+                    path))
+
+        for i, url in enumerate(urls):
+            base_url, session = self._sessions[url]
+            try:
+                with profiler.active().request(method,
+                        self._unprefixed(path)):
+                    r = session.request(method, base_url + self._path(path),
+                        timeout=self.timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._pool.record_failure(url)
+                if i + 1 == len(urls) or not _can_fail_over(method, e):
+                    raise
+                logger.info("Kong admin API %s failed %s %s (%s), "
+                    "sending it to %s", url, method, path, e, urls[i + 1])
+                continue
+            if _is_backpressure(r):
+                # the node is up, the request is retried after the delay
+                # it asked for (see _request)
+                pass
+            elif r.status_code >= 500:
+                self._pool.record_failure(url)
+            else:
+                self._pool.record_success(url)
+            return r
+
+    def _get_retry_delay(self, r, attempt):
+        """ helper function to determine how long to wait before retrying
+        """
+        retry_after = r.headers.get('Retry-After')
+        if retry_after is None:
+            if r.status_code != 429:
+                return None
+            return min(2 ** attempt, _max_retry_delay)
+
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            date = email.utils.parsedate_tz(retry_after)
+            if date is None:
+                return min(2 ** attempt, _max_retry_delay)
+            delay = email.utils.mktime_tz(date) - time.time()
+
+        return min(max(delay, 0), _max_retry_delay)
 
     def list_routes(self):
         """ list the routes (GET /routes) """
-        r = requests.get(self.url + "/routes")
-        if r.status_code != 200:
-            raise ApiError('Unable to list routes: '
-                'status code: {}, error: {}, request url: {}'
-                .format(r.status_code, r.content, r.request.url))
-        return r.json()['data']
+        return self._list("/routes", "routes")
+
+    def iter_routes(self):
+        """ iterate the routes (GET /routes) page by page, so each page
+        can be processed (and released) before the next one is requested
+        """
+        return self._iter("/routes", "routes")
 
     def list_certificates(self):
         """ list the certificates (GET /certificates) """
-        r = requests.get(self.url + "/certificates")
+        return self._list("/certificates", "certificates")
+
+    def list_snis(self):
+        """ list the snis (GET /snis) """
+        return self._list("/snis", "snis")
+
+    def list_services(self):
+        """ list the services (GET /services) """
+        return self._list("/services", "services")
+
+    def list_service_routes(self, service_id):
+        """ list the routes of a service (GET /services/{service}/routes) """
+        return self._list("/services/"+service_id+"/routes", "routes")
+
+    def list_service_plugins(self, service_id):
+        """ list the plugins of a service (GET /services/{service}/plugins) """
+        return self._list("/services/"+service_id+"/plugins", "plugins")
+
+    def list_global_plugins(self, name):
+        """ list the global plugins named `name`, i.e. those without a
+        route, service or consumer (GET /plugins).
+        Plugins are listed whatever their tags, as kong allows a single
+        global instance of a plugin.
+        """
+        return [p for p in self._list("/plugins", "plugins", tagged=False)
+            if p.get('name') == name and not (p.get('route') or
+                p.get('service') or p.get('consumer'))]
+
+    def _list(self, path, entity_name, tagged=True):
+        """ list all pages of entities.
+        When the api has tags (and tagged is set) only the entities with all
+        of the tags are listed.
+        """
+        return list(self._iter(path, entity_name, tagged))
+
+    def _iter(self, path, entity_name, tagged=True):
+        """ iterate the entities of every page, see _list() """
+        params = ({"tags": ",".join(self.tags)} if self.tags and tagged
+            else None)
+        count = 0
+        while path:
+            r = self._request("GET", path, params=params)
+            if r.status_code != 200:
+                raise ApiError('Unable to list {}: '
+                    'status code: {}, error: {}, request url: {}'
+                    .format(entity_name, r.status_code, r.content,
+                        r.request.url))
+            page = self._json(r)
+            count += len(page['data'])
+            for entity in page['data']:
+                yield entity
+
+            # the next page url includes the query parameters
+            path = page.get('next')
+            params = None
+
+        logger.debug("Listed %d %s, %s", count, entity_name,
+            self.transfer_stats)
+
+    def _tag(self, data):
+        """ helper function to add the api tags to a new entity """
+        if self.tags and data.get('tags') is None:
+            data = dict(data, tags=list(self.tags))
+        return data
+
+    def get_certificate(self, certificate_id):
+        """ get the certificate (GET /certificates/{cert})
+        returns None if the certificate does not exist
+        """
+        return self._get_entity("/certificates/"+certificate_id, "certificate")
+
+    def get_route(self, route_id):
+        """ get the route (GET /routes/{route})
+        returns None if the route does not exist
+        """
+        return self._get_entity("/routes/"+route_id, "route")
+
+    def get_sni(self, sni):
+        """ get the sni (GET /snis/{sni})
+        returns None if the sni does not exist
+        """
+        return self._get_entity("/snis/"+sni, "sni")
+
+    def get_plugin(self, plugin_id):
+        """ get the plugin (GET /plugins/{plugin})
+        returns None if the plugin does not exist
+        """
+        return self._get_entity("/plugins/"+plugin_id, "plugin")
+
+    def _get_entity(self, path, entity_name):
+        r = self._request("GET", path)
+        if r.status_code == 404:
+            return None
         if r.status_code != 200:
-            raise ApiError('Unable to list certificates: '
+            raise ApiError('Unable to get {}: '
                 'status code: {}, error: {}, request url: {}'
-                .format(r.status_code, r.content, r.request.url))
-        return r.json()['data']
+                .format(entity_name, r.status_code, r.content, r.request.url))
+        return self._json(r)
 
     def update_certificate(self, certificate_id, cert, key, snis=None):
         """ update the certificate (PATCH /certificates/{cert}) """
@@ -47,31 +397,34 @@ class KongAdminApi():
                 "snis": snis
             }
         data = {k: v for k, v in data.items() if v is not None}
-        r = requests.patch(self.url+"/certificates/"+certificate_id, json=data)
+        r = self._request("PATCH", "/certificates/"+certificate_id,
+            priority=PRIORITY_BULK, data=JsonBody(data), headers=_json_headers)
 
         if r.status_code != 200:
             raise ApiError('Unable to update certificate: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def update_or_create_certificate(self, certificate_id, cert, key,
-            snis=None
+            snis=None, tags=None
             ):
         """ update or create the certificate (PUT /certificates/{cert}) """
         data = {
                 "cert": cert,
                 "key": key,
-                "snis": snis
+                "snis": snis,
+                "tags": tags
             }
-        data = {k: v for k, v in data.items() if v is not None}
-        r = requests.put(self.url+"/certificates/"+certificate_id, json=data)
+        data = self._tag({k: v for k, v in data.items() if v is not None})
+        r = self._request("PUT", "/certificates/"+certificate_id,
+            priority=PRIORITY_BULK, data=JsonBody(data), headers=_json_headers)
 
         if r.status_code not in [200, 201]:
             raise ApiError('Unable to update or create certificate: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def add_certificate(self, cert, key, snis):
         """ create the certificate (POST /certificates/{cert}) """
@@ -80,18 +433,20 @@ class KongAdminApi():
                 "key": key,
                 "snis": snis
             }
-        data = {k: v for k, v in data.items() if v is not None}
-        r = requests.post(self.url+"/certificates", json=data)
+        data = self._tag({k: v for k, v in data.items() if v is not None})
+        r = self._request("POST", "/certificates",
+            priority=PRIORITY_BULK, data=JsonBody(data), headers=_json_headers)
 
         if r.status_code != 201:
             raise ApiError('Unable to add certificate: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def delete_certificate(self, certificate_id):
         """ delete the certificate (DELETE /certificates/{cert}) """
-        r = requests.delete(self.url+"/certificates/"+certificate_id)
+        r = self._request("DELETE", "/certificates/"+certificate_id,
+            priority=PRIORITY_BULK)
 
         if r.status_code != 204:
             raise ApiError('Unable to delete certificate: '
@@ -104,14 +459,15 @@ class KongAdminApi():
                 "name": sni,
                 "certificate": {"id": certificate_id}
             }
-        data = {k: v for k, v in data.items() if v is not None}
-        r = requests.post(self.url + "/snis", json=data)
+        data = self._tag({k: v for k, v in data.items() if v is not None})
+        r = self._request("POST", "/snis",
+            priority=PRIORITY_BULK, json=data)
 
         if r.status_code != 201:
             raise ApiError('Unable to add sni: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def update_sni(self, sni, certificate_id):
         """ update the sni (PATCH /snis/{sni}) """
@@ -120,17 +476,19 @@ class KongAdminApi():
                 "certificate": {"id": certificate_id}
             }
         data = {k: v for k, v in data.items() if v is not None}
-        r = requests.patch(self.url+"/snis/"+sni, json=data)
+        r = self._request("PATCH", "/snis/"+sni,
+            priority=PRIORITY_BULK, json=data)
 
         if r.status_code != 200:
             raise ApiError('Unable to update sni: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def delete_sni(self, sni):
         """ delete the sni (DELETE /snis/{sni}) """
-        r = requests.delete(self.url+"/snis/"+sni)
+        r = self._request("DELETE", "/snis/"+sni,
+            priority=PRIORITY_BULK)
 
         if r.status_code != 204:
             raise ApiError('Unable to delete sni: '
@@ -143,28 +501,30 @@ class KongAdminApi():
                 "protocols": protocols
             }
         data = {k: v for k, v in data.items() if v is not None}
-        r = requests.patch(self.url+"/routes/"+route_id, json=data)
+        r = self._request("PATCH", "/routes/"+route_id, json=data)
 
         if r.status_code != 200:
             raise ApiError('Unable to update route: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def update_or_create_plugin(self, plugin_id, data):
         """ update or create the plugin (PUT /plugins/{plugin}) """
-        data = {k: v for k, v in data.items() if v is not None}
-        r = requests.put(self.url+"/plugins/"+plugin_id, json=data)
+        data = self._tag({k: v for k, v in data.items() if v is not None})
+        r = self._request("PUT", "/plugins/"+plugin_id,
+            priority=PRIORITY_CHALLENGE, json=data)
 
         if r.status_code not in [200, 201]:
             raise ApiError('Unable to update or create plugin: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def delete_plugin(self, plugin_id):
         """ delete the plugin (DELETE /plugins/{plugin}) """
-        r = requests.delete(self.url+"/plugins/"+plugin_id)
+        r = self._request("DELETE", "/plugins/"+plugin_id,
+            priority=PRIORITY_CHALLENGE)
 
         if r.status_code != 204:
             raise ApiError('Unable to delete plugin: '
@@ -173,18 +533,20 @@ class KongAdminApi():
 
     def update_or_create_service(self, service_id, data):
         """ update or create the service (PUT /services/{service}) """
-        data = {k: v for k, v in data.items() if v is not None}
-        r = requests.put(self.url+"/services/"+service_id, json=data)
+        data = self._tag({k: v for k, v in data.items() if v is not None})
+        r = self._request("PUT", "/services/"+service_id,
+            priority=PRIORITY_CHALLENGE, json=data)
 
         if r.status_code not in [200, 201]:
             raise ApiError('Unable to update or create service: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def delete_service(self, service_id):
         """ delete the service (DELETE /services/{service}) """
-        r = requests.delete(self.url+"/services/"+service_id)
+        r = self._request("DELETE", "/services/"+service_id,
+            priority=PRIORITY_CHALLENGE)
 
         if r.status_code != 204:
             raise ApiError('Unable to delete service: '
@@ -193,20 +555,71 @@ class KongAdminApi():
 
     def update_or_create_route(self, route_id, data):
         """ update or create the route (PUT /routes/{route}) """
-        data = {k: v for k, v in data.items() if v is not None}
-        r = requests.put(self.url+"/routes/"+route_id, json=data)
+        data = self._tag({k: v for k, v in data.items() if v is not None})
+        r = self._request("PUT", "/routes/"+route_id,
+            priority=PRIORITY_CHALLENGE, json=data)
 
         if r.status_code not in [200, 201]:
             raise ApiError('Unable to update or create route: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
-        return r.json()
+        return self._json(r)
 
     def delete_route(self, route_id):
         """ delete the route (DELETE /routes/{route}) """
-        r = requests.delete(self.url+"/routes/"+route_id)
+        r = self._request("DELETE", "/routes/"+route_id,
+            priority=PRIORITY_CHALLENGE)
 
         if r.status_code != 204:
             raise ApiError('Unable to delete route: '
                 'status code: {}, error: {}, request url: {}'
                 .format(r.status_code, r.content, r.request.url))
+
+    def create_consumer(self, data):
+        """ create the consumer (POST /consumers) """
+        data = {k: v for k, v in data.items() if v is not None}
+        r = self._request("POST", "/consumers", json=data)
+
+        if r.status_code == 409:
+            raise Conflict('Consumer already exists: '
+                'status code: {}, error: {}, request url: {}'
+                .format(r.status_code, r.content, r.request.url))
+        if r.status_code != 201:
+            raise ApiError('Unable to add consumer: '
+                'status code: {}, error: {}, request url: {}'
+                .format(r.status_code, r.content, r.request.url))
+        return self._json(r)
+
+    def get_consumer(self, consumer_id):
+        """ get the consumer (GET /consumers/{consumer}) """
+        r = self._request("GET", "/consumers/"+consumer_id)
+
+        if r.status_code == 404:
+            raise NotFound('Consumer not found: {}'.format(consumer_id))
+        if r.status_code != 200:
+            raise ApiError('Unable to get consumer: '
+                'status code: {}, error: {}, request url: {}'
+                .format(r.status_code, r.content, r.request.url))
+        return self._json(r)
+
+    def update_consumer(self, consumer_id, data):
+        """ update the consumer (PATCH /consumers/{consumer}) """
+        data = {k: v for k, v in data.items() if v is not None}
+        r = self._request("PATCH", "/consumers/"+consumer_id, json=data)
+
+        if r.status_code == 404:
+            raise NotFound('Consumer not found: {}'.format(consumer_id))
+        if r.status_code != 200:
+            raise ApiError('Unable to update consumer: '
+                'status code: {}, error: {}, request url: {}'
+                .format(r.status_code, r.content, r.request.url))
+        return self._json(r)
+
+    def delete_consumer(self, consumer_id):
+        """ delete the consumer (DELETE /consumers/{consumer}) """
+        r = self._request("DELETE", "/consumers/"+consumer_id)
+
+        if r.status_code != 204:
+            raise ApiError('Unable to delete consumer: '
+                'status code: {}, error: {}, request url: {}'
+                .format(r.status_code, r.content, r.request.url))
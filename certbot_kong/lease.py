@@ -0,0 +1,292 @@
+""" Module to lease Kong entities for the duration of a change batch """
+import contextlib
+import hashlib
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+
+from certbot.compat import filesystem
+from certbot.compat import os
+
+from certbot_kong.kong_admin_api import Conflict
+from certbot_kong.kong_admin_api import NotFound
+
+logger = logging.getLogger(__name__)
+
+LEASE_TAG = "certbot-kong-lease"
+_expires_tag_prefix = "expires:"
+
+
+class LeaseError(Exception):
+    """Raised when a lease cannot be acquired"""
+
+
+class LeaseManager(object):
+    """ Acquire leases on lock keys (i.e. SNI names) shared between
+    concurrent certbot-kong runs.
+
+    Keys are acquired in sorted order so runs which need overlapping keys
+    cannot deadlock. Runs with disjoint keys never wait on each other. A
+    lease which is not released (i.e. the run crashed) can be taken over
+    once it is older than `ttl` seconds. Held leases are renewed every
+    `ttl` / 3 seconds, so batches which take longer than `ttl` keep them.
+    """
+
+    def __init__(self, ttl=300, timeout=600, poll_interval=1):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.owner = "{}:{}:{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4())
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        """ Hold leases on all keys for the duration of the context """
+        acquired = [] #type: List[str]
+        stop = threading.Event()
+        # renew while the remaining keys are acquired as well, waiting for
+        # them can take longer than the ttl
+        renewer = threading.Thread(target=self._renew_until,
+            args=(acquired, stop))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            for key in sorted(set(keys)):
+                self._acquire(key)
+                acquired.append(key)
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+            for key in reversed(acquired):
+                try:
+                    self._release(key)
+                except Exception: # pylint: disable=broad-except
+                    logger.warning("Unable to release lease %s", key,
+                        exc_info=True)
+
+    def _acquire(self, key):
+        deadline = time.time() + self.timeout
+        waiting = False
+        while not self._try_acquire(key, time.time() + self.ttl):
+            if time.time() >= deadline:
+                raise LeaseError("Timed out waiting for lease on %s" % key)
+            if not waiting:
+                logger.info("Waiting for lease on %s held by another run", key)
+                waiting = True
+            time.sleep(self.poll_interval)
+
+    def _renew_until(self, keys, stop):
+        """ helper function to renew the leases on keys until stopped """
+        while not stop.wait(self.ttl / 3.0):
+            for key in list(keys):
+                try:
+                    if not self._renew(key, time.time() + self.ttl):
+                        logger.warning("Lease %s is no longer held by "
+                            "this run", key)
+                except Exception: # pylint: disable=broad-except
+                    logger.warning("Unable to renew lease %s", key,
+                        exc_info=True)
+
+    def _try_acquire(self, key, expires):
+        """ try to acquire the lease, returns True when acquired """
+        raise NotImplementedError
+
+    def _renew(self, key, expires):
+        """ extend a lease held by this owner, returns False when the lease
+        is no longer held by this owner
+        """
+        raise NotImplementedError
+
+    def _release(self, key):
+        """ release a lease held by this owner """
+        raise NotImplementedError
+
+    @staticmethod
+    def _key_name(key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class FileLeaseManager(LeaseManager):
+    """ Leases stored as files in a local directory.
+    Suitable for runs on a single host or sharing a file system.
+    """
+
+    def __init__(self, directory, **kwargs):
+        super(FileLeaseManager, self).__init__(**kwargs)
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, self._key_name(key) + ".lease")
+
+    def _try_acquire(self, key, expires):
+        if not os.path.isdir(self.directory):
+            filesystem.makedirs(self.directory, 0o700)
+        path = self._path(key)
+        try:
+            fd = filesystem.open(path,
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except OSError:
+            lease = self._read(path)
+            if self._get_expires(path, lease) > time.time():
+                return False
+            self._take_over(key, path, lease)
+            return False
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._lease(key, expires), f)
+        return True
+
+    def _take_over(self, key, path, lease):
+        """ helper function to remove an expired lease. The lease is moved
+        to a unique name first, so only one run removes it, and is only
+        removed when it is still the lease which was read, i.e. it was not
+        renewed or replaced in the meantime.
+        """
+        stale = "%s.%s.stale" % (path, uuid.uuid4().hex)
+        try:
+            filesystem.replace(path, stale)
+        except OSError:
+            # another run moved it first
+            return
+        if self._read(stale) == lease:
+            logger.info("Taking over expired lease on %s", key)
+        else:
+            try:
+                # link fails rather than overwriting a lease created since
+                os.link(stale, path)
+            except OSError:
+                logger.warning("Unable to restore lease on %s", key)
+        os.remove(stale)
+
+    def _renew(self, key, expires):
+        path = self._path(key)
+        lease = self._read(path)
+        if lease is None or lease.get('owner') != self.owner:
+            return False
+        tmp = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        with open(tmp, 'w') as f:
+            json.dump(self._lease(key, expires), f)
+        filesystem.replace(tmp, path)
+        return True
+
+    def _lease(self, key, expires):
+        return {"key": key, "owner": self.owner, "expires": expires}
+
+    def _release(self, key):
+        path = self._path(key)
+        lease = self._read(path)
+        if lease is not None and lease.get('owner') == self.owner:
+            os.remove(path)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _get_expires(self, path, lease):
+        """ helper function to get the expiry of a lease. A lease which
+        cannot be read is still being written (or was left empty by a
+        crashed run), it expires ttl seconds after it was created.
+        """
+        if lease is not None:
+            return lease.get('expires', 0)
+        try:
+            return os.path.getmtime(path) + self.ttl
+        except OSError:
+            return 0
+
+
+class KongLeaseManager(LeaseManager):
+    """ Leases stored in Kong as consumers.
+    Consumer usernames are unique so creating the consumer is an atomic
+    test and set which is shared by every run using the same Kong cluster.
+
+    Taking over an expired lease is not atomic: Kong has no conditional
+    delete, so the consumer is read again and deleted by id, and a renewal
+    which lands between that read and the delete is lost. This needs the
+    holder to have missed every renewal for `ttl` seconds and to renew in
+    that window; its next renewal then finds the lease gone and logs that
+    the lease is no longer held. Renewing by creating a new consumer would
+    not close the window, as the username has to be freed before it can
+    be created again.
+    """
+
+    def __init__(self, api, **kwargs):
+        super(KongLeaseManager, self).__init__(**kwargs)
+        self._api = api
+
+    def _username(self, key):
+        return LEASE_TAG + "-" + self._key_name(key)
+
+    def _try_acquire(self, key, expires):
+        username = self._username(key)
+        try:
+            self._api.create_consumer({
+                "username": username,
+                "custom_id": self.owner,
+                "tags": [LEASE_TAG, _expires_tag_prefix + str(int(expires))]
+            })
+            return True
+        except Conflict:
+            pass
+
+        try:
+            consumer = self._api.get_consumer(username)
+        except NotFound:
+            return False
+
+        if self._get_expires(consumer) > time.time():
+            return False
+
+        # only delete the consumer which was read, by id, and only when it
+        # was not renewed (or replaced by another run) in the meantime. A
+        # renewal after this read is still lost, see the class docstring
+        try:
+            current = self._api.get_consumer(consumer['id'])
+        except NotFound:
+            return False
+        if (current.get('custom_id') != consumer.get('custom_id') or
+                current.get('tags') != consumer.get('tags')):
+            return False
+
+        logger.info("Taking over expired lease on %s", key)
+        self._api.delete_consumer(consumer['id'])
+        return False
+
+    def _renew(self, key, expires):
+        try:
+            consumer = self._api.get_consumer(self._username(key))
+        except NotFound:
+            return False
+        if consumer.get('custom_id') != self.owner:
+            return False
+        self._api.update_consumer(consumer['id'], {
+            "tags": [LEASE_TAG, _expires_tag_prefix + str(int(expires))]
+        })
+        return True
+
+    def _release(self, key):
+        username = self._username(key)
+        try:
+            consumer = self._api.get_consumer(username)
+        except NotFound:
+            return
+        if consumer.get('custom_id') == self.owner:
+            self._api.delete_consumer(consumer['id'])
+
+    @staticmethod
+    def _get_expires(consumer):
+        for tag in consumer.get('tags') or []:
+            if tag.startswith(_expires_tag_prefix):
+                try:
+                    return int(tag[len(_expires_tag_prefix):])
+                except ValueError:
+                    pass
+        return 0
@@ -0,0 +1,33 @@
+""" Module to write values into the Lua code of Kong pre-function plugins """
+import re
+
+# a double quoted Lua string literal, as written by quote
+STRING = r'"(?:[^"\\\n]|\\.)*"'
+
+_safe_bytes = frozenset(bytearray(
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.-*/:"))
+_escape = re.compile(r'\\(\d{1,3}|.)')
+_escaped_chars = {"n": "\n", "r": "\r", "t": "\t"}
+
+
+def quote(value):
+    """ Get a Lua string literal for the value. Bytes other than letters,
+    digits and _.-*/: are written as decimal escapes, i.e. \\034 for ", so
+    the value cannot end the literal or inject code.
+    """
+    return '"' + "".join(chr(b) if b in _safe_bytes else "\\%03d" % b
+        for b in bytearray(value.encode('utf-8'))) + '"'
+
+
+def unquote(literal):
+    """ Get the value of a Lua string literal (see :data:`STRING`) """
+    def unescape(match):
+        escaped = match.group(1)
+        if escaped.isdigit():
+            return chr(int(escaped))
+        return _escaped_chars.get(escaped, escaped)
+
+    # every escaped byte is < 256, so latin-1 maps the characters back to
+    # the utf-8 bytes of the value
+    return _escape.sub(unescape, literal[1:-1]).encode('latin-1').decode(
+        'utf-8')
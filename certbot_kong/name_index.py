@@ -0,0 +1,66 @@
+""" Module to index the names (SNIs and route hosts) configured in Kong """
+import bisect
+import collections
+
+
+class NameIndex(object):
+    """ Names referenced by certificate SNIs and route hosts.
+
+    Each name is counted once per reference so it stays in the index until
+    the last certificate or route referencing it no longer does. A sorted
+    list of the names is kept alongside the counts for ordered and prefix
+    lookups.
+    """
+
+    def __init__(self, certs=None, routes=None):
+        self._counts = collections.Counter() #type: Counter[str]
+        for c in certs or []:
+            self._counts.update(c.get('snis') or [])
+        if hasattr(routes, 'iter_hosts'):
+            # a RouteTable, scan the hosts without building route dicts
+            self._counts.update(routes.iter_hosts())
+        else:
+            for r in routes or []:
+                self._counts.update(r.get('hosts') or [])
+        self._sorted = sorted(self._counts) #type: List[str]
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def __contains__(self, name):
+        return name in self._counts
+
+    def __iter__(self):
+        return iter(self._sorted)
+
+    def add(self, name):
+        """ Add a reference to a name """
+        self._counts[name] += 1
+        if self._counts[name] == 1:
+            bisect.insort(self._sorted, name)
+
+    def discard(self, name):
+        """ Remove a reference to a name """
+        count = self._counts.get(name, 0)
+        if count > 1:
+            self._counts[name] = count - 1
+        elif count == 1:
+            del self._counts[name]
+            del self._sorted[bisect.bisect_left(self._sorted, name)]
+
+    def names(self):
+        """ Get the names
+        :rtype: set
+        """
+        return set(self._counts)
+
+    def with_prefix(self, prefix):
+        """ Get the names starting with prefix, in sorted order
+        :rtype: list
+        """
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = start
+        while (end < len(self._sorted) and
+                self._sorted[end].startswith(prefix)):
+            end += 1
+        return self._sorted[start:end]
@@ -0,0 +1,88 @@
+""" Module to choose between the nodes of a Kong Admin API cluster """
+import itertools
+import threading
+
+from certbot_kong.circuit_breaker import CircuitBreaker
+
+
+def parse_urls(urls):
+    """ Get the admin urls from a comma separated string (or a list) """
+    if isinstance(urls, str):
+        urls = urls.split(",")
+    return [u.strip() for u in urls if u.strip()]
+
+
+class NodePool(object):
+    """ Admin API nodes, each with its own circuit breaker.
+
+    Reads are spread over the nodes round robin. Writes are pinned to one
+    node, so the changes of a plan are made (and read back by Kong) on the
+    same node, until that node fails and the next node is pinned. Nodes
+    with an open circuit are skipped, and the other nodes are returned in
+    order so a failed request can be sent to the next one.
+    """
+
+    def __init__(self, urls, circuit_threshold=5, circuit_reset=30):
+        self.urls = parse_urls(urls)
+        if not self.urls:
+            raise ValueError("No admin API url")
+        self._breakers = dict((u, CircuitBreaker(circuit_threshold,
+            circuit_reset)) for u in self.urls)
+        self._write_index = 0
+        self._init_runtime_state()
+
+    def _init_runtime_state(self):
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_lock', '_counter'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime_state()
+
+    def __len__(self):
+        return len(self.urls)
+
+    @property
+    def write_url(self):
+        """ get the url of the node writes are pinned to """
+        return self.urls[self._write_index]
+
+    def candidates(self, write=False):
+        """ Get the urls to send a request to, in the order to try them.
+        Empty when the circuit of every node is open.
+        """
+        with self._lock:
+            if write:
+                first = self._write_index
+            else:
+                first = next(self._counter) % len(self.urls)
+        ordered = self.urls[first:] + self.urls[:first]
+        return [u for u in ordered if self._breakers[u].allow()]
+
+    def failures(self):
+        """ get the number of consecutive failures of the healthiest node """
+        return min(b.failures for b in self._breakers.values())
+
+    def record_success(self, url):
+        """ record a request to the node which succeeded """
+        self._breakers[url].record_success()
+
+    def record_failure(self, url):
+        """ record a request to the node which failed. Writes are pinned to
+        the next node when the pinned node fails.
+        """
+        self._breakers[url].record_failure()
+        with self._lock:
+            if len(self.urls) > 1 and self.write_url == url:
+                self._write_index = (self._write_index + 1) % len(self.urls)
+
+    def reset(self):
+        """ close the circuit of every node """
+        for breaker in self._breakers.values():
+            breaker.reset()
@@ -0,0 +1,81 @@
+""" Module to read and fingerprint PEM files once per run """
+import hashlib
+import threading
+
+from certbot.compat import os
+
+_read_chunk_size = 64 * 1024
+
+
+def digest(content):
+    """ Get the digest of a PEM string """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def combine(fullchain_digest, key_digest):
+    """ Combine the digests of a certificate chain and its key """
+    return hashlib.sha256(
+        (fullchain_digest + ":" + key_digest).encode('ascii')).hexdigest()
+
+
+def fingerprint(fullchain_str, key_str):
+    """ Get the fingerprint identifying a certificate chain and key """
+    return combine(digest(fullchain_str or ""), digest(key_str or ""))
+
+
+class PemFile(object):
+    """ Content of a PEM file and its digest """
+    __slots__ = ('content', 'digest')
+
+    def __init__(self, content, content_digest):
+        self.content = content
+        self.digest = content_digest
+
+
+class PemCache(object):
+    """ Cache of PEM files keyed by path, modification time and size.
+    A file is read (and its digest computed while it is read) only the first
+    time it is requested, or again if it has since been modified.
+    """
+
+    def __init__(self):
+        self._files = {} #type: Dict[str, Tuple[Tuple[float, int], PemFile]]
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        """ Read a PEM file
+        :rtype: PemFile
+        :raises IOError: when the file cannot be read
+        """
+        version = (os.path.getmtime(path), os.path.getsize(path))
+        with self._lock:
+            cached = self._files.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        pem_file = self._read(path)
+        with self._lock:
+            self._files[path] = (version, pem_file)
+        return pem_file
+
+    def read_certificate(self, fullchain_path, key_path):
+        """ Read a certificate chain and key
+        :returns: (fullchain_str, key_str, fingerprint)
+        """
+        fullchain = self.read(fullchain_path)
+        key = self.read(key_path)
+        return (fullchain.content, key.content,
+            combine(fullchain.digest, key.digest))
+
+    @staticmethod
+    def _read(path):
+        sha = hashlib.sha256()
+        chunks = []
+        with open(path, 'r') as f:
+            while True:
+                chunk = f.read(_read_chunk_size)
+                if not chunk:
+                    break
+                sha.update(chunk.encode('utf-8'))
+                chunks.append(chunk)
+        return PemFile("".join(chunks), sha.hexdigest())
@@ -0,0 +1,191 @@
+""" Module to profile where the time of a certbot-kong run is spent
+
+A run is profiled once :func:`start` is called (see --kong-profile). The
+profiler is process wide, so the admin API clients and invokers restored
+from the work directory report to the same profile.
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+
+from certbot.compat import filesystem
+
+# upper bounds, in milliseconds, of the admin call latency histogram buckets
+_latency_buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class NullProfiler(object):
+    """ Profiler used when the run is not profiled """
+
+    @contextlib.contextmanager
+    def operation(self, unused_name):
+        """ Profile an operation """
+        yield
+
+    @contextlib.contextmanager
+    def measure(self, unused_category):
+        """ Measure time spent in a category """
+        yield
+
+    @contextlib.contextmanager
+    def request(self, unused_method, unused_path):
+        """ Measure an admin API request """
+        yield
+
+
+class RunProfiler(object):
+    """ Wall time of the plugin operations split into categories.
+
+    Operations (i.e. deploy_cert) nest, and the time measured in a
+    category (network, json, pickle) is attributed to the innermost
+    operation. Threads without operations of their own (i.e. of a pool)
+    report to the operations of the thread which started profiling. The
+    time of an operation not measured in a category or nested operation is
+    counted as python, i.e. scanning and planning. Times are recorded by
+    stack, as "operation;operation;category", so the report can be rendered
+    as a flame graph.
+
+    As requests may be sent concurrently the network time of an operation
+    can exceed its wall time, its python time is then 0.
+
+    When a filename is given the report is written to it each time an
+    outermost operation completes.
+    """
+
+    def __init__(self, filename=None, clock=time.time):
+        self.filename = filename
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started_at = clock()
+        self._owner = threading.current_thread().ident
+        self._threads = {} #type: Dict[int, List[List]]
+        self._stacks = collections.Counter() #type: Counter[str]
+        self._operations = collections.OrderedDict() #type: Dict[str, Dict]
+        self._latency = {} #type: Dict[str, Dict]
+
+    def _frames(self):
+        """ helper function to get the operations in progress, as
+        [name, start, child time] frames, of the current thread
+        """
+        return (self._threads.get(threading.current_thread().ident) or
+            self._threads.get(self._owner) or [])
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """ Profile an operation """
+        ident = threading.current_thread().ident
+        frame = [name, self._clock(), 0.0]
+        with self._lock:
+            previous = self._threads.get(ident)
+            frames = self._frames() + [frame]
+            self._threads[ident] = frames
+        try:
+            yield
+        finally:
+            wall = self._clock() - frame[1]
+            with self._lock:
+                self._threads[ident] = previous
+                if len(frames) > 1:
+                    frames[-2][2] += wall
+                self._stacks[";".join([f[0] for f in frames] +
+                    ["python"])] += max(wall - frame[2], 0.0)
+                stats = self._operations.setdefault(name,
+                    {"calls": 0, "wall": 0.0})
+                stats["calls"] += 1
+                stats["wall"] += wall
+                outermost = ident == self._owner and not previous
+            if outermost and self.filename:
+                self.write(self.filename)
+
+    @contextlib.contextmanager
+    def measure(self, category):
+        """ Measure time spent in a category """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self._add(category, self._clock() - start)
+
+    @contextlib.contextmanager
+    def request(self, method, path):
+        """ Measure an admin API request, as network time and in the
+        latency histogram of the method and entity type of the path
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            elapsed = self._clock() - start
+            self._add("network", elapsed)
+            key = "%s /%s" % (method,
+                path.split("?")[0].strip("/").split("/")[0])
+            bucket = next((str(b) for b in _latency_buckets
+                if elapsed * 1000 <= b), "inf")
+            with self._lock:
+                stats = self._latency.setdefault(key, {"count": 0,
+                    "total": 0.0, "max": 0.0, "buckets": dict(
+                        [(str(b), 0) for b in _latency_buckets] +
+                        [("inf", 0)])})
+                stats["count"] += 1
+                stats["total"] += elapsed
+                stats["max"] = max(stats["max"], elapsed)
+                stats["buckets"][bucket] += 1
+
+    def _add(self, category, elapsed):
+        with self._lock:
+            frames = self._frames()
+            if frames:
+                frames[-1][2] += elapsed
+            self._stacks[";".join([f[0] for f in frames] +
+                [category])] += elapsed
+
+    def report(self):
+        """ Get the report
+        :rtype: dict
+        """
+        with self._lock:
+            totals = collections.Counter()
+            for stack, elapsed in self._stacks.items():
+                totals[stack.rsplit(";", 1)[-1]] += elapsed
+            report = {
+                "started_at": self._started_at,
+                "elapsed": self._clock() - self._started_at,
+                "totals": dict(totals),
+                "operations": self._operations,
+                "stacks": dict(self._stacks),
+                "latency": self._latency
+            }
+            # copy the nested stats while they cannot change
+            return json.loads(json.dumps(report))
+
+    def write(self, filename):
+        """ Write the report as JSON """
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        filesystem.replace(tmp, filename)
+
+
+_profiler = NullProfiler()
+
+
+def active():
+    """ Get the profiler of the run """
+    return _profiler
+
+
+def start(filename=None):
+    """ Start profiling the run
+    :rtype: RunProfiler
+    """
+    global _profiler # pylint: disable=global-statement
+    _profiler = RunProfiler(filename)
+    return _profiler
+
+
+def stop():
+    """ Stop profiling the run """
+    global _profiler # pylint: disable=global-statement
+    _profiler = NullProfiler()
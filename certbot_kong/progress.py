@@ -0,0 +1,64 @@
+""" Module to persist the changes applied by a run so a run can resume """
+import threading
+
+from certbot.compat import filesystem
+from certbot.compat import os
+
+
+class ChangeProgress(object):
+    """ Ids of the changes applied by runs which did not complete.
+
+    Each id is appended to the file as soon as the change is applied, so
+    the progress survives a crash. Ids are discarded once every change of
+    a plan has been applied, including the ids recorded by previous runs
+    whose changes were not planned again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._applied = set() #type: Set[str]
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self._applied.update(l.strip() for l in f if l.strip())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __contains__(self, change_id):
+        return change_id in self._applied
+
+    def __len__(self):
+        return len(self._applied)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(sorted(self._applied))
+
+    def add(self, change_id):
+        """ Record an applied change """
+        with self._lock:
+            if change_id in self._applied:
+                return
+            self._applied.add(change_id)
+            with open(self.filename, "a") as f:
+                f.write(change_id + "\n")
+
+    def discard(self, change_ids):
+        """ Forget changes, i.e. once their plan has been applied """
+        with self._lock:
+            self._applied.difference_update(change_ids)
+            if not self._applied:
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                return
+            tmp = self.filename + ".tmp"
+            with open(tmp, "w") as f:
+                f.writelines(i + "\n" for i in sorted(self._applied))
+            filesystem.replace(tmp, self.filename)
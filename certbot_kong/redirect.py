@@ -0,0 +1,65 @@
+""" Module to redirect HTTP to HTTPS for hosts with a single Kong plugin """
+import re
+import uuid
+
+from certbot_kong import lua
+
+PLUGIN_NAME = "pre-function"
+_plugin_id_name = "certbot-kong-redirect"
+_host_pattern = re.compile(r'^  \[(%s)\] = true,$' % lua.STRING, re.MULTILINE)
+
+_redirect_function = """
+return function()
+  if kong.request.get_scheme() ~= "http" then
+    return
+  end
+  local host = kong.request.get_host()
+  local wildcard = (host:gsub("^[^.]+", "*", 1))
+  if not (hosts[host] or hosts[wildcard]) then
+    return
+  end
+  local path = kong.request.get_path()
+  if path:find("/.well-known/acme-challenge/", 1, true) == 1 then
+    return
+  end
+  return kong.response.exit(301, "", {
+    Location = "https://" .. host .. kong.request.get_path_with_query()
+  })
+end
+"""
+
+
+def plugin_id(workspace=None):
+    """ Get the id of the redirect plugin (of a workspace) """
+    name = _plugin_id_name
+    if workspace:
+        name += "/" + workspace
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+def plugin_data(hosts):
+    """ Get the redirect plugin for the hosts.
+    The plugin is global, so it runs for every route, and redirects HTTP
+    requests for the hosts (other than ACME http-01 challenges) to HTTPS.
+    """
+    lines = ["local hosts = {"]
+    lines.extend('  [%s] = true,' % lua.quote(h) for h in sorted(hosts))
+    lines.append("}")
+    return {
+        "name": PLUGIN_NAME,
+        "config": {
+            "access": ["\n".join(lines) + _redirect_function]
+        }
+    }
+
+
+def get_hosts(plugin):
+    """ Get the hosts redirected by a redirect plugin
+    :rtype: set
+    """
+    if not plugin:
+        return set()
+    hosts = set()
+    for code in (plugin.get('config') or {}).get('access') or []:
+        hosts.update(lua.unquote(h) for h in _host_pattern.findall(code))
+    return hosts
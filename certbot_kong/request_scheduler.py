@@ -0,0 +1,91 @@
+""" Module to schedule Kong Admin API requests """
+import heapq
+import itertools
+import threading
+import time
+
+
+# Priority classes, lower values are sent first
+PRIORITY_CHALLENGE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+
+
+def _now():
+    return getattr(time, 'monotonic', time.time)()
+
+
+class RequestScheduler(object):
+    """ Token bucket scheduler for Kong Admin API requests.
+
+    Each request acquires a token before it is sent. Tokens are refilled at
+    `rate` per second up to `burst` tokens. When tokens are exhausted the
+    waiting requests are released in priority order (then in arrival
+    order). A rate of None does not limit the request rate, although
+    requests are still held back while the scheduler is deferred (i.e. after
+    a response with a Retry-After header).
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self._rate = float(rate) if rate else None
+        self._burst = max(float(burst or 1), 1.0)
+        self._tokens = self._burst
+        self._updated = _now()
+        self._blocked_until = 0.0
+        self._init_runtime_state()
+
+    def _init_runtime_state(self):
+        self._cond = threading.Condition()
+        self._waiting = [] #type: List[Tuple[int, int]]
+        self._counter = itertools.count()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_cond', '_waiting', '_counter'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._tokens = self._burst
+        self._updated = _now()
+        self._blocked_until = 0.0
+        self._init_runtime_state()
+
+    def acquire(self, priority=PRIORITY_DEFAULT):
+        """ Block until a request with `priority` may be sent """
+        with self._cond:
+            ticket = (priority, next(self._counter))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    now = _now()
+                    self._refill(now)
+                    wait = self._blocked_until - now
+                    if wait <= 0 and self._waiting[0] == ticket:
+                        if self._rate is None:
+                            return
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        wait = (1 - self._tokens) / self._rate
+                    self._cond.wait(wait if wait > 0 else None)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def defer(self, seconds):
+        """ Hold back all requests for the next `seconds` seconds """
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, _now() + seconds)
+            if self._rate is not None:
+                self._tokens = 0.0
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        if self._rate is None:
+            return
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+        self._updated = now
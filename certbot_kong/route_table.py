@@ -0,0 +1,145 @@
+""" Module to hold Kong routes in compact columns """
+import array
+
+try:
+    from sys import intern
+except ImportError: # pragma: no cover
+    pass # builtin on python 2
+
+# protocols are stored as bit flags, in the order Kong defines them
+_protocols = ("http", "https", "grpc", "grpcs", "tcp", "tls", "udp",
+    "tls_passthrough", "ws", "wss")
+
+
+class RouteTable(object):
+    """ Routes held as columns rather than one dict per route.
+
+    Only the fields certbot-kong uses (id, hosts, protocols and updated_at)
+    are kept. Ids and hosts are interned strings, hosts of every route are
+    held in one list with an offset array, and protocols are bit flags in
+    an array. Routes are indexed by id.
+
+    A replaced route with the same number of hosts is overwritten in
+    place. Otherwise the route is appended again and the index points to
+    the new row, a removed route is dropped from the index. The rows no
+    longer indexed are dropped once they outnumber the routes. Iterating
+    the table yields a new dict for each route, so changes to a route must
+    be made with replace() or set_protocols().
+    """
+
+    def __init__(self, routes=()):
+        self._ids = [] #type: List[str]
+        self._updated_at = array.array('l')
+        self._protocols = array.array('L')
+        self._host_offsets = array.array('L', [0])
+        self._hosts = [] #type: List[str]
+        self._index = {} #type: Dict[str, int]
+        self._stale = 0
+        self._protocol_names = list(_protocols)
+        self.extend(routes)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        for row in self._rows():
+            yield self._route(row)
+
+    def __contains__(self, route_id):
+        return route_id in self._index
+
+    def __getstate__(self):
+        return {"routes": list(self)}
+
+    def __setstate__(self, state):
+        self.__init__(state["routes"])
+
+    def _rows(self):
+        for row, route_id in enumerate(self._ids):
+            if self._index.get(route_id) == row:
+                yield row
+
+    def extend(self, routes):
+        """ Add routes, i.e. while the pages of a listing are received """
+        for route in routes:
+            self.append(route)
+
+    def append(self, route):
+        """ Add a route, replacing any route with the same id """
+        route_id = intern(str(route['id']))
+        hosts = [intern(str(h)) for h in route.get('hosts') or []]
+        row = self._index.get(route_id)
+        if row is not None and len(hosts) == len(self._row_hosts(row)):
+            start = self._host_offsets[row]
+            self._hosts[start:start + len(hosts)] = hosts
+            self._updated_at[row] = route.get('updated_at') or 0
+            self._protocols[row] = self._encode_protocols(
+                route.get('protocols') or [])
+            return
+
+        self._index[route_id] = len(self._ids)
+        self._ids.append(route_id)
+        self._updated_at.append(route.get('updated_at') or 0)
+        self._protocols.append(self._encode_protocols(
+            route.get('protocols') or []))
+        self._hosts.extend(hosts)
+        self._host_offsets.append(len(self._hosts))
+        if row is not None:
+            self._stale += 1
+            self._compact()
+
+    def get(self, route_id):
+        """ Get a route, None if there is no route with the id """
+        row = self._index.get(route_id)
+        return self._route(row) if row is not None else None
+
+    def replace(self, route_id, route):
+        """ Replace a route, or remove it when route is None """
+        if route is None:
+            if self._index.pop(route_id, None) is not None:
+                self._stale += 1
+                self._compact()
+        else:
+            self.append(route)
+
+    def _compact(self):
+        """ helper function to drop the rows which are no longer indexed
+        once they outnumber the routes
+        """
+        if self._stale > len(self._index):
+            self.__init__(list(self))
+
+    def set_protocols(self, route_id, protocols):
+        """ Set the protocols of a route """
+        self._protocols[self._index[route_id]] = (
+            self._encode_protocols(protocols))
+
+    def iter_hosts(self):
+        """ Iterate the hosts of every route """
+        for row in self._rows():
+            for host in self._row_hosts(row):
+                yield host
+
+    def _row_hosts(self, row):
+        return self._hosts[self._host_offsets[row]:self._host_offsets[row + 1]]
+
+    def _route(self, row):
+        hosts = self._row_hosts(row)
+        return {
+            "id": self._ids[row],
+            "hosts": hosts if hosts else None,
+            "protocols": self._decode_protocols(self._protocols[row]),
+            "updated_at": self._updated_at[row] or None
+        }
+
+    def _encode_protocols(self, protocols):
+        flags = 0
+        for p in protocols:
+            if p not in self._protocol_names:
+                self._protocol_names.append(p)
+            flags |= 1 << self._protocol_names.index(p)
+        return flags
+
+    def _decode_protocols(self, flags):
+        return [p for i, p in enumerate(self._protocol_names)
+            if flags & (1 << i)]
@@ -0,0 +1,289 @@
+""" Tests for the change records of the change invoker """
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+
+from certbot_kong import change_invoker
+from certbot_kong.progress import ChangeProgress
+
+
+class ChangeRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = change_invoker.CertificateStore()
+        self.ref = self.store.add("CERT", "KEY")
+
+    def test_certificate_stored_once(self):
+        # WHEN the same certificate is stored twice
+        ref = self.store.add("CERT", "KEY")
+
+        # THEN it is stored once
+        self.assertEqual(ref, self.ref)
+        self.assertEqual(len(self.store), 1)
+
+    def test_record_round_trip(self):
+        # GIVEN changes nested in parallel changes
+        change = change_invoker.ParallelChanges([
+            change_invoker.AddCertificate("cert001", self.ref, self.store),
+            change_invoker.DeleteCertificate("cert002", self.ref, self.store,
+                tags=["a"]),
+            change_invoker.UpdateRouteProtocols("route001",
+                ["https"], ["http", "https"]),
+            change_invoker.CreateSni("a.example.com", "cert001"),
+        ])
+
+        # WHEN the records are serialized as json and restored
+        record = json.loads(json.dumps(change.to_record()))
+        store = change_invoker.CertificateStore.from_record(
+            json.loads(json.dumps(self.store.to_record())))
+        restored = change_invoker.Change.from_record(record, store)
+
+        # THEN the changes are equal
+        self.assertEqual(restored.changes, change.changes)
+        self.assertEqual(restored.get_details(), change.get_details())
+        self.assertEqual(store.get(self.ref).cert, "CERT")
+
+    def test_change_id_is_deterministic(self):
+        change = change_invoker.CreateSni("a.example.com", "cert001")
+
+        self.assertEqual(change.change_id,
+            change_invoker.CreateSni("a.example.com", "cert001").change_id)
+        self.assertNotEqual(change.change_id,
+            change_invoker.CreateSni("a.example.com", "cert002").change_id)
+
+    def test_changes_are_slotted(self):
+        change = change_invoker.CreateSni("a.example.com", "cert001")
+
+        self.assertFalse(hasattr(change, '__dict__'))
+        restored = pickle.loads(pickle.dumps(change))
+        self.assertEqual(restored, change)
+
+
+
+class FakeApi(object):
+    """ Records the undo requests made by an invoker """
+    # pylint: disable=missing-docstring
+
+    def __init__(self):
+        self.calls = []
+        self.circuit_resets = 0
+        self.fail = set()
+        self.certificates = {}
+        self.snis = {}
+        self._lock = threading.Lock()
+
+    def list_certificates(self):
+        return []
+
+    def iter_routes(self):
+        return iter([{"id": "route001", "hosts": ["a.example.com"],
+            "protocols": ["http", "https"]}])
+
+    def reset_circuit(self):
+        self.circuit_resets += 1
+
+    def _record(self, *call):
+        with self._lock:
+            self.calls.append(call)
+
+    def update_or_create_certificate(self, certificate_id, cert,
+            *unused_args):
+        self._record("put", "certificate:" + certificate_id)
+        self.certificates[certificate_id] = {"id": certificate_id,
+            "cert": cert}
+
+    def get_certificate(self, certificate_id):
+        cert = self.certificates.get(certificate_id)
+        if cert is None:
+            return None
+        return dict(cert, snis=sorted(name for name, sni in self.snis.items()
+            if sni["certificate"]["id"] == certificate_id))
+
+    def delete_certificate(self, certificate_id):
+        self._record("delete", "certificate:" + certificate_id)
+        self.certificates.pop(certificate_id, None)
+
+    def create_sni(self, sni, cert_id):
+        if sni in self.fail:
+            raise ValueError("unable to create " + sni)
+        self._record("post", "sni:" + sni)
+        self.snis[sni] = {"name": sni, "certificate": {"id": cert_id}}
+
+    def get_sni(self, sni):
+        return self.snis.get(sni)
+
+    def delete_sni(self, sni):
+        self._record("delete", "sni:" + sni)
+        self.snis.pop(sni, None)
+
+    def update_route_protocols(self, route_id, unused_protocols):
+        if route_id == "route002":
+            raise ValueError("no route002")
+        self._record("patch", "route:" + route_id)
+
+
+class UndoChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeApi()
+        self.store = change_invoker.CertificateStore()
+        self.invoker = change_invoker.KongChangeInvoker(self.api,
+            store=self.store, revalidate=False)
+        ref = self.store.add("CERT", "KEY")
+        self.invoker._queued_changes = [ # pylint: disable=protected-access
+            change_invoker.AddCertificate("cert001", ref, self.store),
+            change_invoker.CreateSni("a.example.com", "cert001"),
+            change_invoker.CreateSni("b.example.com", "cert001"),
+            change_invoker.UpdateRouteProtocols("route001",
+                ["https"], ["http", "https"]),
+        ]
+
+    def test_undo_dependent_changes_last(self):
+        # GIVEN the changes have been applied
+        self.invoker.apply_changes()
+        del self.api.calls[:]
+
+        # WHEN the changes are undone
+        self.invoker.undo_changes()
+
+        # THEN the independent changes are undone first, and the
+        # certificate is deleted once its snis have been deleted
+        self.assertEqual(sorted(self.api.calls[:3]), [
+            ("delete", "sni:a.example.com"), ("delete", "sni:b.example.com"),
+            ("patch", "route:route001")])
+        self.assertEqual(self.api.calls[3:],
+            [("delete", "certificate:cert001")])
+
+    def test_failure_undoes_applied_changes(self):
+        # GIVEN a change which fails
+        self.invoker._queued_changes.append( # pylint: disable=protected-access
+            change_invoker.UpdateRouteProtocols("route002",
+                ["https"], ["http", "https"]))
+
+        # WHEN the changes are applied
+        self.assertRaises(ValueError, self.invoker.apply_changes)
+
+        # THEN the circuit is closed and the applied changes are undone
+        self.assertEqual(self.api.circuit_resets, 1)
+        self.assertEqual(self.api.calls[-1],
+            ("delete", "certificate:cert001"))
+        self.assertEqual(sorted(self.api.calls[4:-1]), [
+            ("delete", "sni:a.example.com"), ("delete", "sni:b.example.com"),
+            ("patch", "route:route001")])
+
+
+
+class SharedCertificateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeApi()
+        self.store = change_invoker.CertificateStore()
+        self.ref = self.store.add("CERT", "KEY")
+
+    def _invoker(self, sni):
+        """ get an invoker adding the certificate for a SNI, as a run does """
+        invoker = change_invoker.KongChangeInvoker(self.api,
+            store=self.store, revalidate=False)
+        invoker._queued_changes = [ # pylint: disable=protected-access
+            change_invoker.AddCertificate("cert001", self.ref, self.store),
+            change_invoker.CreateSni(sni, "cert001"),
+        ]
+        return invoker
+
+    def test_rollback_keeps_certificate_added_by_other_run(self):
+        # GIVEN a run which added the certificate
+        self._invoker("a.example.com").apply_changes()
+
+        # WHEN another run adding the same certificate rolls back
+        self.api.fail.add("b.example.com")
+        self.assertRaises(ValueError,
+            self._invoker("b.example.com").apply_changes)
+
+        # THEN the certificate of the first run is kept
+        self.assertTrue("cert001" in self.api.certificates)
+        self.assertEqual(list(self.api.snis), ["a.example.com"])
+
+    def test_rollback_keeps_certificate_referenced_by_other_run(self):
+        # GIVEN a run which added the certificate before another run
+        # deployed it as well
+        add = change_invoker.AddCertificate("cert001", self.ref, self.store)
+        add.execute(self.api)
+        self._invoker("a.example.com").apply_changes()
+
+        # WHEN the first run rolls back
+        add.undo(self.api)
+
+        # THEN the certificate referenced by the other run is kept
+        self.assertTrue("cert001" in self.api.certificates)
+
+    def test_rollback_deletes_certificate_it_added(self):
+        add = change_invoker.AddCertificate("cert001", self.ref, self.store)
+        add.execute(self.api)
+
+        add.undo(self.api)
+
+        self.assertFalse("cert001" in self.api.certificates)
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeApi()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.filename = os.path.join(self.work_dir, "kong_progress")
+
+    def _apply(self):
+        """ plan and apply a deployment with a new invoker, as a run does """
+        invoker = change_invoker.KongChangeInvoker(self.api, revalidate=False,
+            progress=ChangeProgress(self.filename))
+        store = change_invoker.CertificateStore()
+        ref = store.add("CERT", "KEY")
+        invoker._queued_changes = [ # pylint: disable=protected-access
+            change_invoker.AddCertificate("cert001", ref, store),
+            change_invoker.CreateSni("a.example.com", "cert001"),
+            change_invoker.CreateSni("b.example.com", "cert001"),
+        ]
+        invoker.apply_changes(resumable=True)
+
+    def test_resume_after_failure(self):
+        # GIVEN a resumable apply which fails on the last change
+        self.api.fail.add("b.example.com")
+        self.assertRaises(ValueError, self._apply)
+
+        # THEN the applied changes are kept and recorded
+        self.assertEqual(self.api.calls, [("put", "certificate:cert001"),
+            ("post", "sni:a.example.com")])
+        self.assertEqual(len(ChangeProgress(self.filename)), 2)
+
+        # WHEN the next run applies the same plan
+        self.api.fail.clear()
+        del self.api.calls[:]
+        self._apply()
+
+        # THEN only the failed change is applied and the progress is cleared
+        self.assertEqual(self.api.calls, [("post", "sni:b.example.com")])
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_unverified_changes_applied_again(self):
+        # GIVEN a change recorded as applied which is no longer in kong
+        self.api.fail.add("b.example.com")
+        self.assertRaises(ValueError, self._apply)
+        del self.api.snis["a.example.com"]
+
+        # WHEN the next run applies the same plan
+        self.api.fail.clear()
+        del self.api.calls[:]
+        self._apply()
+
+        # THEN the change is applied again
+        self.assertEqual(self.api.calls, [("post", "sni:a.example.com"),
+            ("post", "sni:b.example.com")])
+
+
+if __name__ == '__main__':
+    unittest.main()
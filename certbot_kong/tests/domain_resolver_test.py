@@ -0,0 +1,38 @@
+""" Tests for the domain resolver """
+import unittest
+
+from certbot_kong.domain_resolver import DomainResolver
+from certbot_kong.domain_resolver import matches_wildcard
+
+
+class DomainResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = DomainResolver([
+            "a.example.com", "b.example.com", "x.a.example.com",
+            "example.com", "localhost"])
+
+    def test_resolve(self):
+        self.assertEqual(self.resolver.resolve("*.example.com"),
+            ["a.example.com", "b.example.com"])
+        self.assertEqual(self.resolver.resolve("*.a.example.com"),
+            ["x.a.example.com"])
+        self.assertEqual(self.resolver.resolve("c.example.com"),
+            ["c.example.com"])
+        self.assertEqual(self.resolver.resolve("*.other.com"), [])
+
+    def test_added_names_resolved(self):
+        self.resolver.add("c.example.com")
+
+        self.assertEqual(self.resolver.resolve("*.example.com"),
+            ["a.example.com", "b.example.com", "c.example.com"])
+
+    def test_matches_wildcard(self):
+        self.assertTrue(matches_wildcard("a.example.com", "*.example.com"))
+        self.assertFalse(matches_wildcard("x.a.example.com", "*.example.com"))
+        self.assertFalse(matches_wildcard("example.com", "*.example.com"))
+        self.assertFalse(matches_wildcard("localhost", "*.example.com"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+""" Tests for the Kong Admin API wrapper """
+import gzip
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import requests
+import urllib3
+
+import certbot_kong.kong_admin_api as api
+from certbot_kong import json_stream
+from certbot_kong import request_scheduler
+from certbot_kong.tests.mock_http_server import MockHttpServer
+from certbot_kong.tests.mock_kong_admin_handler import MockKongAdminHandler
+
+
+class KongAdminApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockHttpServer(handler=MockKongAdminHandler)
+        self.server.start()
+        self.api = api.KongAdminApi(url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_retry_after_too_many_requests(self, response_override):
+        # GIVEN kong rate limits the first request
+        response_override.side_effect = [
+            (429, {"Retry-After": "0"}),
+            None
+        ]
+
+        # WHEN creating a sni
+        self.api.create_sni("a005.example.com", "cert001")
+
+        # THEN the request is retried
+        self.assertEqual(response_override.call_count, 2)
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_retries_exhausted(self, response_override):
+        # GIVEN kong always rate limits requests
+        response_override.return_value = (429, {"Retry-After": "0"})
+        self.api = api.KongAdminApi(url=self.server.url, max_retries=2)
+
+        # WHEN creating a sni THEN an error is raised after the retries
+        self.assertRaises(api.ApiError,
+            self.api.create_sni, "a005.example.com", "cert001")
+        self.assertEqual(response_override.call_count, 3)
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_circuit_opens_after_failures(self, response_override):
+        # GIVEN kong fails every request
+        response_override.return_value = (500, {})
+        self.api = api.KongAdminApi(url=self.server.url, circuit_threshold=2)
+        for _ in range(2):
+            self.assertRaises(api.ApiError,
+                self.api.create_sni, "a005.example.com", "cert001")
+
+        # WHEN another request is made THEN it fails without being sent
+        self.assertRaises(api.CircuitOpenError,
+            self.api.delete_sni, "a005.example.com")
+        self.assertEqual(response_override.call_count, 2)
+
+        # AND requests are sent again once the circuit is reset
+        response_override.return_value = None
+        self.api.reset_circuit()
+        self.api.create_sni("a005.example.com", "cert001")
+        self.assertEqual(response_override.call_count, 3)
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_backpressure_does_not_open_circuit(self, response_override):
+        # GIVEN kong asks for requests to be slowed down
+        response_override.side_effect = [(429, {"Retry-After": "0"})] + [
+            (503, {"Retry-After": "0"})] * 3 + [None]
+        self.api = api.KongAdminApi(url=self.server.url, circuit_threshold=2)
+
+        # WHEN the requests are retried THEN they are sent until they succeed
+        self.api.create_sni("a005.example.com", "cert001")
+        self.assertEqual(response_override.call_count, 5)
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_request_timeout(self, response_override):
+        # GIVEN kong is slow to respond
+        response_override.side_effect = lambda *args: time.sleep(0.5)
+        self.api = api.KongAdminApi(url=self.server.url, timeout=0.1,
+            circuit_threshold=1)
+
+        # WHEN a request is made THEN it times out and opens the circuit
+        self.assertRaises(requests.exceptions.Timeout,
+            self.api.list_routes)
+        self.assertRaises(api.CircuitOpenError, self.api.list_routes)
+
+    def test_fail_over_to_next_node(self):
+        # GIVEN the first admin node is down
+        self.api = api.KongAdminApi(
+            url="http://127.0.0.1:1," + self.server.url)
+
+        # WHEN reading and writing
+        routes = self.api.list_routes()
+        self.api.create_sni("a005.example.com", "cert001")
+
+        # THEN the requests are sent to the other node
+        self.assertTrue(routes)
+        self.assertEqual(self.api.urls, ["http://127.0.0.1:1",
+            self.server.url])
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.request_info')
+    def test_write_not_sent_again_once_sent(self, request_info):
+        # GIVEN the first admin node aborts the connection once a write is
+        # sent to it
+        self.api = api.KongAdminApi(
+            url="http://127.0.0.1:1," + self.server.url)
+        _, session = self.api._sessions["http://127.0.0.1:1"] # pylint: disable=protected-access
+        aborted = requests.exceptions.ConnectionError(
+            urllib3.exceptions.ProtocolError("Connection aborted."))
+
+        # WHEN writing THEN the write is not sent to the other node
+        with mock.patch.object(session, 'request', side_effect=aborted):
+            self.assertRaises(requests.exceptions.ConnectionError,
+                self.api.create_sni, "a005.example.com", "cert001")
+        request_info.assert_not_called()
+
+    def test_fail_over_from_unix_socket(self):
+        # GIVEN the first admin node does not listen on its socket
+        self.api = api.KongAdminApi(
+            url="unix:///nonexistent/admin.sock," + self.server.url)
+
+        # WHEN writing THEN the write is sent to the other node
+        self.api.create_sni("a005.example.com", "cert001")
+
+    def test_api_with_nodes_can_be_pickled(self):
+        self.api = api.KongAdminApi(url=[self.server.url, self.server.url])
+
+        restored = pickle.loads(pickle.dumps(self.api))
+
+        self.assertEqual(len(restored.list_routes()),
+            len(self.api.list_routes()))
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_list_all_pages(self, response_override):
+        # GIVEN the first page of routes has a next page
+        first_page = json.dumps({
+            "data": [{"id": "route000"}],
+            "next": "/routes?offset=abc"
+        })
+        response_override.side_effect = lambda method, path: (
+            (200, {}, first_page) if path == "/routes" else None)
+
+        # WHEN listing routes THEN routes from every page are returned
+        routes = self.api.list_routes()
+
+        self.assertEqual([r['id'] for r in routes],
+            ["route000", "route001", "route002", "route003"])
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.request_info')
+    def test_certificate_body_streamed(self, request_info):
+        # GIVEN a certificate larger than the inline limit
+        cert = "-----BEGIN CERTIFICATE-----\n" + "A" * 2048 + "\n"
+
+        # WHEN uploading the certificate
+        self.api.update_or_create_certificate("cert001", cert, "KEY",
+            tags=["a"])
+
+        # THEN the streamed body is the certificate as json
+        _, _, body = request_info.call_args[0]
+        self.assertEqual(json.loads(body.decode('utf-8')),
+            {"cert": cert, "key": "KEY", "tags": ["a"]})
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_compressed_response(self, response_override):
+        # GIVEN a proxy which compresses the certificates
+        page = json.dumps({
+            "data": [{"id": "cert%03d" % i, "cert": "A" * 4096}
+                for i in range(10)],
+            "next": None
+        }).encode('utf-8')
+        response_override.return_value = (200,
+            {"Content-Encoding": "gzip"}, gzip.compress(page))
+
+        # WHEN listing certificates
+        certs = self.api.list_certificates()
+
+        # THEN the response is decoded and the saved bytes are measured
+        self.assertEqual(len(certs), 10)
+        stats = self.api.transfer_stats
+        self.assertEqual(stats.decoded_bytes, len(page))
+        self.assertTrue(stats.saved_bytes > len(page) // 2)
+
+    def test_api_can_be_pickled(self):
+        restored = pickle.loads(pickle.dumps(self.api))
+
+        self.assertEqual(len(restored.list_routes()), 3)
+
+
+class UnixSocketApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.server = MockHttpServer(handler=MockKongAdminHandler,
+            unix_socket=self.temp_dir + "/admin.sock")
+        self.server.start()
+        self.api = api.KongAdminApi(url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def test_list_over_unix_socket(self):
+        self.assertTrue(self.server.url.startswith("unix:///"))
+        self.assertEqual(len(self.api.list_routes()), 3)
+
+    def test_write_over_unix_socket(self):
+        self.api.update_or_create_certificate("cert001", "CERT", "KEY")
+        self.api.delete_sni("a001.example.com")
+
+    def test_unix_socket_api_can_be_pickled(self):
+        restored = pickle.loads(pickle.dumps(self.api))
+
+        self.assertEqual(len(restored.list_certificates()), 4)
+
+
+class JsonBodyTest(unittest.TestCase):
+
+    def test_encoded_strings_reused(self):
+        # GIVEN bodies for the same certificate
+        strings = json_stream.EncodedStrings(size=1)
+        cert = "C" * 1024
+        first = list(json_stream.JsonBody({"cert": cert}, strings))
+        second = list(json_stream.JsonBody({"cert": cert, "snis": []},
+            strings))
+
+        # THEN the certificate is encoded once
+        self.assertIs(first[1], second[1])
+        self.assertEqual(len(strings), 1)
+        self.assertEqual(json.loads(b"".join(second).decode('utf-8')),
+            {"cert": cert, "snis": []})
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def test_rate_limit(self):
+        # GIVEN a burst of 2 and 20 requests per second
+        scheduler = request_scheduler.RequestScheduler(rate=20, burst=2)
+
+        # WHEN acquiring 4 requests
+        start = time.time()
+        for _ in range(4):
+            scheduler.acquire()
+
+        # THEN the 2 requests after the burst wait for tokens
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_priority_order(self):
+        # GIVEN requests waiting while the scheduler is deferred
+        scheduler = request_scheduler.RequestScheduler(rate=1000, burst=1)
+        scheduler.defer(0.2)
+        order = []
+
+        def send(priority):
+            scheduler.acquire(priority)
+            order.append(priority)
+
+        threads = [
+            threading.Thread(target=send,
+                args=(request_scheduler.PRIORITY_BULK,)),
+            threading.Thread(target=send,
+                args=(request_scheduler.PRIORITY_CHALLENGE,)),
+        ]
+        for t in threads:
+            t.start()
+            time.sleep(0.05)
+        for t in threads:
+            t.join()
+
+        # THEN the challenge request is sent first
+        self.assertEqual(order, [
+            request_scheduler.PRIORITY_CHALLENGE,
+            request_scheduler.PRIORITY_BULK
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
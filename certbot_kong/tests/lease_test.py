@@ -0,0 +1,185 @@
+""" Tests for leasing entities between concurrent runs """
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from certbot.compat import os
+
+import certbot_kong.kong_admin_api as api
+from certbot_kong import lease
+from certbot_kong.tests.mock_http_server import MockHttpServer
+from certbot_kong.tests.mock_kong_admin_handler import MockKongAdminHandler
+
+
+class FileLeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lease_dir = tempfile.mkdtemp()
+        self.run1 = lease.FileLeaseManager(self.lease_dir,
+            timeout=0.2, poll_interval=0.05)
+        self.run2 = lease.FileLeaseManager(self.lease_dir,
+            timeout=0.2, poll_interval=0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.lease_dir)
+
+    def test_disjoint_keys(self):
+        # GIVEN a run holding a lease on a SNI
+        with self.run1.hold(["sni:a001.example.com"]):
+            # WHEN another run leases a different SNI
+            # THEN it does not wait
+            with self.run2.hold(["sni:a002.example.com"]):
+                pass
+
+        # AND all leases are released
+        self.assertEqual(os.listdir(self.lease_dir), [])
+
+    def test_conflicting_keys(self):
+        # GIVEN a run holding a lease on a SNI
+        with self.run1.hold(["sni:a001.example.com"]):
+            # WHEN another run leases the same SNI
+            # THEN it times out waiting
+            self.assertRaises(lease.LeaseError,
+                self.run2.hold(["sni:a002.example.com",
+                    "sni:a001.example.com"]).__enter__)
+
+        # AND the lease the other run did acquire is released
+        with self.run1.hold(["sni:a002.example.com"]):
+            pass
+
+    def test_expired_lease_taken_over(self):
+        # GIVEN an expired lease left by a crashed run
+        path = self.run1._path("sni:a001.example.com") # pylint: disable=protected-access
+        with open(path, 'w') as f:
+            json.dump({"owner": "crashed", "expires": time.time() - 1}, f)
+
+        # WHEN another run leases the SNI THEN the lease is taken over
+        with self.run2.hold(["sni:a001.example.com"]):
+            with open(path, 'r') as f:
+                self.assertEqual(json.load(f)['owner'], self.run2.owner)
+
+    def test_renewed_lease_not_taken_over(self):
+        # GIVEN a lease which was read as expired but renewed since
+        key = "sni:a001.example.com"
+        path = self.run1._path(key) # pylint: disable=protected-access
+        with open(path, 'w') as f:
+            json.dump({"owner": "renewed", "expires": time.time() + 60}, f)
+        expired = {"owner": "renewed", "expires": time.time() - 1}
+
+        # WHEN another run reads it as expired and takes it over
+        read = self.run2._read # pylint: disable=protected-access
+        reads = [expired]
+        with mock.patch.object(self.run2, '_read',
+                side_effect=lambda p: reads.pop() if reads else read(p)):
+            self.assertFalse(self.run2._try_acquire(key, time.time() + 60)) # pylint: disable=protected-access
+
+        # THEN the renewed lease is kept
+        with open(path, 'r') as f:
+            self.assertEqual(json.load(f)['owner'], "renewed")
+        self.assertEqual(os.listdir(self.lease_dir), [os.path.basename(path)])
+
+    def test_lease_being_written_not_taken_over(self):
+        # GIVEN a lease which was just created but not written yet
+        path = self.run1._path("sni:a001.example.com") # pylint: disable=protected-access
+        with open(path, 'w'):
+            pass
+
+        # THEN another run waits for it
+        self.assertRaises(lease.LeaseError,
+            self.run2.hold(["sni:a001.example.com"]).__enter__)
+
+    def test_lease_renewed_while_held(self):
+        run = lease.FileLeaseManager(self.lease_dir, ttl=0.15)
+        path = run._path("sni:a001.example.com") # pylint: disable=protected-access
+
+        with run.hold(["sni:a001.example.com"]):
+            time.sleep(0.3)
+            # THEN the lease did not expire
+            with open(path, 'r') as f:
+                self.assertTrue(json.load(f)['expires'] > time.time())
+
+
+class KongLeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockHttpServer(handler=MockKongAdminHandler)
+        self.server.start()
+        self.api = api.KongAdminApi(url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.request_info')
+    def test_lease_stored_as_consumer(self, request_info):
+        manager = lease.KongLeaseManager(self.api)
+
+        with manager.hold(["sni:a001.example.com"]):
+            pass
+
+        method, path, body = request_info.mock_calls[0].args
+        self.assertEqual((method, path), ("POST", "/consumers"))
+        consumer = json.loads(body.decode('utf-8'))
+        self.assertEqual(consumer['custom_id'], manager.owner)
+        self.assertTrue(lease.LEASE_TAG in consumer['tags'])
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_lease_held_by_another_run(self, response_override):
+        # GIVEN the consumer for the lease already exists
+        response_override.side_effect = (
+            lambda method, path: (409, {}) if method == "POST" else None)
+        manager = lease.KongLeaseManager(self.api,
+            timeout=0.1, poll_interval=0.05)
+
+        # THEN the lease is not acquired
+        with mock.patch.object(self.api, 'get_consumer',
+                return_value={"tags": [lease.LEASE_TAG,
+                    "expires:%d" % (time.time() + 60)]}):
+            self.assertRaises(lease.LeaseError,
+                manager.hold(["sni:a001.example.com"]).__enter__)
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.request_info')
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.response_override')
+    def test_renewed_lease_not_deleted(self, response_override, request_info):
+        # GIVEN an expired lease which is renewed before it is deleted
+        response_override.side_effect = (
+            lambda method, path: (409, {}) if method == "POST" else None)
+        expired = {"id": "c1", "custom_id": "other", "tags": [lease.LEASE_TAG,
+            "expires:%d" % (time.time() - 1)]}
+        renewed = dict(expired, tags=[lease.LEASE_TAG,
+            "expires:%d" % (time.time() + 60)])
+        manager = lease.KongLeaseManager(self.api)
+
+        with mock.patch.object(self.api, 'get_consumer',
+                side_effect=[expired, renewed]):
+            self.assertFalse(manager._try_acquire( # pylint: disable=protected-access
+                "sni:a001.example.com", time.time() + 60))
+
+        # THEN the consumer is not deleted
+        self.assertEqual([c.args[0] for c in request_info.mock_calls],
+            ["POST"])
+
+    @mock.patch('certbot_kong.tests.mock_kong_admin_handler.'
+        'MockKongAdminHandler.request_info')
+    def test_lease_renewed_while_held(self, request_info):
+        manager = lease.KongLeaseManager(self.api, ttl=0.15)
+
+        with mock.patch.object(self.api, 'get_consumer',
+                return_value={"id": "c1", "custom_id": manager.owner}):
+            with manager.hold(["sni:a001.example.com"]):
+                time.sleep(0.3)
+
+        # THEN the expiry of the consumer is extended
+        self.assertTrue(("PATCH", "/consumers/c1") in
+            [c.args[:2] for c in request_info.mock_calls])
+
+
+if __name__ == '__main__':
+    unittest.main()
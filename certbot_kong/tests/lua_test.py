@@ -0,0 +1,42 @@
+""" Tests for writing values into Lua code """
+import re
+import unittest
+
+from certbot_kong import challenge_route
+from certbot_kong import lua
+from certbot_kong import redirect
+
+
+class LuaTest(unittest.TestCase):
+
+    def test_quote(self):
+        self.assertEqual(lua.quote("a001.example.com"), '"a001.example.com"')
+        self.assertEqual(lua.quote('a"] = 1 os.exit() --'),
+            '"a\\034\\093\\032\\061\\0321\\032os.exit\\040\\041\\032--"')
+
+    def test_unquote(self):
+        for value in ["*.example.com", 'a"]\\\n',
+                b"b\xc3\xbccher.example".decode('utf-8')]:
+            literal = lua.quote(value)
+            self.assertTrue(re.match("^%s$" % lua.STRING, literal))
+            self.assertEqual(lua.unquote(literal), value)
+        # literals which are not written by quote
+        self.assertEqual(lua.unquote('"a\\"b\\n"'), 'a"b\n')
+
+    def test_redirect_hosts_escaped(self):
+        hosts = {"a001.example.com", 'evil"] = true } os.exit() --'}
+
+        plugin = redirect.plugin_data(hosts)
+
+        self.assertFalse("os.exit()" in plugin['config']['access'][0])
+        self.assertEqual(redirect.get_hosts(plugin), hosts)
+
+    def test_challenge_validations_escaped(self):
+        plugin = challenge_route.plugin_data("service", {
+            "/.well-known/acme-challenge/token": 'key"..os.exit().."'})
+
+        self.assertFalse("os.exit()" in plugin['config']['access'][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
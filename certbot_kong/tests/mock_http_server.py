@@ -4,10 +4,23 @@ try:
     from http.server import BaseHTTPRequestHandler, HTTPServer
 except ImportError:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import UnixStreamServer
+except ImportError:
+    from SocketServer import UnixStreamServer
 import socket
 from threading import Thread
 
 
+class UnixHTTPServer(UnixStreamServer):
+    """ HTTP server listening on a Unix domain socket """
+
+    def get_request(self):
+        request, _ = UnixStreamServer.get_request(self)
+        # handlers expect a (host, port) client address
+        return request, ("localhost", 0)
+
+
 class MockHttpServer(object):
     """ Run a mock HTTP server """
     @property
@@ -18,14 +31,18 @@ class MockHttpServer(object):
     @property
     def url(self):
         """ get the server url """
+        if self._unix_socket:
+            return "unix://"+self._unix_socket
         return "http://localhost:"+str(self._port)
 
     def __init__(
         self,
         port=None,
-        handler=None
+        handler=None,
+        unix_socket=None
     ):
         self._port = port  # type: int
+        self._unix_socket = unix_socket  # type: str
         self._handler = handler  # type: BaseHTTPRequestHandler
         self._server = None  # type: HTTPServer
         self._thread = None  # type: Thread
@@ -45,7 +62,10 @@ class MockHttpServer(object):
 
     def start(self):
         """ start the server """
-        self._server = HTTPServer(('localhost', self._port), self._handler)
+        if self._unix_socket:
+            self._server = UnixHTTPServer(self._unix_socket, self._handler)
+        else:
+            self._server = HTTPServer(('localhost', self._port), self._handler)
         self._thread = Thread(target=self._server.serve_forever)
         self._thread.setDaemon(True)
         self._thread.start()
@@ -54,3 +74,4 @@ class MockHttpServer(object):
         """ stop the server """
         if self._server:
             self._server.shutdown()
+            self._server.server_close()
@@ -1,4 +1,5 @@
 """ Mock Kong Admin service """
+import json
 import re
 
 # Standard library imports...
@@ -14,13 +15,33 @@ class MockKongAdminHandler(BaseHTTPRequestHandler):
     Mocks the following Kong Admin operations:
         - GET /certificates
         - GET /routes
+        - GET /services
+        - GET /snis, from the certificate snis
+        - GET /plugins
+        - GET /services/{id}/routes and /services/{id}/plugins
+        - GET /certificates/{id}, /routes/{id} and /snis/{name}
+        - GET /<anything else>, always returns 404
         - POST /<anything>, always returns 201
         - PUT /<anything>, always returns 201
         - PATCH /<anything>, always returns 200
         - DELETE /<anything>, always returns 204
+    Paths prefixed with a workspace, i.e. /ws1/routes, respond as if there
+    was no prefix.
+    Tests can patch response_override() to return a (status code, headers)
+    or (status code, headers, body) tuple to respond with instead. The body
+    is sent as is when it is bytes, i.e. compressed.
     """
-    CERTIFICATES_PATTERN = re.compile(r'/certificates')
-    ROUTES_PATTERN = re.compile(r'/routes')
+    CERTIFICATES_PATTERN = re.compile(r'^/certificates/?(\?.*)?$')
+    ROUTES_PATTERN = re.compile(r'^/routes/?(\?.*)?$')
+    SERVICES_PATTERN = re.compile(r'^/services/?(\?.*)?$')
+    SNIS_PATTERN = re.compile(r'^/snis/?(\?.*)?$')
+    PLUGINS_PATTERN = re.compile(r'^/plugins/?(\?.*)?$')
+    SERVICE_ENTITIES_PATTERN = re.compile(
+        r'^/services/([^/?]+)/(routes|plugins)/?(\?.*)?$')
+    ENTITY_PATTERN = re.compile(r'^/(certificates|routes|snis)/([^/?]+)$')
+    WORKSPACE_PATTERN = re.compile(
+        r'^/(?!(certificates|routes|services|snis|plugins|consumers)\b)'
+        r'[^/?]+(/.*)$')
     THIS_DIR = os.path.dirname(os.path.abspath(__file__))
     response_content = None
 
@@ -30,47 +51,93 @@ class MockKongAdminHandler(BaseHTTPRequestHandler):
         body = self.rfile.read(content_len)
 
         self.request_info("GET", self.path, body)
-        if re.search(self.CERTIFICATES_PATTERN, self.path):
-            # Add response status code.
-            self.send_response(200)
-
-            # Add response headers.
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.end_headers()
-
-            # Add response content.
-            filename = os.path.join(self.THIS_DIR,
-                                    "testdata/list_certificates.json")
-
-            with open(filename, "r") as file:
-                response_content = file.read()
-
-            self.wfile.write(response_content.encode('utf-8'))
+        if self.send_response_override("GET", self.path):
+            return
+        path = self.path
+        workspace = re.search(self.WORKSPACE_PATTERN, path)
+        if workspace:
+            path = workspace.group(2)
+        if re.search(self.CERTIFICATES_PATTERN, path):
+            self.send_json(200, self.read_testdata("list_certificates.json"))
+            return
+        elif re.search(self.ROUTES_PATTERN, path):
+            self.send_json(200, self.read_testdata("list_routes.json"))
+            return
+        elif re.search(self.SERVICES_PATTERN, path):
+            self.send_json(200, self.read_testdata("list_services.json"))
+            return
+        elif re.search(self.PLUGINS_PATTERN, path):
+            self.send_json(200, self.read_testdata("list_plugins.json"))
+            return
+        elif re.search(self.SNIS_PATTERN, path):
+            snis = [{"name": sni, "certificate": {"id": cert['id']}}
+                for cert in self.get_entities("certificates")
+                for sni in cert.get('snis', [])]
+            self.send_json(200, json.dumps({"data": snis, "next": None}))
             return
-        elif re.search(self.ROUTES_PATTERN, self.path):
-            # Add response status code.
-            self.send_response(200)
-
-            # Add response headers.
-            self.send_header('Content-Type', 'application/json; charset=utf-8')
-            self.end_headers()
-
-            # Add response content.
-            filename = os.path.join(self.THIS_DIR,
-                                    "testdata/list_routes.json")
 
-            with open(filename, "r") as file:
-                response_content = file.read()
+        match = re.search(self.SERVICE_ENTITIES_PATTERN, path)
+        if match:
+            service_id, kind = match.groups()[:2]
+            entities = [e for e in self.get_entities(kind)
+                if (e.get('service') or {}).get('id') == service_id]
+            self.send_json(200, json.dumps({"data": entities, "next": None}))
+            return
 
-            self.wfile.write(response_content.encode('utf-8'))
+        match = re.search(self.ENTITY_PATTERN, path)
+        entity = self.get_entity(*match.groups()) if match else None
+        if entity is not None:
+            self.send_json(200, json.dumps(entity))
             return
 
+        self.send_json(404, '{"message":"Not found"}')
+
+    def get_entity(self, kind, entity_id):
+        """ get a certificate, route or sni from the test data """
+        if kind == "snis":
+            for cert in self.get_entities("certificates"):
+                if entity_id in cert.get('snis', []):
+                    return {
+                        "name": entity_id,
+                        "certificate": {"id": cert['id']}
+                    }
+            return None
+
+        for entity in self.get_entities(kind):
+            if entity['id'] == entity_id:
+                return entity
+        return None
+
+    def get_entities(self, kind):
+        """ get the certificates, routes or services from the test data """
+        if not os.path.exists(
+                os.path.join(self.THIS_DIR, "testdata", "list_%s.json" % kind)):
+            return []
+        return json.loads(
+            self.read_testdata("list_%s.json" % kind))['data']
+
+    def read_testdata(self, name):
+        """ read a test data file """
+        filename = os.path.join(self.THIS_DIR, "testdata", name)
+        with open(filename, "r") as file:
+            return file.read()
+
+    def send_json(self, status_code, response_content):
+        """ send a JSON response """
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(response_content.encode('utf-8'))
+
     def do_POST(self):
         """ Mock Kong Admin POST requests """
         content_len = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_len)
 
         self.request_info("POST", self.path, body)
+        if self.send_response_override("POST", self.path):
+            return
+        self.apply_write("POST", self.path, body)
 
         self.response_content = '{"id":"new_cert"}'
         self.send_response(201)
@@ -86,6 +153,9 @@ class MockKongAdminHandler(BaseHTTPRequestHandler):
         body = self.rfile.read(content_len)
 
         self.request_info("PUT", self.path, body)
+        if self.send_response_override("PUT", self.path):
+            return
+        self.apply_write("PUT", self.path, body)
 
         self.response_content = '{"id":"new_cert"}'
         self.send_response(201)
@@ -101,6 +171,9 @@ class MockKongAdminHandler(BaseHTTPRequestHandler):
         body = self.rfile.read(content_len)
 
         self.request_info("PATCH", self.path, body)
+        if self.send_response_override("PATCH", self.path):
+            return
+        self.apply_write("PATCH", self.path, body)
 
         self.response_content = '{"id":"updated_sni"}'
         self.send_response(200)
@@ -116,6 +189,9 @@ class MockKongAdminHandler(BaseHTTPRequestHandler):
         body = self.rfile.read(content_len)
 
         self.request_info("DELETE", self.path, body)
+        if self.send_response_override("DELETE", self.path):
+            return
+        self.apply_write("DELETE", self.path, body)
 
         self.send_response(204)
 
@@ -126,3 +202,82 @@ class MockKongAdminHandler(BaseHTTPRequestHandler):
 
     def request_info(self, method, path, body):
         """ not used """
+
+    def apply_write(self, method, path, body):
+        """ not used, see StatefulKongAdminHandler """
+
+    def response_override(self, method, path): # pylint: disable=unused-argument
+        """ not used, returns None to respond normally """
+        return None
+
+    def send_response_override(self, method, path):
+        """ send the response from response_override() if there is one """
+        override = self.response_override(method, path) # pylint: disable=assignment-from-none
+        if not override:
+            return False
+
+        status_code, headers = override[:2]
+        response_content = (override[2] if len(override) > 2 else '{}')
+        if not isinstance(response_content, bytes):
+            response_content = response_content.encode('utf-8')
+        self.send_response(status_code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(response_content)))
+        self.end_headers()
+        self.wfile.write(response_content)
+        return True
+
+
+class StatefulKongAdminHandler(MockKongAdminHandler):
+    """ Mock Kong Admin HTTP server which applies the writes to certificates
+    and SNIs, so they are read back by later requests (i.e. by a later run).
+    The certificates are shared by every handler, call reset() before each
+    test.
+    """
+    SNI_PATTERN = re.compile(r'^/snis/?([^/?]*)$')
+    CERTIFICATE_PATTERN = re.compile(r'^/certificates/([^/?]+)$')
+    certificates = None
+
+    @classmethod
+    def reset(cls):
+        """ restore the certificates of the test data """
+        cls.certificates = None
+
+    def get_entities(self, kind):
+        if kind != "certificates":
+            return super(StatefulKongAdminHandler, self).get_entities(kind)
+        if StatefulKongAdminHandler.certificates is None:
+            StatefulKongAdminHandler.certificates = super(
+                StatefulKongAdminHandler, self).get_entities(kind)
+        return StatefulKongAdminHandler.certificates
+
+    def apply_write(self, method, path, body):
+        data = json.loads(body.decode('utf-8')) if body else {}
+        certificates = self.get_entities("certificates")
+        workspace = re.search(self.WORKSPACE_PATTERN, path)
+        if workspace:
+            path = workspace.group(2)
+
+        match = re.search(self.CERTIFICATE_PATTERN, path)
+        if match:
+            cert = self.get_entity("certificates", match.group(1))
+            if cert is not None:
+                certificates.remove(cert)
+            if method != "DELETE":
+                cert = dict(cert or {"snis": []}, id=match.group(1))
+                cert.update((k, v) for k, v in data.items() if k != "snis")
+                certificates.append(cert)
+            return
+
+        match = re.search(self.SNI_PATTERN, path)
+        if match:
+            name = match.group(1) or data.get('name')
+            for cert in certificates:
+                if name in cert.get('snis', []):
+                    cert['snis'].remove(name)
+            cert = self.get_entity("certificates",
+                (data.get('certificate') or {}).get('id'))
+            if method != "DELETE" and cert is not None:
+                cert.setdefault('snis', []).append(name)
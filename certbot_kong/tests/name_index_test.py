@@ -0,0 +1,38 @@
+""" Tests for the name index """
+import unittest
+
+from certbot_kong.name_index import NameIndex
+
+
+class NameIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = NameIndex(
+            certs=[{"snis": ["b.example.com", "a.example.com"]}],
+            routes=[{"hosts": ["a.example.com", "c.test.com"]}, {}])
+
+    def test_names_sorted(self):
+        self.assertEqual(list(self.index),
+            ["a.example.com", "b.example.com", "c.test.com"])
+
+    def test_name_kept_until_last_reference_removed(self):
+        # WHEN the sni referencing a name also used by a route is removed
+        self.index.discard("a.example.com")
+
+        # THEN the name is still indexed until the route no longer uses it
+        self.assertTrue("a.example.com" in self.index)
+        self.index.discard("a.example.com")
+        self.assertFalse("a.example.com" in self.index)
+        self.assertEqual(self.index.with_prefix("a"), [])
+
+    def test_with_prefix(self):
+        self.index.add("b.example.org")
+
+        self.assertEqual(self.index.with_prefix("b.example."),
+            ["b.example.com", "b.example.org"])
+        self.assertEqual(self.index.with_prefix("c"), ["c.test.com"])
+        self.assertEqual(self.index.with_prefix("d"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
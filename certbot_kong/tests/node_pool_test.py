@@ -0,0 +1,42 @@
+""" Tests for the admin API node pool """
+import unittest
+
+from certbot_kong.node_pool import NodePool
+
+
+class NodePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = NodePool("http://a:8001, http://b:8001,http://c:8001",
+            circuit_threshold=1)
+
+    def test_reads_spread(self):
+        firsts = [self.pool.candidates()[0] for _ in range(3)]
+
+        self.assertEqual(firsts,
+            ["http://a:8001", "http://b:8001", "http://c:8001"])
+
+    def test_writes_pinned(self):
+        firsts = set(self.pool.candidates(write=True)[0] for _ in range(3))
+
+        self.assertEqual(firsts, {"http://a:8001"})
+
+    def test_failed_node_skipped(self):
+        # WHEN the pinned node fails
+        self.pool.record_failure("http://a:8001")
+
+        # THEN writes are pinned to the next node and it is not tried
+        self.assertEqual(self.pool.write_url, "http://b:8001")
+        self.assertEqual(self.pool.candidates(write=True),
+            ["http://b:8001", "http://c:8001"])
+
+        # AND once every node has failed there are no candidates
+        self.pool.record_failure("http://b:8001")
+        self.pool.record_failure("http://c:8001")
+        self.assertEqual(self.pool.candidates(), [])
+        self.pool.reset()
+        self.assertEqual(len(self.pool.candidates()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
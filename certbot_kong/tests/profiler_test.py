@@ -0,0 +1,71 @@
+""" Tests for the run profiler """
+import threading
+import unittest
+
+from certbot_kong.profiler import RunProfiler
+
+
+class FakeClock(object):
+    """ A clock which only moves when a test moves it """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class RunProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.profiler = RunProfiler(clock=self.clock)
+
+    def test_operations(self):
+        # WHEN a nested operation sends a request and decodes the response
+        with self.profiler.operation("save"):
+            self.clock.now += 1
+            with self.profiler.operation("load_config"):
+                with self.profiler.request("GET", "/routes?offset=a"):
+                    self.clock.now += 3
+                with self.profiler.measure("json"):
+                    self.clock.now += 2
+            self.clock.now += 1
+
+        # THEN the time is split by stack and category
+        report = self.profiler.report()
+        self.assertEqual(report["stacks"], {
+            "save;python": 2.0,
+            "save;load_config;network": 3.0,
+            "save;load_config;json": 2.0,
+            "save;load_config;python": 0.0
+        })
+        self.assertEqual(report["totals"],
+            {"python": 2.0, "network": 3.0, "json": 2.0})
+        self.assertEqual(report["operations"]["save"],
+            {"calls": 1, "wall": 7.0})
+
+        # AND the request is counted in the latency histogram
+        latency = report["latency"]["GET /routes"]
+        self.assertEqual(latency["count"], 1)
+        self.assertEqual(latency["buckets"]["5000"], 1)
+
+    def test_pool_threads(self):
+        # WHEN a request is sent by another thread during an operation
+        def send():
+            with self.profiler.request("PUT", "/certificates/cert001"):
+                pass
+
+        with self.profiler.operation("save"):
+            thread = threading.Thread(target=send)
+            thread.start()
+            thread.join()
+
+        # THEN it is attributed to the operation
+        report = self.profiler.report()
+        self.assertIn("save;network", report["stacks"])
+        self.assertEqual(report["latency"]["PUT /certificates"]["count"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
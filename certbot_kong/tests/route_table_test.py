@@ -0,0 +1,68 @@
+""" Tests for the columnar route table """
+import pickle
+import unittest
+
+from certbot_kong.route_table import RouteTable
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RouteTable(iter([
+            {"id": "route001", "hosts": ["a.example.com"],
+                "protocols": ["http", "https"], "updated_at": 10,
+                "service": {"id": "service001"}},
+            {"id": "route002", "hosts": None, "protocols": ["grpc", "foo"]},
+        ]))
+
+    def test_routes(self):
+        self.assertEqual(list(self.table), [
+            {"id": "route001", "hosts": ["a.example.com"],
+                "protocols": ["http", "https"], "updated_at": 10},
+            {"id": "route002", "hosts": None,
+                "protocols": ["grpc", "foo"], "updated_at": None},
+        ])
+        self.assertEqual(list(self.table.iter_hosts()), ["a.example.com"])
+
+    def test_set_protocols(self):
+        self.table.set_protocols("route001", ["https"])
+
+        self.assertEqual(self.table.get("route001")["protocols"], ["https"])
+
+    def test_replace(self):
+        # WHEN a route is replaced and another is removed
+        self.table.replace("route001", {"id": "route001",
+            "hosts": ["a.example.com", "b.example.com"]})
+        self.table.replace("route002", None)
+
+        # THEN only the current routes are listed
+        self.assertEqual(len(self.table), 1)
+        self.assertEqual([r["hosts"] for r in self.table],
+            [["a.example.com", "b.example.com"]])
+        self.assertTrue(self.table.get("route002") is None)
+
+    def test_replaced_rows_dropped(self):
+        # WHEN routes are replaced many times, with and without host changes
+        for i in range(100):
+            self.table.replace("route001", {"id": "route001",
+                "hosts": ["a.example.com"] * (i % 3 + 1), "updated_at": i})
+            self.table.replace("route002", {"id": "route002",
+                "protocols": ["https"], "updated_at": i})
+
+        # THEN the table does not grow
+        self.assertTrue(len(self.table._ids) <= 4) # pylint: disable=protected-access
+        self.assertEqual(sorted(self.table, key=lambda r: r["id"]), [
+            {"id": "route001", "hosts": ["a.example.com"],
+                "protocols": [], "updated_at": 99},
+            {"id": "route002", "hosts": None,
+                "protocols": ["https"], "updated_at": 99},
+        ])
+
+    def test_pickle(self):
+        restored = pickle.loads(pickle.dumps(self.table))
+
+        self.assertEqual(list(restored), list(self.table))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 
 """Common utilities for certbot_kong."""
+import json
 import shutil
 import unittest
 
@@ -56,6 +57,18 @@ class KongTest(unittest.TestCase):  # pylint: disable=too-few-public-methods
         shutil.rmtree(self.config_dir)
         shutil.rmtree(self.work_dir)
 
+    def _get_write_requests(self, calls):
+        """ Helper function to clean and remove GET requests from calls.
+        """
+        requests = []
+        for c in calls:
+            if c.args[0] != "GET":
+                body = None
+                if c.args[2]:
+                    body = json.loads(c.args[2].decode('utf-8'))
+                requests.append((c.args[0], c.args[1], body))
+        return requests
+
 
 def get_kong_configurator(  # pylint: disable=too-many-arguments, too-many-locals
         kong_admin_url,
@@ -70,6 +83,27 @@ def get_kong_configurator(  # pylint: disable=too-many-arguments, too-many-local
     config = configurator.KongConfigurator(
         config=mock.MagicMock(
             kong_admin_url=kong_admin_url,
+            kong_tags=None,
+            kong_workspaces=None,
+            kong_reap_unused_certificates=False,
+            kong_redirect_strategy="protocols",
+            kong_defer_save=False,
+            kong_admin_rate_limit=None,
+            kong_admin_rate_burst=10,
+            kong_admin_max_retries=5,
+            kong_admin_timeout=60,
+            kong_admin_circuit_threshold=5,
+            kong_admin_circuit_reset=30,
+            kong_challenge_route="per-domain",
+            kong_sweep_challenge_services=False,
+            kong_sweep_challenge_services_age=3600,
+            kong_revalidate=True,
+            kong_resume=False,
+            kong_profile=False,
+            kong_lease="none",
+            kong_lease_dir=None,
+            kong_lease_ttl=300,
+            kong_lease_timeout=600,
             backup_dir=backups,
             config_dir=config_dir,
             http01_port=80,
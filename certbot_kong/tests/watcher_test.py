@@ -0,0 +1,115 @@
+""" Tests for the watch mode """
+import unittest
+
+import mock
+
+import certbot_kong.kong_admin_api as api
+from certbot_kong import watcher
+from certbot_kong.tests.mock_http_server import MockHttpServer
+from certbot_kong.tests.mock_kong_admin_handler import MockKongAdminHandler
+
+
+class KongWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockHttpServer(handler=MockKongAdminHandler)
+        self.server.start()
+        self.now = 1000.0
+        self.handler = mock.MagicMock(return_value=True)
+        self.watcher = watcher.KongWatcher(
+            api.KongAdminApi(url=self.server.url), self.handler,
+            debounce=10, retry_delay=100, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_uncovered_hosts_handled_after_debounce(self):
+        # WHEN polling kong
+        self.assertEqual(self.watcher.poll(), ["a004.example.com"])
+
+        # THEN the host is only handled once the debounce has passed
+        self.assertFalse(self.watcher.flush())
+        self.now += 10
+        self.assertTrue(self.watcher.flush())
+        self.handler.assert_called_once_with(["a004.example.com"])
+
+        # AND unchanged routes are not compared again
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.pending, [])
+
+    def test_failed_hosts_retried(self):
+        # GIVEN the handler fails
+        self.handler.return_value = False
+        self.watcher.poll()
+        self.watcher.flush(force=True)
+
+        # THEN the host is retried after the retry delay
+        self.assertEqual(self.watcher.poll(), [])
+        self.now += 100
+        self.assertEqual(self.watcher.poll(), ["a004.example.com"])
+
+    def test_failed_group_split(self):
+        # GIVEN hosts flushed in groups, one of which cannot be validated
+        kong = mock.MagicMock()
+        kong.iter_routes.return_value = [{"id": "r1", "hosts": [
+            "a.example.com", "b.example.com", "bad.example.com",
+            "*.example.com", "example.*"]}]
+        kong.list_snis.return_value = []
+        self.handler.side_effect = lambda hosts: "bad.example.com" not in hosts
+        group_watcher = watcher.KongWatcher(kong, self.handler, group_size=4,
+            retry_delay=100, clock=lambda: self.now)
+
+        # WHEN the hosts are handled
+        group_watcher.poll()
+        group_watcher.flush(force=True)
+
+        # THEN wildcard hosts are skipped and the failed group is split
+        self.assertEqual([c.args[0] for c in self.handler.mock_calls], [
+            ["a.example.com", "b.example.com", "bad.example.com"],
+            ["a.example.com"],
+            ["b.example.com", "bad.example.com"],
+            ["b.example.com"],
+            ["bad.example.com"]])
+        # AND only the host which failed on its own is retried
+        self.now += 100
+        self.assertEqual(group_watcher.poll(), ["bad.example.com"])
+
+    @mock.patch('certbot_kong.watcher.subprocess.call', return_value=0)
+    @mock.patch('certbot_kong.kong_admin_api.KongAdminApi')
+    def test_hosts_batched_into_one_run(self, kong_admin_api, call):
+        # GIVEN several uncovered hosts
+        kong = kong_admin_api.return_value
+        kong.iter_routes.return_value = [
+            {"id": "r1", "hosts": ["a.example.com", "b.example.com"]},
+            {"id": "r2", "hosts": ["c.example.com"]}]
+        kong.list_snis.return_value = []
+
+        # WHEN watching once with the default options
+        self.assertEqual(watcher.main(["--once"]), 0)
+
+        # THEN the hosts get one certificate from a single certbot run
+        self.assertEqual(call.call_count, 1)
+        command = call.call_args.args[0]
+        self.assertEqual([command[i + 1] for i, a in enumerate(command)
+            if a == "-d"], ["a.example.com", "b.example.com", "c.example.com"])
+
+    def test_covered_by_wildcard(self):
+        self.assertTrue(watcher.is_covered("a.example.com",
+            {"*.example.com"}))
+        self.assertFalse(watcher.is_covered("a.b.example.com",
+            {"*.example.com"}))
+
+    def test_certbot_command(self):
+        handler = watcher.CertbotHandler("http://kong:8001",
+            ["--email", "a@example.com"], tags="team-a")
+
+        self.assertEqual(handler.command(["a.example.com", "b.example.com"]),
+            ["certbot", "run", "--non-interactive", "-a", "kong",
+            "-i", "kong", "--kong-admin-url", "http://kong:8001",
+            "--kong-tags", "team-a",
+            "-d", "a.example.com", "-d", "b.example.com",
+            "--email", "a@example.com"])
+
+
+if __name__ == '__main__':
+    unittest.main()
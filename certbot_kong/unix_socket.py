@@ -0,0 +1,79 @@
+""" Module to send admin API requests over a Unix domain socket """
+import socket
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+try:
+    from urllib.parse import unquote
+except ImportError: # pragma: no cover
+    from urllib import unquote
+
+UNIX_SCHEME = "unix://"
+# base url of the requests sent to the adapter, the host is not used
+BASE_URL = "http://kong-admin.sock"
+
+
+def is_unix_url(url):
+    """ Check if the url is a unix socket url, i.e. unix:///path/admin.sock """
+    return url.startswith(UNIX_SCHEME)
+
+
+def socket_path(url):
+    """ Get the socket path of a unix socket url """
+    return unquote(url[len(UNIX_SCHEME):])
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """ HTTP connection over a Unix domain socket """
+
+    def __init__(self, *args, **kwargs):
+        self.socket_path = kwargs.pop('socket_path')
+        super(UnixHTTPConnection, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as e:
+            sock.close()
+            # as for TCP connections, so the request is known not to be sent
+            raise NewConnectionError(self,
+                "Failed to establish a new connection: %s" % e)
+        return sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    """ Pool of HTTP connections over a Unix domain socket """
+    ConnectionCls = UnixHTTPConnection
+
+    def __init__(self, path, **kwargs):
+        super(UnixHTTPConnectionPool, self).__init__("localhost", **kwargs)
+        self.conn_kw['socket_path'] = path
+
+
+class UnixAdapter(HTTPAdapter):
+    """ Transport adapter sending every request to a Unix domain socket.
+    Connections are pooled and kept alive like TCP connections.
+    """
+
+    def __init__(self, path, pool_maxsize=10, **kwargs):
+        self._path = path
+        self._pool = UnixHTTPConnectionPool(path, maxsize=pool_maxsize,
+            block=False)
+        super(UnixAdapter, self).__init__(pool_maxsize=pool_maxsize, **kwargs)
+
+    def get_connection(self, url, proxies=None): # pylint: disable=unused-argument
+        return self._pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+            cert=None): # pylint: disable=unused-argument
+        return self._pool
+
+    def close(self):
+        super(UnixAdapter, self).close()
+        self._pool.close()
@@ -0,0 +1,217 @@
+""" Module to watch Kong for route hosts which have no certificate """
+import argparse
+import logging
+import subprocess
+import sys
+import time
+
+from certbot_kong import constants
+from certbot_kong.domain_resolver import is_wildcard_host
+from certbot_kong.domain_resolver import parent_domain
+
+logger = logging.getLogger(__name__)
+
+
+def is_covered(host, snis):
+    """ Check if a host is covered by an SNI (or a wildcard SNI) """
+    if host in snis:
+        return True
+    parent = parent_domain(host)
+    return parent is not None and ("*." + parent) in snis
+
+
+class KongWatcher(object):
+    """ Poll Kong for route hosts which are not covered by any SNI.
+
+    Only routes created or updated since the previous poll (by updated_at
+    and hosts) have their hosts compared with the SNIs, and the SNIs are
+    listed rather than the certificates so no certificate material is
+    transferred. The SNIs are listed with `sni_api` (by default the api),
+    i.e. without the tags the routes are filtered by. Wildcard hosts are
+    skipped. Uncovered hosts are collected and flushed once no new host has
+    been seen for `debounce` seconds, or once `batch_size` hosts are
+    pending. Flushed hosts are handed to the handler in groups of
+    `group_size` hosts, one certificate per group.
+
+    :ivar handler: called with a sorted list of uncovered hosts, returns
+        True when the hosts were handled. A group which was not handled is
+        split and its halves are handed to the handler again, so one host
+        which cannot be validated does not fail the others. Hosts which
+        were not handled on their own are retried after `retry_delay`
+        seconds if they are still uncovered.
+    """
+
+    def __init__(self, api, handler, interval=30, debounce=10,
+            batch_size=100, retry_delay=3600, clock=time.time,
+            sleep=time.sleep, sni_api=None,
+            group_size=constants.MAX_NAMES_PER_CERTIFICATE):
+        self._api = api
+        self._sni_api = sni_api or api
+        self.handler = handler
+        self.interval = interval
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.retry_delay = retry_delay
+        self._clock = clock
+        self._sleep = sleep
+        self._routes = {} #type: Dict[str, Tuple[int, List[str]]]
+        self._pending = set() #type: Set[str]
+        self._failed = {} #type: Dict[str, float]
+        self._last_seen = None
+
+    @property
+    def pending(self):
+        """ get the uncovered hosts waiting to be handled """
+        return sorted(self._pending)
+
+    def poll(self):
+        """ Poll kong once
+        :returns: the new uncovered hosts
+        """
+        changed = []
+        routes = {}
+        for route in self._api.iter_routes():
+            version = (route.get('updated_at'), [h for h in
+                route.get('hosts') or [] if not is_wildcard_host(h)])
+            routes[route['id']] = version
+            if self._routes.get(route['id']) != version:
+                changed.extend(version[1])
+        self._routes = routes
+
+        now = self._clock()
+        hosts = set(h for _, route_hosts in routes.values()
+            for h in route_hosts)
+        retry = [h for h, retry_at in self._failed.items()
+            if retry_at <= now]
+        for host in retry:
+            del self._failed[host]
+        candidates = set(changed).union(h for h in retry if h in hosts)
+        candidates.difference_update(self._pending, self._failed)
+        if not candidates:
+            return []
+
+        snis = set(s['name'] for s in self._sni_api.list_snis())
+        new_hosts = set(h for h in candidates if not is_covered(h, snis))
+        if new_hosts:
+            logger.info("Found hosts without a certificate: %s",
+                ", ".join(sorted(new_hosts)))
+            self._pending.update(new_hosts)
+            self._last_seen = now
+        return sorted(new_hosts)
+
+    def flush(self, force=False):
+        """ Hand the pending hosts to the handler if they are due
+        :returns: True if the handler was called
+        """
+        if not self._pending:
+            return False
+        if (not force and len(self._pending) < self.batch_size and
+                self._clock() - self._last_seen < self.debounce):
+            return False
+
+        hosts = sorted(self._pending)
+        for i in range(0, len(hosts), self.group_size):
+            group = hosts[i:i + self.group_size]
+            self._pending.difference_update(group)
+            self._handle(group)
+        return True
+
+    def _handle(self, hosts):
+        """ helper function to hand hosts to the handler, splitting the
+        hosts until the hosts which cannot be handled are found
+        """
+        if self.handler(hosts):
+            return
+        if len(hosts) > 1:
+            middle = len(hosts) // 2
+            self._handle(hosts[:middle])
+            self._handle(hosts[middle:])
+            return
+        logger.warning("Unable to handle %s, retrying in %d seconds",
+            hosts[0], self.retry_delay)
+        self._failed[hosts[0]] = self._clock() + self.retry_delay
+
+    def run(self, iterations=None):
+        """ Poll and flush every interval (until `iterations` polls) """
+        count = 0
+        while iterations is None or count < iterations:
+            try:
+                self.poll()
+            except Exception: # pylint: disable=broad-except
+                logger.warning("Unable to poll kong", exc_info=True)
+            self.flush()
+            count += 1
+            self._sleep(self.interval)
+
+
+class CertbotHandler(object):
+    """ Issue and install a certificate for hosts by running certbot """
+
+    def __init__(self, admin_url, certbot_args=None, certbot="certbot",
+            tags=None):
+        self.admin_url = admin_url
+        self.certbot_args = list(certbot_args or [])
+        self.certbot = certbot
+        self.tags = tags
+
+    def command(self, hosts):
+        """ get the certbot command for the hosts """
+        command = [self.certbot, "run", "--non-interactive",
+            "-a", "kong", "-i", "kong", "--kong-admin-url", self.admin_url]
+        if self.tags:
+            command.extend(["--kong-tags", self.tags])
+        for host in hosts:
+            command.extend(["-d", host])
+        return command + self.certbot_args
+
+    def __call__(self, hosts):
+        command = self.command(hosts)
+        logger.info("Running %s", " ".join(command))
+        return subprocess.call(command) == 0
+
+
+def main(argv=None):
+    """ Watch kong and run certbot for route hosts without a certificate """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--kong-admin-url",
+        default=constants.CLI_DEFAULTS["admin_url"])
+    parser.add_argument("--kong-tags", default=None,
+        help="Comma separated kong tags of the routes to watch")
+    parser.add_argument("--interval", type=float, default=30,
+        help="Seconds between polls")
+    parser.add_argument("--debounce", type=float, default=10,
+        help="Seconds without new hosts before certbot is run")
+    parser.add_argument("--batch-size", type=int, default=100,
+        help="Number of pending hosts after which certbot is run without "
+        "waiting for the debounce")
+    parser.add_argument("--hosts-per-certificate", type=int,
+        default=constants.MAX_NAMES_PER_CERTIFICATE,
+        help="Maximum number of hosts per certificate (and certbot run)")
+    parser.add_argument("--once", action="store_true",
+        help="Poll once and run certbot for any uncovered hosts")
+    parser.add_argument("certbot_args", nargs=argparse.REMAINDER,
+        help="Arguments passed to certbot after --")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from certbot_kong.kong_admin_api import KongAdminApi
+    tags = [t.strip() for t in (args.kong_tags or "").split(",") if t.strip()]
+    sni_api = KongAdminApi(url=args.kong_admin_url)
+    api = KongAdminApi(url=args.kong_admin_url, tags=tags) if tags else sni_api
+    certbot_args = [a for a in args.certbot_args if a != "--"]
+    watcher = KongWatcher(api, CertbotHandler(args.kong_admin_url,
+        certbot_args, tags=",".join(tags) or None), interval=args.interval,
+        debounce=args.debounce, batch_size=args.batch_size, sni_api=sni_api,
+        group_size=args.hosts_per_certificate)
+
+    if args.once:
+        watcher.poll()
+        watcher.flush(force=True)
+        return 0
+    watcher.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
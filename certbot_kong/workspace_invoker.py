@@ -0,0 +1,177 @@
+""" Module to invoke changes across Kong Enterprise workspaces """
+import collections
+import logging
+from multiprocessing.pool import ThreadPool
+
+from certbot_kong.change_invoker import CertificateStore
+from certbot_kong.change_invoker import KongChangeInvoker
+from certbot_kong.change_invoker import KongChangeInvokerError
+from certbot_kong.name_index import NameIndex
+
+logger = logging.getLogger(__name__)
+
+_workspace_processes = 8
+
+
+class WorkspaceChangeInvoker(object):
+    """ Invoke changes to several workspaces with one invoker per workspace.
+
+    The invokers share one certificate store, so certificate material
+    deployed to several workspaces is held (and encoded) once. The
+    inventories are loaded, and the changes applied, concurrently. Names
+    are deployed to every workspace which already references them, or to
+    the first workspace when none do.
+    """
+
+    def __init__(self, api, workspaces, processes=_workspace_processes,
+            **kwargs):
+        self._processes = processes
+        self._resumable = kwargs.get('progress') is not None
+        self._store = CertificateStore()
+        self._names = None
+        self._invokers = collections.OrderedDict(zip(workspaces,
+            self._map(lambda w: KongChangeInvoker(api.for_workspace(w),
+                store=self._store, **kwargs), workspaces)))
+
+    @property
+    def invokers(self):
+        """ Get the invokers by workspace """
+        return self._invokers
+
+    @property
+    def routes(self):
+        """ Get the routes of every workspace """
+        return [r for i in self._invokers.values() for r in i.routes]
+
+    @property
+    def certs(self):
+        """ Get the certs of every workspace """
+        return [c for i in self._invokers.values() for c in i.certs]
+
+    @property
+    def names(self):
+        """ Get the names of every workspace
+        :rtype: :class:`~certbot_kong.name_index.NameIndex`
+        """
+        if self._names is None:
+            self._names = NameIndex(self.certs, self.routes)
+        return self._names
+
+    def _map(self, func, items):
+        items = list(items)
+        pool = ThreadPool(max(min(len(items), self._processes), 1))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+
+    def _name_invokers(self, name):
+        """ helper function to get the invokers of the workspaces which
+        reference the name, or of the first workspace if none do
+        """
+        invokers = [i for i in self._invokers.values() if name in i.names]
+        return invokers or list(self._invokers.values())[:1]
+
+    def load_config(self):
+        """ Load the configuration of every workspace """
+        self._map(lambda i: i.load_config(), self._invokers.values())
+        self._names = None
+
+    def clear_changes(self):
+        """ Clear the queued changes of every workspace """
+        for invoker in self._invokers.values():
+            invoker.clear_changes()
+
+    def set_sni_cert(self, sni, fullchain_str, key_str, *args, **kwargs):
+        """ Set the certificate of the SNI in the workspaces using it """
+        for invoker in self._name_invokers(sni):
+            invoker.set_sni_cert(sni, fullchain_str, key_str, *args, **kwargs)
+        if self._names is not None:
+            self._names.add(sni)
+
+    def redirect_route(self, route_id):
+        """ Configure http to https redirection for a route """
+        for invoker in self._invokers.values():
+            if route_id in invoker.routes:
+                invoker.redirect_route(route_id)
+                return
+        raise KongChangeInvokerError("Unable to redirect route for %s "
+            "as there is no matching route" % route_id)
+
+    def redirect_hosts(self, hosts):
+        """ Configure http to https redirection for hosts in the workspaces
+        using them
+        """
+        for invoker in self._invokers.values():
+            workspace_hosts = [h for h in hosts if h in invoker.names]
+            if workspace_hosts:
+                invoker.redirect_hosts(workspace_hosts)
+
+    def create_http01_challenge_service(self,
+            domain, validation, validation_path):
+        """ Create the challenge service in the workspaces using the domain
+        """
+        for invoker in self._name_invokers(domain):
+            invoker.create_http01_challenge_service(
+                domain, validation, validation_path)
+
+    def create_http01_challenge_route(self, challenges):
+        """ Create one challenge service, for the challenges of the domains
+        it uses, in each workspace
+        """
+        by_workspace = collections.OrderedDict()
+        for challenge in challenges:
+            for invoker in self._name_invokers(challenge[0]):
+                by_workspace.setdefault(id(invoker), (invoker, []))[1].append(
+                    challenge)
+        for invoker, workspace_challenges in by_workspace.values():
+            invoker.create_http01_challenge_route(workspace_challenges)
+
+    def reap_unused_certs(self):
+        """ Delete the unused certificates of every workspace """
+        ids = []
+        for invoker in self._invokers.values():
+            ids.extend(invoker.reap_unused_certs())
+        return ids
+
+    def get_changes_details(self):
+        """ Get a list of changes queued to be invoked """
+        return ["[%s] %s" % (workspace, detail)
+            for workspace, invoker in self._invokers.items()
+            for detail in invoker.get_changes_details()]
+
+    def apply_changes(self, resumable=False):
+        """ Apply the changes to every workspace concurrently.
+        If the changes to any workspace fail, the changes applied to the
+        other workspaces are undone before the error is raised, unless the
+        apply is resumable (see KongChangeInvoker.apply_changes()).
+        """
+        def apply_workspace(invoker):
+            try:
+                invoker.apply_changes(resumable)
+                return None
+            except Exception as e: # pylint: disable=broad-except
+                return e
+
+        invokers = list(self._invokers.values())
+        errors = self._map(apply_workspace, invokers)
+        failed = [e for e in errors if e is not None]
+        if failed:
+            if not (resumable and self._resumable):
+                self._map(lambda i: i.undo_changes(),
+                    [i for i, e in zip(invokers, errors) if e is None])
+            raise failed[0]
+
+    def undo_changes(self):
+        """ Undo the changes applied to every workspace """
+        def undo_workspace(invoker):
+            try:
+                invoker.undo_changes()
+                return None
+            except Exception as e: # pylint: disable=broad-except
+                return e
+
+        failed = [e for e in self._map(undo_workspace,
+            self._invokers.values()) if e is not None]
+        if failed:
+            raise failed[0]
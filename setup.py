@@ -17,5 +17,8 @@ setup(
         'certbot.plugins': [
             'kong = certbot_kong.configurator:KongConfigurator',
         ],
+        'console_scripts': [
+            'certbot-kong-watch = certbot_kong.watcher:main',
+        ],
     },
 )